@@ -1,5 +1,4 @@
-import json
-import logging.config
+import logging
 import os
 import time
 from threading import Thread
@@ -7,44 +6,132 @@ from threading import Thread
 import connexion
 import yaml
 from connexion.middleware import MiddlewarePosition
-from pykafka import KafkaClient
-from pykafka.common import OffsetType
 from starlette.middleware.cors import CORSMiddleware
 
+from feed import EVENT_KEYS, FeedMiddleware, feed_from_config
+from history import history_from_config
+from shared.cache import cache_from_config
+from shared.codec import DecodeError, decode
+from shared.digest import BucketDigests, Ranges, digests, digests_from_config, in_range
+from shared.health import Health
+from shared.ids import trace_id_ms
+from shared.log import configure_logging, get_event_logger
+from shared.metrics import MetricsMiddleware, counter, histogram, metrics_response, SIZE_BUCKETS
+from shared.profile import profiler_from_config
+from shared.serve import serve
+from shared.state import SharedState, state_from_config
+from shared.transport import get_transport
+
 # Configurations
-with open('/app/config/app_conf.yml', 'r', encoding='utf-8') as f:
+with open(os.environ.get("APP_CONF_FILE", '/app/config/app_conf.yml'), 'r', encoding='utf-8') as f:
     app_config = yaml.safe_load(f.read())
 
 # Make sure the logs directory exists
-LOG_DIRECTORY = "/app/logs"
+LOG_DIRECTORY = os.environ.get("LOG_DIRECTORY", "/app/logs")
 if not os.path.exists(LOG_DIRECTORY):
     os.makedirs(LOG_DIRECTORY)
 
 # Logging
-with open('/config/log_conf.yml', 'r', encoding='utf-8') as f:
-    log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+configure_logging(os.environ.get("LOG_CONF_FILE", '/config/log_conf.yml'))
 
 logger = logging.getLogger('analyzerLogger')
+# Per-event lines, sampled by the log config
+event_logger = get_event_logger('analyzerLogger.events')
 
 # Load Kafka config
 KAFKA_HOSTNAME = app_config["events"]["hostname"] 
 KAFKA_PORT = app_config["events"]["port"] 
 KAFKA_TOPIC = app_config["events"]["topic"] 
+transport = get_transport(app_config["events"])
+
+health = Health(logger)
+# Sampling profiles and thread dumps on GET /debug/..., disabled without DEBUG_TOKEN
+profiler = profiler_from_config(app_config)
+
+def connect_kafka():
+    # Requests open their own consumers, ready means the topic is there to read
+    if not transport.has_topic():
+        raise RuntimeError(f"Kafka topic '{KAFKA_TOPIC}' does not exist")
+    return transport
+
+kafka = health.dependency("kafka", connect_kafka)
+
+# Event counts and the latest event per type, published by the one process
+# following the topic and read by every worker
+state = state_from_config(app_config, "/dev/shm/analyzer.state")
+STATE_INTERVAL_MS = (app_config.get("server") or {}).get("state_interval_ms", 200)
+
+# Digests of the events on the topic per digests.bucket_seconds bucket, kept
+# by the updater as it consumes and merged by the workers on GET /digests
+DIGEST_BUCKET_SECONDS = digests_from_config(app_config).bucket_seconds
+digest_state = SharedState(
+    (app_config.get("digests") or {}).get("state_file", "/dev/shm/analyzer.digests"),
+    (app_config.get("digests") or {}).get("state_size", 1 << 22),
+)
+
+# Answers read the whole topic, they stay valid until the state is published again
+queue_cache = cache_from_config("queue", app_config)
+
+# The last history.max_events events per type in rings shared by the workers,
+# None to answer reads by index from the whole topic
+history = history_from_config(app_config)
+SNAPSHOT_INTERVAL_SECONDS = (app_config.get("history") or {}).get("snapshot_interval_seconds", 60)
+
+# Pushes the changes of the state to the dashboards on GET /feed
+feed = feed_from_config(app_config, state)
+
+CONSUMED = counter("kafka_consumed_messages_total", "Messages read by the analyzer tail consumer")
+SCANNED = histogram(
+    "analyzer_scanned_messages", "Queue messages read to answer one request",
+    ("operation",), buckets=SIZE_BUCKETS
+)
+
+
+def scan(consumer, operation):
+    """ Iterates a consumer and records how many messages one request read """
+    count = 0
+    try:
+        for msg in consumer:
+            count += 1
+            yield msg
+    finally:
+        SCANNED.labels(operation).observe(count)
 
 
 def get_trackGPS_reading(index):
-    client = KafkaClient(hosts=f"{KAFKA_HOSTNAME}:{KAFKA_PORT}")
-    topic = client.topics[KAFKA_TOPIC.encode()]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
+    return queue_cache.respond(("trackGPS", index), state.version(), lambda: read_trackGPS(index))
+
+
+def published_count(count_key):
+    """ Events of a type counted by the updater, None until it caught up with the topic """
+    _, published = state.read()
+    return None if published is None else published[count_key]
+
+
+def read_history(event_type, index):
+    """ Message at index of the retained window, counted from its oldest event """
+    message = history.get(event_type, index)
+    if message is None:
+        return {"message": f"No {event_type} message at index {index}"}, 404
+    return message["payload"], 200
+
+
+def read_trackGPS(index):
+    if history is not None:
+        return read_history("TrackGPS", index)
+
+    count = published_count("num_gps_events")
+    if count is not None and index >= count:
+        return {"message": f"No TrackGPS message at index {index}"}, 404
+
+    consumer = transport.topic().scan_consumer(timeout_ms=1000)
 
     counter = 0 
     logger.info("Kafka Consumer started, waiting for TrackGPS messages")
 
-    for msg in consumer:
+    for msg in scan(consumer, "trackGPS"):
         try:
-            message = msg.value.decode("utf-8")
-            data = json.loads(message)
+            data = decode(msg.value)
 
             if data["type"] == "TrackGPS":
                 if counter == index:  
@@ -52,25 +139,33 @@ def get_trackGPS_reading(index):
                     return data["payload"], 200
                 counter += 1 
 
-        except json.JSONDecodeError:
-            logger.error("Failed to decode JSON message.")
+        except DecodeError:
+            logger.error("Failed to decode message.")
 
     logger.warning(f"No TrackGPS message at index %d", index)
     return {"message": f"No TrackGPS message at index {index}"}, 404
 
 
 def get_trackAlerts_reading(index):
-    client = KafkaClient(hosts=f"{KAFKA_HOSTNAME}:{KAFKA_PORT}")
-    topic = client.topics[KAFKA_TOPIC.encode()]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
+    return queue_cache.respond(("trackAlerts", index), state.version(), lambda: read_trackAlerts(index))
+
+
+def read_trackAlerts(index):
+    if history is not None:
+        return read_history("TrackAlerts", index)
+
+    count = published_count("num_alert_events")
+    if count is not None and index >= count:
+        return {"message": f"No TrackAlerts message at index {index}"}, 404
+
+    consumer = transport.topic().scan_consumer(timeout_ms=1000)
 
     counter = 0
     logger.info("Kafka Consumer started, waiting for TrackAlerts messages")
 
-    for msg in consumer:
+    for msg in scan(consumer, "trackAlerts"):
         try:
-            message = msg.value.decode("utf-8")
-            data = json.loads(message)
+            data = decode(msg.value)
 
             if data["type"] == "TrackAlerts":
                 if counter == index:  
@@ -78,33 +173,83 @@ def get_trackAlerts_reading(index):
                     return data["payload"], 200
                 counter += 1 
 
-        except json.JSONDecodeError:
-            logger.error("Failed to decode JSON message.")
+        except DecodeError:
+            logger.error("Failed to decode message.")
 
     logger.warning(f"No TrackAlerts message at index {index}")
     return {"message": f"No TrackAlerts message at index {index}"}, 404
 
+# GET /track/locations/events
+def get_trackGPS_page(position=0, limit=100):
+    return queue_cache.respond(
+        ("trackGPS page", position, limit), state.version(),
+        lambda: read_page("TrackGPS", "num_gps_events", position, limit)
+    )
+
+
+# GET /track/alerts/events
+def get_trackAlerts_page(position=0, limit=100):
+    return queue_cache.respond(
+        ("trackAlerts page", position, limit), state.version(),
+        lambda: read_page("TrackAlerts", "num_alert_events", position, limit)
+    )
+
+
+def read_page(event_type, count_key, position, limit):
+    """ Events of a type from a position that does not move as the history slides """
+    if history is not None:
+        first, next_position, messages = history.page(event_type, position, limit)
+        return {"first": first, "next": next_position, "events": [m["payload"] for m in messages]}, 200
+
+    # Without the history positions count the events of the type from the start of the topic
+    events = []
+    count = published_count(count_key)
+    if count is None or position < count:
+        consumer = transport.topic().scan_consumer(timeout_ms=1000)
+        current = 0
+        for msg in scan(consumer, "page"):
+            try:
+                data = decode(msg.value)
+            except DecodeError:
+                logger.error("Failed to decode message.")
+                continue
+            if data["type"] != event_type:
+                continue
+            if current >= position:
+                events.append(data["payload"])
+                if len(events) == limit:
+                    break
+            current += 1
+    return {"first": 0, "next": position + len(events), "events": events}, 200
+
+
 def get_event_stats():
-    client = KafkaClient(hosts=f"{KAFKA_HOSTNAME}:{KAFKA_PORT}")
-    topic = client.topics[KAFKA_TOPIC.encode()]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
+    return queue_cache.respond("stats", state.version(), read_event_stats)
+
+
+def read_event_stats():
+    _, published = state.read()
+    if published is not None:
+        return {count_key: published[count_key] for count_key, _ in EVENT_KEYS.values()}, 200
+
+    # The updater is still reading the topic
+    consumer = transport.topic().scan_consumer(timeout_ms=1000)
 
     num_gps_events = 0
     num_alert_events = 0
     logger.info("Kafka Consumer started, counting TrackGPS and TrackAlerts messages")
 
-    for msg in consumer:
+    for msg in scan(consumer, "stats"):
         try:
-            message = msg.value.decode("utf-8")
-            data = json.loads(message)
+            data = decode(msg.value)
 
             if data["type"] == "TrackGPS":
                 num_gps_events += 1
             elif data["type"] == "TrackAlerts":
                 num_alert_events += 1
 
-        except json.JSONDecodeError:
-            logger.error("Failed to decode JSON message.")
+        except DecodeError:
+            logger.error("Failed to decode message.")
 
     logger.info(
     "Stats retrieved - GPS Events: %d, Alert Events: %d",
@@ -117,17 +262,18 @@ def get_event_stats():
 
 def get_all_event_ids():
     """Returns all event_id and trace_id pairs from the Kafka queue."""
-    client = KafkaClient(hosts=f"{KAFKA_HOSTNAME}:{KAFKA_PORT}")
-    topic = client.topics[KAFKA_TOPIC.encode()]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
+    return queue_cache.respond("ids", state.version(), read_all_event_ids)
+
+
+def read_all_event_ids():
+    consumer = transport.topic().scan_consumer(timeout_ms=1000)
 
     results = []
     logger.info("Kafka Consumer started, collecting all event_id and trace_id")
 
-    for msg in consumer:
+    for msg in scan(consumer, "ids"):
         try:
-            message = msg.value.decode("utf-8")
-            data = json.loads(message)
+            data = decode(msg.value)
 
             event_type = data.get("type", "Unknown")
             payload = data.get("payload", {})
@@ -137,67 +283,218 @@ def get_all_event_ids():
                 "trace_id": payload.get("trace_id", ""),
                 "type": event_type
             })
-        except json.JSONDecodeError:
-            logger.warning("Skipping invalid JSON message")
+        except DecodeError:
+            logger.warning("Skipping undecodable message")
         except Exception as e:
             logger.error(f"Error processing message: {e}")
 
     logger.info(f"Collected {len(results)} total event IDs from queue")
     return results, 200
 
-def process_messages():
-    while True:  # Keep the consumer running even if it crashes
-        try:
-            hostname = f"{KAFKA_HOSTNAME}:{KAFKA_PORT}"
-            client = KafkaClient(hosts=hostname)
-            topic = client.topics[KAFKA_TOPIC.encode("utf-8")]
+# GET /digests
+def get_digests(bucket_seconds=86400, start_ms=None, end_ms=None):
+    return queue_cache.respond(
+        ("digests", bucket_seconds, start_ms, end_ms), digest_state.version(),
+        lambda: read_digests(bucket_seconds, start_ms, end_ms)
+    )
 
-            consumer = topic.get_simple_consumer(
-                consumer_group=b"event_group",
-                reset_offset_on_start=False,
-                auto_offset_reset=OffsetType.LATEST
-            )
 
-            logger.info("Kafka Consumer started, waiting for messages")
-            
-            for msg in consumer:
-                try:
-                    msg_str = msg.value.decode("utf-8")
-                    message = json.loads(msg_str)
-                    logger.info("Message: %s", message)
+def queued_events(operation, accept=None):
+    """ Decoded messages on the topic whose trace id is in accept, all of them if it is None """
+    consumer = transport.topic().scan_consumer(timeout_ms=1000)
+    for msg in scan(consumer, operation):
+        try:
+            data = decode(msg.value)
+        except DecodeError:
+            logger.error("Failed to decode message.")
+            continue
+        trace_id = data.get("payload", {}).get("trace_id")
+        if trace_id is not None and (accept is None or trace_id in accept):
+            yield data
+
+
+def read_digests(bucket_seconds, start_ms, end_ms):
+    _, published = digest_state.read()
+    if published is None:
+        # The updater is still reading the topic
+        trace_ids = (
+            data["payload"]["trace_id"] for data in queued_events("digests")
+            if in_range(data["payload"]["trace_id"], start_ms, end_ms)
+        )
+        return digests(trace_ids, bucket_seconds), 200
+    kept = BucketDigests.from_json(published)
+    if not kept.aligned(bucket_seconds, start_ms, end_ms):
+        return {"message": f"bucket_seconds, start_ms and end_ms must be multiples of {kept.bucket_seconds} seconds"}, 400
+    return kept.rollup(bucket_seconds, start_ms, end_ms), 200
+
+# GET /events
+def get_events(start_ms, end_ms):
+    if len(start_ms) != len(end_ms):
+        return {"message": "start_ms and end_ms must be given in pairs"}, 400
+    ranges = tuple(zip(start_ms, end_ms))
+    return queue_cache.respond(("events", ranges), state.version(), lambda: read_events(ranges))
+
+
+def read_events(ranges):
+    """ Events received in any of the ranges, in one scan of the topic """
+    events = {"gps": [], "alerts": []}
+    for data in queued_events("events", Ranges(ranges)):
+        if data["type"] == "TrackGPS":
+            events["gps"].append(data["payload"])
+        elif data["type"] == "TrackAlerts":
+            events["alerts"].append(data["payload"])
+    return events, 200
+
+def caught_up(consumer, end_offsets):
+    return all(offset >= end_offsets.get(partition_id, 0) - 1 for partition_id, offset in consumer.held_offsets.items())
+
+
+def warm_start():
+    """ Offsets, published state and digests of the history snapshot, None to read the topic from the start """
+    if history is None:
+        return None
+    snapshot = history.load()
+    if snapshot is None or "digests" not in snapshot[1]:
+        history.reset()
+        return None
+    held_offsets, saved = snapshot
+    return held_offsets, saved["published"], BucketDigests.from_json(saved["digests"])
 
-                except json.JSONDecodeError:
-                    logger.error("JSON Decoding Error")
 
-                consumer.commit_offsets()
+def process_messages():
+    """ Counts the events of the whole topic and keeps following it, in one process of the service """
+    while True:  # Keep the consumer running even if it crashes
+        try:
+            topic = transport.topic()
+            end_offsets = topic.latest_offsets()
+            counts = {count_key: 0 for count_key, _ in EVENT_KEYS.values()}
+            latest = {}
+
+            snapshot = warm_start()
+            if snapshot is None:
+                # Workers scan the topic themselves until the counts are complete again
+                state.publish(None)
+                digest_state.publish(None)
+                kept = BucketDigests(DIGEST_BUCKET_SECONDS)
+                consumer = topic.follow_consumer(STATE_INTERVAL_MS)
+                logger.info("Kafka Consumer started, reading the topic from the start")
+                reading_history = True
+            else:
+                held_offsets, published, kept = snapshot
+                for count_key, latest_key in EVENT_KEYS.values():
+                    counts[count_key] = published[count_key]
+                    if published.get(latest_key) is not None:
+                        latest[latest_key] = published[latest_key]
+                state.publish({**counts, **latest})
+                digest_state.publish(kept.to_json())
+                consumer = topic.follow_consumer(STATE_INTERVAL_MS, held_offsets)
+                logger.info("Kafka Consumer started from the history snapshot, %d events counted", sum(counts.values()))
+                reading_history = False
+
+            changed = False
+            next_publish = 0
+            history_changed = False
+            next_snapshot = time.monotonic() + SNAPSHOT_INTERVAL_SECONDS
+
+            while True:
+                msg = consumer.consume()
+                if msg is not None:
+                    CONSUMED.inc()
+                    try:
+                        message = decode(msg.value)
+                        event_logger.info("Message: %s", message)
+                        keys = EVENT_KEYS.get(message.get("type"))
+                        if keys is not None:
+                            counts[keys[0]] += 1
+                            latest[keys[1]] = message.get("payload")
+                            changed = True
+                            trace_id = message["payload"].get("trace_id")
+                            if trace_id is not None:
+                                kept.add(trace_id)
+                            if history is not None:
+                                ms = trace_id_ms(trace_id) if trace_id is not None else int(time.time() * 1000)
+                                if not history.append(message["type"], ms, message):
+                                    logger.warning("%s message left out of the history", message["type"])
+                                history_changed = True
+                    except DecodeError:
+                        logger.error("Message Decoding Error")
+
+                if reading_history and (msg is None or caught_up(consumer, end_offsets)):
+                    reading_history = False
+                    changed = True
+                    logger.info("Counted the %d events already on the topic", sum(counts.values()))
+
+                # One publish per interval at most, the workers decode each one
+                if changed and not reading_history and time.monotonic() >= next_publish:
+                    state.publish({**counts, **latest})
+                    digest_state.publish(kept.to_json())
+                    changed = False
+                    next_publish = time.monotonic() + STATE_INTERVAL_MS / 1000
+
+                # The counts saved with the rings must be complete, so only once caught up
+                if history_changed and not reading_history and time.monotonic() >= next_snapshot:
+                    history.save(consumer.held_offsets, {"published": {**counts, **latest}, "digests": kept.to_json()})
+                    history_changed = False
+                    next_snapshot = time.monotonic() + SNAPSHOT_INTERVAL_SECONDS
 
         except Exception as err:
             logger.error("Kafka Consumer Error: %s", err)
             time.sleep(5) 
         
+# GET /debug/profile
+def get_profile(seconds=10, hz=100, thread=None):
+    return profiler.profile_response(seconds, hz, thread)
+
+# GET /debug/threads
+def get_threads():
+    return profiler.threads_response()
+
+# GET /metrics
+def get_metrics():
+    return metrics_response()
+
+# GET /feed
+def get_feed():
+    # FeedMiddleware streams this operation, the handler only runs without it
+    return {"message": "The live feed is not enabled"}, 404
+
+# GET /health/live
+def get_liveness():
+    return health.liveness()
+
+# GET /health/ready
+def get_readiness():
+    return health.readiness()
+
 # to consume messages
 def setup_kafka_thread():
-    thread = Thread(target=process_messages)
+    thread = Thread(target=process_messages, name="state-updater")
     thread.daemon = True
     thread.start()
 
 
-app = connexion.FlaskApp(__name__, specification_dir='.')
-app.add_api("openapi.yml", base_path="/analyzer", strict_validation=True, validate_responses=True)
+def create_app():
+    """ Builds the app, Kafka is checked when the server starts it """
+    app = connexion.FlaskApp(__name__, specification_dir='.', lifespan=health.lifespan)
+    app.add_api("openapi.yml", base_path="/analyzer", strict_validation=True, validate_responses=True)
+    app.add_middleware(MetricsMiddleware, position=MiddlewarePosition.BEFORE_SECURITY)
+    app.add_middleware(FeedMiddleware, position=MiddlewarePosition.BEFORE_SECURITY, feed=feed, operation_id="app.get_feed")
 
+    if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
+        app.add_middleware(
+            CORSMiddleware,
+            position=MiddlewarePosition.BEFORE_EXCEPTION,
+            allow_origins=["*"],
+            allow_credentials=True,
+            allow_methods=["*"],
+            allow_headers=["*"],
+        )
+    return app
 
-if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
-    app.add_middleware(
-        CORSMiddleware,
-        position=MiddlewarePosition.BEFORE_EXCEPTION,
-        allow_origins=["*"],
-        allow_credentials=True,
-        allow_methods=["*"],
-        allow_headers=["*"],
-    )
+app = create_app()
 
 if __name__ == "__main__":
     logger.info("Starting Analyzer Service")
     setup_kafka_thread()
-    app.run(port=8110, host="0.0.0.0")
+    serve(app, 8110, app_config)
     
\ No newline at end of file
@@ -0,0 +1,209 @@
+"""
+Live feed for the dashboard on GET /analyzer/feed, as server-sent events.
+
+The analyzer's updater publishes its event counts and the latest event of
+each type to a SharedState. One publisher task per worker wakes every
+interval_ms, reads it and, if anything changed, merges a single update into
+every connected client:
+
+    event: update
+    data: {"stats_delta": {"num_gps_events": 3, "num_alert_events": 0},
+           "latest_gps": {...}, "latest_alert": {...}, "processing_stats": {...}}
+
+stats_delta counts the events since the client's previous update, clients
+add it to GET /analyzer/stats read when they connect. Changes while no
+client is connected are dropped, a new client starts from /stats. processing_stats is
+polled from processing by the publisher, with If-None-Match, and only sent
+when it changed. A client that falls behind has its pending updates merged
+instead of queued, so the cost per viewer stays one small dict whatever the
+event rate, and the work behind the updates is done once for all of them.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+
+import httpx
+
+logger = logging.getLogger('analyzerLogger')
+
+EVENT_KEYS = {
+    "TrackGPS": ("num_gps_events", "latest_gps"),
+    "TrackAlerts": ("num_alert_events", "latest_alert"),
+}
+
+
+class _Client:
+    def __init__(self, initial):
+        self.pending = initial
+        self.ready = asyncio.Event()
+        self.ready.set()
+
+    def merge(self, update):
+        if self.pending is None:
+            self.pending = {**update, "stats_delta": dict(update["stats_delta"])}
+        else:
+            delta = self.pending["stats_delta"]
+            for key, count in update["stats_delta"].items():
+                delta[key] = delta.get(key, 0) + count
+            self.pending.update((key, value) for key, value in update.items() if key != "stats_delta")
+        self.ready.set()
+
+    def take(self):
+        update, self.pending = self.pending, None
+        self.ready.clear()
+        return update
+
+
+class LiveFeed:
+    def __init__(self, state, interval_ms=1000, keepalive_seconds=15, processing_url=None, processing_interval_seconds=5):
+        self.state = state
+        self.interval = interval_ms / 1000
+        self.keepalive = keepalive_seconds
+        self.processing_url = processing_url
+        self.processing_interval = processing_interval_seconds
+        self.clients = set()
+        self._lock = threading.Lock()
+        self._counts = {key: 0 for key, _ in EVENT_KEYS.values()}
+        self._latest = {}
+        self._changed = False
+        self._version = None
+        self._totals = None
+        self._processing_etag = None
+        self._publisher = None
+        self.http_transport = None  # swapped for benchmarks/inprocess.py
+
+    def _follow(self):
+        """ Records what changed in the shared state since the last call """
+        version, published = self.state.read()
+        if version == self._version or published is None:
+            return
+        self._version = version
+        totals = {count_key: published[count_key] for count_key, _ in EVENT_KEYS.values()}
+        with self._lock:
+            if self._totals is not None:
+                for count_key, total in totals.items():
+                    self._counts[count_key] += total - self._totals[count_key]
+            self._totals = totals
+            for _, latest_key in EVENT_KEYS.values():
+                if published.get(latest_key) is not None:
+                    self._latest[latest_key] = published[latest_key]
+            self._changed = True
+
+    def _take(self):
+        """ Update since the last call, None if nothing changed """
+        with self._lock:
+            if not self._changed:
+                return None
+            update = {"stats_delta": self._counts, **self._latest}
+            self._counts = {key: 0 for key in self._counts}
+            self._changed = False
+            return update
+
+    def _snapshot(self):
+        with self._lock:
+            return {"stats_delta": {key: 0 for key in self._counts}, **self._latest}
+
+    async def _poll_processing(self, client):
+        headers = {"If-None-Match": self._processing_etag} if self._processing_etag else {}
+        try:
+            response = await client.get(f"{self.processing_url}/stats", headers=headers)
+        except httpx.HTTPError as e:
+            logger.warning("Live feed could not poll processing stats: %s", e)
+            return
+        if response.status_code == 200:
+            self._processing_etag = response.headers.get("ETag")
+            with self._lock:
+                self._latest["processing_stats"] = response.json()
+                self._changed = True
+
+    async def _publish(self):
+        next_processing_poll = 0
+        async with httpx.AsyncClient(timeout=5, transport=self.http_transport) as client:
+            while True:
+                await asyncio.sleep(self.interval)
+                self._follow()
+                if not self.clients:
+                    self._take()
+                    continue
+                if self.processing_url and time.monotonic() >= next_processing_poll:
+                    await self._poll_processing(client)
+                    next_processing_poll = time.monotonic() + self.processing_interval
+                update = self._take()
+                if update is not None:
+                    for client_ in list(self.clients):
+                        client_.merge(update)
+
+    def _ensure_publisher(self):
+        if self._publisher is None or self._publisher.done():
+            self._publisher = asyncio.get_running_loop().create_task(self._publish())
+
+    async def stream(self, receive, send):
+        """ Serves one client until it disconnects """
+        self._ensure_publisher()
+        client = _Client(self._snapshot())
+        self.clients.add(client)
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),  # nginx would hold the stream in its buffer otherwise
+            ],
+        })
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        try:
+            while not disconnected.done():
+                ready = asyncio.ensure_future(client.ready.wait())
+                await asyncio.wait({ready, disconnected}, timeout=self.keepalive, return_when=asyncio.FIRST_COMPLETED)
+                ready.cancel()
+                if disconnected.done():
+                    break
+                if client.pending is None:
+                    body = b": keepalive\n\n"
+                else:
+                    body = f"event: update\ndata: {json.dumps(client.take())}\n\n".encode("utf-8")
+                await send({"type": "http.response.body", "body": body, "more_body": True})
+        finally:
+            self.clients.discard(client)
+            disconnected.cancel()
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+class FeedMiddleware:
+    """
+    ASGI middleware answering the operation `operation_id` with feed.stream(),
+    so every client is a coroutine instead of a Flask worker thread. Add it
+    with MiddlewarePosition.BEFORE_SECURITY, after connexion routing.
+    """
+
+    def __init__(self, app, feed, operation_id):
+        self.app = app
+        self.feed = feed
+        self.operation_id = operation_id
+
+    async def __call__(self, scope, receive, send):
+        routing = scope.get("extensions", {}).get("connexion_routing", {})
+        if scope["type"] == "http" and routing.get("operation_id") == self.operation_id:
+            await self.feed.stream(receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
+def feed_from_config(app_config, state):
+    feed = app_config.get("feed") or {}
+    return LiveFeed(
+        state,
+        feed.get("interval_ms", 1000),
+        feed.get("keepalive_seconds", 15),
+        feed.get("processing_url"),
+        feed.get("processing_interval_seconds", 5),
+    )
@@ -0,0 +1,278 @@
+"""
+Bounded history of the events on the topic, so reads by index cost the same
+whatever the topic's retention.
+
+    history = history_from_config(app_config)   None unless history.bounded
+    history.append(event_type, ms, message)     the updater, in topic order
+    history.get(event_type, index)              message at index of the retained window, or None
+    history.page(event_type, position, limit)   (first, next, messages) from a stable position on
+    history.save(held_offsets, state)           snapshot of the rings, where the updater is and its state
+    history.load()                              (held_offsets, state) of the snapshot, or None
+
+Each event type has a ring of max_events fixed size slots in an mmap'd file
+(under /dev/shm in the containers), preallocated when the service starts.
+A slot holds the message in the binary codec, usually well under 100 bytes,
+and the time of the event from its trace id. Messages larger than
+slot_bytes, or that the binary codec cannot encode, are left out of the
+history. With max_age_hours the window is
+also cut to the events of the last max_age_hours.
+
+Index 0 is the oldest retained event of the type and the window slides as
+events arrive: the same index names a newer event once older ones fall out.
+Positions count the events of the type appended since the rings were
+reset, so they name the same event as long as it is retained: page() is
+how a client reads the whole window without duplicates or gaps, and it
+tells the client where the window starts now if it fell behind.
+Only the updater writes a ring. It fills a slot and then counts it, and a
+worker that reads a slot checks the count again, so a slot overwritten
+during the copy is read as missing, never as a mix of two events. One slot
+more than max_events is kept for the one being written.
+
+The snapshot file holds the rings, the updater's state (its counts and
+digests) and the offsets it consumed up to. It is written to a temporary
+file and renamed, a restart loads it and follows the topic from the saved
+offsets instead of reading it from the start.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from shared.codec import DecodeError, EncodeError, decode, get_codec
+
+logger = logging.getLogger('analyzerLogger')
+
+HEADER = struct.Struct("<QII")  # events appended, slots, slot_bytes
+SLOT = struct.Struct("<QI")  # event time (unix ms), message length
+META_LENGTH = struct.Struct("<Q")
+EVENT_TYPES = ("TrackGPS", "TrackAlerts")
+
+_codec = get_codec("binary")
+
+
+class Ring:
+    """ max_events latest messages of one type, in a file every worker maps """
+
+    def __init__(self, path, max_events, slot_bytes=256):
+        self.path = path
+        self.slots = max_events + 1
+        self.slot_bytes = slot_bytes
+        self.size = HEADER.size + self.slots * (SLOT.size + slot_bytes)
+        self._map = None
+        self._lock = threading.Lock()
+
+    def _mapped(self):
+        if self._map is None:
+            with self._lock:
+                if self._map is None:
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                    try:
+                        if os.fstat(fd).st_size < self.size:
+                            os.ftruncate(fd, self.size)
+                        self._map = mmap.mmap(fd, self.size)
+                    finally:
+                        os.close(fd)
+        return self._map
+
+    def _offset(self, position):
+        return HEADER.size + (position % self.slots) * (SLOT.size + self.slot_bytes)
+
+    def total(self):
+        """ Messages appended since the ring was reset, 0 if it was laid out for other dimensions """
+        total, slots, slot_bytes = HEADER.unpack_from(self._mapped(), 0)
+        return total if (slots, slot_bytes) == (self.slots, self.slot_bytes) else 0
+
+    def reset(self):
+        HEADER.pack_into(self._mapped(), 0, 0, self.slots, self.slot_bytes)
+
+    def append(self, ms, value):
+        """ Stores value, False if it does not fit in a slot """
+        if len(value) > self.slot_bytes:
+            return False
+        ring = self._mapped()
+        total = self.total()
+        offset = self._offset(total)
+        SLOT.pack_into(ring, offset, ms, len(value))
+        ring[offset + SLOT.size:offset + SLOT.size + len(value)] = value
+        HEADER.pack_into(ring, 0, total + 1, self.slots, self.slot_bytes)
+        return True
+
+    def _time(self, position):
+        return SLOT.unpack_from(self._mapped(), self._offset(position))[0]
+
+    def window(self, since_ms=None):
+        """ Positions [first, total) retained, from since_ms on if given """
+        total = self.total()
+        first = max(total - (self.slots - 1), 0)
+        if since_ms is not None:
+            low, high = first, total
+            while low < high:  # event times are stored in ascending order
+                middle = (low + high) // 2
+                if self._time(middle) < since_ms:
+                    low = middle + 1
+                else:
+                    high = middle
+            first = low
+        return first, total
+
+    def get(self, index, since_ms=None):
+        """ Bytes of the message at index of the window, None if there is none """
+        first, total = self.window(since_ms)
+        position = first + index
+        if index < 0 or position >= total:
+            return None
+        ring = self._mapped()
+        offset = self._offset(position)
+        length = SLOT.unpack_from(ring, offset)[1]
+        value = ring[offset + SLOT.size:offset + SLOT.size + min(length, self.slot_bytes)]
+        if self.total() >= position + self.slots:
+            return None  # overwritten while it was copied
+        return value
+
+    def read(self, position, limit, since_ms=None):
+        """ (first, start, values): up to limit messages from start, the first retained position from position on """
+        first, total = self.window(since_ms)
+        if position > total:
+            position = first  # the ring was reset since the position was handed out
+        start = max(position, first)
+        ring = self._mapped()
+        values = []
+        for current in range(start, min(start + limit, total)):
+            offset = self._offset(current)
+            length = SLOT.unpack_from(ring, offset)[1]
+            values.append(ring[offset + SLOT.size:offset + SLOT.size + min(length, self.slot_bytes)])
+        # The oldest slots may have been overwritten during the copy, the window moved past them
+        retained = self.total() - self.slots + 1
+        if retained > start:
+            values = values[retained - start:]
+            first = max(first, retained)
+            start = retained
+        return first, start, values
+
+    def dump(self):
+        return self._mapped()[:self.size]
+
+    def restore(self, data):
+        ring = self._mapped()
+        HEADER.pack_into(ring, 0, 0, self.slots, self.slot_bytes)
+        ring[HEADER.size:self.size] = data[HEADER.size:]
+        ring[:HEADER.size] = data[:HEADER.size]
+
+
+class History:
+    def __init__(self, directory, max_events, slot_bytes=256, max_age_hours=0, snapshot_file=None):
+        self.rings = {
+            event_type: Ring(os.path.join(directory, f"analyzer.{event_type}.ring"), max_events, slot_bytes)
+            for event_type in EVENT_TYPES
+        }
+        self.max_age_ms = max_age_hours * 3600 * 1000 if max_age_hours else None
+        self.snapshot_file = snapshot_file
+        self._latest_ms = {}
+
+    def reset(self):
+        for ring in self.rings.values():
+            ring.reset()
+        self._latest_ms = {}
+
+    def append(self, event_type, ms, message):
+        """ Keeps message, False if it is not of a kept type, too large or not encodable """
+        ring = self.rings.get(event_type)
+        if ring is None:
+            return False
+        try:
+            value = _codec.encode(message)
+        except (EncodeError, KeyError, TypeError, AttributeError, struct.error) as err:
+            # Any JSON codec message reaches here, skip it rather than stop the updater on it
+            logger.warning("%s message cannot be kept in the history: %s", event_type, err)
+            return False
+        # Partitions interleave, the window search needs times in ascending order
+        ms = max(ms, self._latest_ms.get(event_type, 0))
+        self._latest_ms[event_type] = ms
+        return ring.append(ms, value)
+
+    def get(self, event_type, index):
+        since_ms = None
+        if self.max_age_ms is not None:
+            since_ms = int(time.time() * 1000) - self.max_age_ms
+        value = self.rings[event_type].get(index, since_ms)
+        if value is None:
+            return None
+        try:
+            return decode(value)
+        except DecodeError:
+            logger.error("Undecodable %s message in the history at index %d", event_type, index)
+            return None
+
+    def page(self, event_type, position, limit):
+        """ (first, next, messages): first is the oldest retained position, pass next to continue """
+        since_ms = None
+        if self.max_age_ms is not None:
+            since_ms = int(time.time() * 1000) - self.max_age_ms
+        first, start, values = self.rings[event_type].read(position, limit, since_ms)
+        messages = []
+        for value in values:
+            try:
+                messages.append(decode(value))
+            except DecodeError:
+                logger.error("Undecodable %s message in the history", event_type)
+        return first, start + len(values), messages
+
+    def _dimensions(self):
+        return {event_type: [ring.slots, ring.slot_bytes] for event_type, ring in self.rings.items()}
+
+    def save(self, held_offsets, state):
+        if not self.snapshot_file:
+            return
+        meta = json.dumps({
+            "offsets": held_offsets,
+            "state": state,
+            "latest_ms": self._latest_ms,
+            "rings": self._dimensions(),
+        }).encode("utf-8")
+        tmp_file = f"{self.snapshot_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(META_LENGTH.pack(len(meta)))
+            f.write(meta)
+            for event_type in EVENT_TYPES:
+                f.write(self.rings[event_type].dump())
+        os.replace(tmp_file, self.snapshot_file)
+
+    def load(self):
+        """ Restores the rings of the snapshot, (held_offsets, state) or None if there is none to use """
+        if not self.snapshot_file or not os.path.exists(self.snapshot_file):
+            return None
+        try:
+            with open(self.snapshot_file, "rb") as f:
+                meta = json.loads(f.read(META_LENGTH.unpack(f.read(META_LENGTH.size))[0]))
+                if meta["rings"] != self._dimensions():
+                    logger.info("History snapshot %s was taken with other ring sizes", self.snapshot_file)
+                    return None
+                for event_type in EVENT_TYPES:
+                    ring = self.rings[event_type]
+                    data = f.read(ring.size)
+                    if len(data) != ring.size:
+                        raise ValueError("truncated ring")
+                    ring.restore(data)
+        except (OSError, ValueError, KeyError, struct.error) as err:
+            logger.error("Could not load the history snapshot %s: %s", self.snapshot_file, err)
+            self.reset()
+            return None
+        self._latest_ms = meta["latest_ms"]
+        offsets = {int(partition_id): offset for partition_id, offset in meta["offsets"].items()}
+        return offsets, meta["state"]
+
+
+def history_from_config(app_config):
+    history = app_config.get("history") or {}
+    if not history.get("bounded"):
+        return None
+    return History(
+        history.get("directory", "/dev/shm"),
+        history.get("max_events", 20000),
+        history.get("slot_bytes", 256),
+        history.get("max_age_hours", 0),
+        history.get("snapshot_file"),
+    )
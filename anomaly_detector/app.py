@@ -2,36 +2,50 @@ import connexion
 import os
 import yaml
 import json
-import logging.config
+import logging
 from datetime import datetime, timezone
 import httpx
 from starlette.middleware.cors import CORSMiddleware
 from connexion.middleware import MiddlewarePosition
 
+from shared.cache import cache_from_config, file_version
+from shared.health import Health
+from shared.log import configure_logging
+from shared.metrics import MetricsMiddleware, histogram, metrics_response
+from shared.profile import profiler_from_config
+
 # Load app config
-with open("/app/config/app_conf.yml", "r") as f:
+with open(os.environ.get("APP_CONF_FILE", "/app/config/app_conf.yml"), "r") as f:
     app_config = yaml.safe_load(f.read())
 
 # Setup logging
-LOG_DIRECTORY = "/app/logs"
+LOG_DIRECTORY = os.environ.get("LOG_DIRECTORY", "/app/logs")
 if not os.path.exists(LOG_DIRECTORY):
     os.makedirs(LOG_DIRECTORY)
 
-with open('/config/log_conf.yml', 'r') as f:
-    log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+configure_logging(os.environ.get("LOG_CONF_FILE", '/config/log_conf.yml'))
 
 logger = logging.getLogger('anomalyLogger')
+# No connections to wait for, ready as soon as it serves requests
+health = Health(logger)
+# Sampling profiles and thread dumps on GET /debug/..., disabled without DEBUG_TOKEN
+profiler = profiler_from_config(app_config)
 
 ANOMALY_FILE = app_config["datastore"]
 ANALYZER_URL = app_config["analyzer"]["url"]
 STORAGE_URL = app_config["storage"]["url"]
 PROCESSING_URL = app_config["processing"]["url"]
+# Events per request when reading the analyzer's history
+PAGE_EVENTS = app_config["analyzer"].get("page_events", 500)
 
 KAFKA_HOSTNAME = app_config["events"]["hostname"]
 KAFKA_PORT = app_config["events"]["port"]
 KAFKA_TOPIC = app_config["events"]["topic"]
 
+anomalies_cache = cache_from_config("anomalies", app_config)
+
+UPDATE_LATENCY = histogram("anomaly_update_duration_seconds", "Duration of one anomaly update run")
+
 logger.info(f"Kafka config - Host: {KAFKA_HOSTNAME}, Port: {KAFKA_PORT}, Topic: {KAFKA_TOPIC}")
 
 # Load previous results
@@ -61,21 +75,30 @@ def save_results(data):
 def event_key(event):
     return str(event.get("trace_id"))
 
-# Fetch analyzer queue data
+# Fetch analyzer queue data, by positions that do not move as the analyzer's history slides
 async def fetch_all_analyzer_events(analyzer_url, event_type):
     results = []
-    index = 0
-    while True:
-        async with httpx.AsyncClient() as client:
+    position = 0
+    async with httpx.AsyncClient() as client:
+        while True:
             try:
-                response = await client.get(f"{analyzer_url}/track/{event_type}?index={index}")
+                response = await client.get(
+                    f"{analyzer_url}/track/{event_type}/events",
+                    params={"position": position, "limit": PAGE_EVENTS},
+                )
                 if response.status_code != 200:
+                    logger.error(f"Analyzer answered {response.status_code} for {event_type} at position {position}")
                     break
-                results.append(response.json())
-                index += 1
+                page = response.json()
             except Exception as e:
-                logger.error(f"Error fetching {event_type} from analyzer at index {index}: {str(e)}")
+                logger.error(f"Error fetching {event_type} from analyzer at position {position}: {str(e)}")
                 break
+            if position and page["first"] > position:
+                logger.warning(f"{page['first'] - position} {event_type} events left the analyzer's history before they were read")
+            if not page["events"]:
+                break
+            results.extend(page["events"])
+            position = page["next"]
     return results
 
 def clean_timestamp(ts):
@@ -118,6 +141,7 @@ async def update_anomalies():
         }
 
         save_results(result)
+        UPDATE_LATENCY.observe(processing_time / 1000)
         logger.debug(
             f"anomaly is detected and added to the JSON file | the value detected={processing_time} | threshold exceeded={processing_time}"
         )
@@ -135,25 +159,53 @@ async def update_anomalies():
 # GET /anomalies
 async def get_anomalies():
     logger.info("Fetching anomaly_detector results")
+    return anomalies_cache.respond("anomalies", file_version(ANOMALY_FILE), read_anomalies)
 
+def read_anomalies():
     if not os.path.exists(ANOMALY_FILE):
         return {"message": "No anomalies have been run yet"}, 404
 
     with open(ANOMALY_FILE, 'r') as f:
         return json.load(f), 200
 
-app = connexion.FlaskApp(__name__, specification_dir=".")
-app.add_api("anomaly.yml", base_path="/anomaly_detector", strict_validation=True, validate_responses=True)
-
-if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
-    app.add_middleware(
-        CORSMiddleware,
-        position=MiddlewarePosition.BEFORE_EXCEPTION,
-        allow_origins=["*"],
-        allow_credentials=True,
-        allow_methods=["*"],
-        allow_headers=["*"],
-    )
+# GET /debug/profile
+def get_profile(seconds=10, hz=100, thread=None):
+    return profiler.profile_response(seconds, hz, thread)
+
+# GET /debug/threads
+def get_threads():
+    return profiler.threads_response()
+
+# GET /metrics
+def get_metrics():
+    return metrics_response()
+
+# GET /health/live
+def get_liveness():
+    return health.liveness()
+
+# GET /health/ready
+def get_readiness():
+    return health.readiness()
+
+def create_app():
+    """ Builds the app """
+    app = connexion.FlaskApp(__name__, specification_dir=".", lifespan=health.lifespan)
+    app.add_api("anomaly.yaml", base_path="/anomaly_detector", strict_validation=True, validate_responses=True)
+    app.add_middleware(MetricsMiddleware, position=MiddlewarePosition.BEFORE_SECURITY)
+
+    if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
+        app.add_middleware(
+            CORSMiddleware,
+            position=MiddlewarePosition.BEFORE_EXCEPTION,
+            allow_origins=["*"],
+            allow_credentials=True,
+            allow_methods=["*"],
+            allow_headers=["*"],
+        )
+    return app
+
+app = create_app()
 
 if __name__ == "__main__":
     logger.info("anomaly_detector Service started to find anomaly threshold is more than 1000")
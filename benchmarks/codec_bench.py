@@ -0,0 +1,73 @@
+"""
+Encode/decode throughput of the event codecs.
+
+Run from the repository root:
+
+    python -m benchmarks.codec_bench [--iterations 100000]
+"""
+import argparse
+import time
+
+from shared.codec import CODECS, decode, get_codec
+
+GPS_MSG = {
+    "type": "TrackGPS",
+    "datetime": "2025-02-11T15:30:00",
+    "payload": {
+        "device_id": "d290f1ee-6c54-4b01-90e6-d701748f0851",
+        "latitude": 49.282729,
+        "longitude": -123.120738,
+        "location_name": "Downtown Vancouver",
+        "timestamp": "2025-02-11T15:30:00.123000Z",
+        "trace_id": 237969814885240832,
+    },
+    "trace": {"received": 1739287800123456789, "produced": 1739287800123956789},
+}
+
+ALERTS_MSG = {
+    "type": "TrackAlerts",
+    "datetime": "2025-02-11T15:30:00",
+    "payload": {
+        "device_id": "d290f1ee-6c54-4b01-90e6-d701748f0851",
+        "latitude": 49.282729,
+        "longitude": -123.120738,
+        "location_name": "Ridgeview Elementary School",
+        "alert_desc": "Child has entered a restricted area.",
+        "timestamp": "2025-02-11T15:30:00.123000Z",
+        "trace_id": 237969814885240832,
+    },
+    "trace": {"received": 1739287800123456789, "produced": 1739287800123956789},
+}
+
+
+def measure(func, arg, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    elapsed = time.perf_counter() - start
+    return iterations / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'codec':<8} {'event':<12} {'bytes':>6} {'encode/s':>12} {'decode/s':>12} {'auto decode/s':>14}")
+    for name in CODECS:
+        codec = get_codec(name)
+        for msg in (GPS_MSG, ALERTS_MSG):
+            data = codec.encode(msg)
+            assert decode(data) == codec.decode(data)
+
+            encode_rate = measure(codec.encode, msg, args.iterations)
+            decode_rate = measure(codec.decode, data, args.iterations)
+            auto_rate = measure(decode, data, args.iterations)
+            print(
+                f"{codec.name:<8} {msg['type']:<12} {len(data):>6} "
+                f"{encode_rate:>12,.0f} {decode_rate:>12,.0f} {auto_rate:>14,.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
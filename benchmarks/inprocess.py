@@ -0,0 +1,143 @@
+"""
+The pipeline wired together in one process, without Kafka or MySQL.
+
+InProcessPipeline loads receiver, storage, analyzer, processing and
+consistency_check from their app.py with the events topic in memory
+(events.backend: memory) and storage on SQLite. Requests go to the services'
+ASGI apps directly through `transport`, an httpx transport routing on the
+first path segment the way nginx does, so a client or the services calling
+each other never open a socket:
+
+    pipeline = InProcessPipeline()
+    pipeline.start()
+    async with httpx.AsyncClient(transport=pipeline.transport, base_url="http://inprocess") as client:
+        await client.post("/receiver/track/locations", json=...)
+
+The modules stay reachable as pipeline.services["storage"] etc. for
+microbenchmarks and profiling of single functions.
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+
+import httpx
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ("receiver", "storage", "analyzer", "processing", "consistency_check")
+BASE_URL = "http://inprocess"
+
+LOG_CONFIG = {
+    "version": 1,
+    "formatters": {"simple": {"format": "%(asctime)s - %(name)s - %(levelname)s - %(message)s"}},
+    "handlers": {"console": {"class": "logging.StreamHandler", "level": "WARNING", "formatter": "simple"}},
+    "root": {"level": "WARNING", "handlers": ["console"]},
+    "disable_existing_loggers": False,
+}
+
+
+class RoutingTransport(httpx.AsyncBaseTransport):
+    """ Sends /<service>/... to that service's app """
+
+    def __init__(self, apps):
+        self.transports = {name: httpx.ASGITransport(app=app) for name, app in apps.items()}
+
+    async def handle_async_request(self, request):
+        service = request.url.path.lstrip("/").split("/", 1)[0]
+        if service not in self.transports:
+            return httpx.Response(404, request=request)
+        return await self.transports[service].handle_async_request(request)
+
+
+class InProcessPipeline:
+    def __init__(self, workdir=None, storage_workers=1, partitions=6, database_url=None):
+        self.workdir = workdir or tempfile.mkdtemp(prefix="simpletracker-")
+        self.database_url = database_url or f"sqlite:///{os.path.join(self.workdir, 'storage.db')}"
+        self.storage_workers = storage_workers
+        self.partitions = partitions
+
+        log_conf = self._write("log_conf.yml", LOG_CONFIG)
+        os.environ["LOG_CONF_FILE"] = log_conf
+        os.environ["LOG_DIRECTORY"] = os.path.join(self.workdir, "logs")
+
+        self.services = {}
+        for name in SERVICES:
+            self.services[name] = self._load(name, self._write(f"{name}.yml", self._config(name)))
+
+        self.transport = RoutingTransport({name: module.app for name, module in self.services.items()})
+        self.services["processing"].http_transport = self.transport
+        self.services["consistency_check"].http_transport = self.transport
+        self.services["analyzer"].feed.http_transport = self.transport
+
+    def _config(self, name):
+        with open(os.path.join(ROOT, "config", name, "app_conf.yml"), "r", encoding="utf-8") as f:
+            config = yaml.safe_load(f.read())
+
+        if "events" in config:
+            config["events"].update(backend="memory", partitions=self.partitions)
+        if name == "receiver":
+            # The load generator sends faster per device than a tracker may, no device limit
+            config["admission"]["device_rate"] = 0
+        elif name == "storage":
+            config["datastore"] = {"url": self.database_url}
+            config["events"]["workers"] = self.storage_workers
+        elif name == "processing":
+            config["datastore"]["directory"] = self.workdir
+            config["server"]["state_file"] = os.path.join(self.workdir, "processing.state")
+            for store in config["eventstores"].values():
+                store["url"] = store["url"].replace("http://storage:8090", BASE_URL)
+        elif name == "analyzer":
+            config["feed"]["processing_url"] = f"{BASE_URL}/processing"
+            config["server"]["state_file"] = os.path.join(self.workdir, "analyzer.state")
+            config["digests"]["state_file"] = os.path.join(self.workdir, "analyzer.digests")
+            config["history"].update(
+                directory=self.workdir, snapshot_file=os.path.join(self.workdir, "history.snapshot")
+            )
+        elif name == "consistency_check":
+            config["datastore"] = os.path.join(self.workdir, "checks.json")
+            for service in ("analyzer", "storage", "processing"):
+                config[service]["url"] = f"{BASE_URL}/{service}"
+        return config
+
+    def _write(self, filename, data):
+        path = os.path.join(self.workdir, filename)
+        with open(path, "w", encoding="utf-8") as f:
+            yaml.safe_dump(data, f)
+        return path
+
+    def _load(self, name, config_path):
+        """ Imports <name>/app.py as <name>_app with its config """
+        directory = os.path.join(ROOT, name)
+        os.environ["APP_CONF_FILE"] = config_path
+        if directory not in sys.path:
+            sys.path.append(directory)  # storage imports its models module
+
+        spec = importlib.util.spec_from_file_location(f"{name}_app", os.path.join(directory, "app.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module
+        # connexion resolves operation ids such as app.get_metrics in add_api and
+        # again when it builds its middleware stack, normally on the first request
+        previous = sys.modules.get("app")
+        sys.modules["app"] = module
+        try:
+            spec.loader.exec_module(module)
+            middleware = module.app.middleware
+            middleware.app, middleware.middleware_stack = middleware._build_middleware_stack()
+        finally:
+            if previous is None:
+                sys.modules.pop("app", None)
+            else:
+                sys.modules["app"] = previous
+        return module
+
+    def start(self, timeout=10):
+        """ Connects the services, as their server's lifespan would, and starts the consumer threads """
+        for module in self.services.values():
+            module.health.start()
+        for module in self.services.values():
+            for dependency in module.health.dependencies.values():
+                if dependency.wait(timeout) is None:
+                    raise RuntimeError(f"{module.__name__} could not connect {dependency.name}: {dependency.error}")
+        self.services["storage"].setup_kafka_thread()
+        self.services["analyzer"].setup_kafka_thread()
@@ -0,0 +1,190 @@
+"""
+Realistic TrackGPS / TrackAlerts traffic for the receiver.
+
+Every simulated device walks between the named places of
+storage/csv/locations.csv, reporting a fix every few seconds of simulated
+time, and now and then raises an alert from storage/csv/alerts.csv.
+
+    python -m benchmarks.loadgen --url http://localhost/receiver --rate 200 --devices 50 --duration 30
+
+The receiver rate limits every device to a few events per second
+(receiver/admission.py), well below what a handful of simulated devices
+send here. Start the stack with ADMISSION_BYPASS_TOKEN set and pass the same
+value with --admission-token (it defaults to that environment variable), or
+most events are answered 429.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+BYPASS_HEADER = "X-Admission-Bypass"  # receiver/admission.py
+CSV_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "storage", "csv")
+
+# Around Vancouver, where the names in locations.csv are
+CENTER = (49.2827, -123.1207)
+SPREAD_DEGREES = 0.15
+STEP_DEGREES = 0.0005
+
+
+def read_lines(filename):
+    with open(os.path.join(CSV_DIR, filename), "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class Device:
+    def __init__(self, rng, places):
+        self.rng = rng
+        self.device_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        self.places = places
+        self.position = self._random_point()
+        self._new_target()
+
+    def _random_point(self):
+        return (
+            CENTER[0] + self.rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES),
+            CENTER[1] + self.rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES),
+        )
+
+    def _new_target(self):
+        self.target = self._random_point()
+        self.target_name = self.rng.choice(self.places)
+
+    def step(self):
+        """ Moves towards the current target and returns the new position """
+        lat, lon = self.position
+        d_lat, d_lon = self.target[0] - lat, self.target[1] - lon
+        distance = math.hypot(d_lat, d_lon)
+        if distance <= STEP_DEGREES:
+            self.position = self.target
+            self._new_target()
+        else:
+            jitter = self.rng.gauss(0, STEP_DEGREES / 10)
+            self.position = (
+                lat + d_lat / distance * STEP_DEGREES + jitter,
+                lon + d_lon / distance * STEP_DEGREES + jitter,
+            )
+        return self.position
+
+
+class TrafficGenerator:
+    """ Yields (path, body) pairs for the receiver, round robin over the devices """
+
+    def __init__(self, devices=50, alert_ratio=0.05, seed=42, start=None):
+        self.rng = random.Random(seed)
+        places = read_lines("locations.csv")
+        self.alerts = read_lines("alerts.csv")
+        self.devices = [Device(self.rng, places) for _ in range(devices)]
+        self.alert_ratio = alert_ratio
+        self.clock = start or datetime.now(timezone.utc)
+
+    def __iter__(self):
+        while True:
+            for device in self.devices:
+                yield self.next_event(device)
+            self.clock += timedelta(seconds=5)
+
+    def next_event(self, device):
+        lat, lon = device.step()
+        body = {
+            "device_id": device.device_id,
+            "latitude": round(lat, 6),
+            "longitude": round(lon, 6),
+            "location_name": device.target_name,
+            "timestamp": self.clock.isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+        }
+        if self.rng.random() < self.alert_ratio:
+            body["alert_desc"] = self.rng.choice(self.alerts)
+            return "/track/alerts", body
+        return "/track/locations", body
+
+
+async def send(url, events, rate, count=None, duration=None, concurrency=64, transport=None, admission_token=None):
+    """
+    Posts events at `rate` per second (0 = as fast as possible) until count
+    events were sent or duration seconds passed. Returns per-request
+    latencies and status counts. transport replaces the network, see
+    benchmarks.inprocess. admission_token skips the receiver's rate limits.
+    """
+    latencies = []
+    statuses = {}
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker(client):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            path, body = item
+            start = time.perf_counter()
+            try:
+                status = (await client.post(url + path, json=body)).status_code
+            except httpx.HTTPError:
+                status = "error"
+            latencies.append(time.perf_counter() - start)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    start = time.perf_counter()
+    limits = httpx.Limits(max_connections=concurrency)
+    headers = {BYPASS_HEADER: admission_token} if admission_token else None
+    async with httpx.AsyncClient(timeout=30, limits=limits, transport=transport, headers=headers) as client:
+        workers = [asyncio.create_task(worker(client)) for _ in range(concurrency)]
+        sent = 0
+        for item in events:
+            if count is not None and sent >= count:
+                break
+            elapsed = time.perf_counter() - start
+            if duration is not None and elapsed >= duration:
+                break
+            if rate:
+                delay = sent / rate - elapsed
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await queue.put(item)
+            sent += 1
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+    return {
+        "sent": sent,
+        "elapsed_s": time.perf_counter() - start,
+        "latencies": latencies,
+        "statuses": statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sends simulated tracker traffic to the receiver")
+    parser.add_argument("--url", default="http://localhost/receiver", help="receiver base URL")
+    parser.add_argument("--rate", type=float, default=100, help="events per second, 0 for unthrottled")
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--alert-ratio", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--admission-token", default=os.environ.get("ADMISSION_BYPASS_TOKEN"),
+        help="ADMISSION_BYPASS_TOKEN of the receiver, skips its rate limits"
+    )
+    args = parser.parse_args()
+
+    events = TrafficGenerator(args.devices, args.alert_ratio, args.seed)
+    result = asyncio.run(send(
+        args.url, events, args.rate, duration=args.duration, concurrency=args.concurrency,
+        admission_token=args.admission_token
+    ))
+    result.pop("latencies")
+    result["rate_per_s"] = result["sent"] / result["elapsed_s"]
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
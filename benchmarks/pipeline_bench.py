@@ -0,0 +1,214 @@
+"""
+End-to-end benchmark of the tracker pipeline.
+
+Drives the receiver with benchmarks.loadgen traffic and measures
+
+    receiver      accepted events per second and request latency
+    ingest_lag    time until storage /stats counts every accepted event,
+                  i.e. how far the Kafka -> MySQL path trails the receiver
+    storage_query latency of GET /storage/track/locations over the run window
+    consistency   duration of POST /consistency_check/update
+
+against a running stack (docker compose up, all services behind nginx):
+
+    python -m benchmarks.pipeline_bench --base-url http://localhost --events 5000 --output results.json
+
+or, with --inprocess, against benchmarks.inprocess: every service in this
+process on an in-memory topic and SQLite, nothing to start first.
+
+The receiver's per-device rate limit would answer most of the benchmark's
+events 429. In process the limit is turned off in the receiver's config. A
+running stack has to be started with ADMISSION_BYPASS_TOKEN, and the
+benchmark sends it with --admission-token, by default from the same
+environment variable:
+
+    ADMISSION_BYPASS_TOKEN=bench docker compose up -d
+    ADMISSION_BYPASS_TOKEN=bench python -m benchmarks.pipeline_bench --base-url http://localhost
+
+A run that still got 429s is flagged with rate_limited in the results and a
+warning, its throughput says nothing about the pipeline.
+
+Results are printed, or written with --output, as one JSON document so runs
+can be diffed and tracked over time.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+from benchmarks.inprocess import BASE_URL, InProcessPipeline
+from benchmarks.loadgen import TrafficGenerator, send
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """ Nearest-rank percentiles of samples (seconds) in ms """
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    result = {f"p{p}_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 3) for p in points}
+    result["max_ms"] = round(ordered[-1] * 1000, 3)
+    result["mean_ms"] = round(sum(ordered) / len(ordered) * 1000, 3)
+    return result
+
+
+async def stored_events(client, base_url):
+    response = await client.get(f"{base_url}/storage/stats")
+    response.raise_for_status()
+    stats = response.json()
+    return stats["num_gps_events"] + stats["num_alert_events"]
+
+
+async def bench_receiver(base_url, args, transport):
+    events = TrafficGenerator(args.devices, args.alert_ratio, args.seed)
+    result = await send(
+        f"{base_url}/receiver", events, args.rate, count=args.events,
+        concurrency=args.concurrency, transport=transport, admission_token=args.admission_token
+    )
+    accepted = result["statuses"].get("201", 0)
+    rate_limited = result["statuses"].get("429", 0)
+    if rate_limited:
+        print(
+            f"warning: the receiver rate limited {rate_limited} of {result['sent']} events, "
+            "set ADMISSION_BYPASS_TOKEN on the stack and pass it with --admission-token",
+            file=sys.stderr,
+        )
+    return {
+        "sent": result["sent"],
+        "accepted": accepted,
+        "rate_limited": rate_limited,
+        "statuses": result["statuses"],
+        "elapsed_s": round(result["elapsed_s"], 3),
+        "throughput_per_s": round(accepted / result["elapsed_s"], 1),
+        "latency": percentiles(result["latencies"]),
+    }
+
+
+async def bench_ingest_lag(client, base_url, expected, timeout):
+    """ Polls storage until `expected` events are stored, timing from the end of the load """
+    start = time.perf_counter()
+    stored = await stored_events(client, base_url)
+    while stored < expected and time.perf_counter() - start < timeout:
+        await asyncio.sleep(0.1)
+        stored = await stored_events(client, base_url)
+    return {
+        "drained": stored >= expected,
+        "lag_s": round(time.perf_counter() - start, 3),
+        "missing": max(expected - stored, 0),
+    }
+
+
+async def bench_storage_query(client, base_url, window_start, repeat):
+    params = {
+        "start_timestamp": window_start.isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+        "end_timestamp": (datetime.now(timezone.utc) + timedelta(minutes=1))
+        .isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+    }
+    latencies = []
+    rows = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = await client.get(f"{base_url}/storage/track/locations", params=params)
+        latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+        rows = len(response.json())
+    return {"rows": rows, "requests": repeat, "latency": percentiles(latencies)}
+
+
+async def bench_consistency(client, base_url, repeat):
+    durations = []
+    reported = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = await client.post(f"{base_url}/consistency_check/update", timeout=300)
+        durations.append(time.perf_counter() - start)
+        response.raise_for_status()
+        reported.append(response.json().get("processing_time_ms"))
+    return {"runs": repeat, "duration": percentiles(durations), "reported_processing_time_ms": reported}
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    base_url = args.base_url.rstrip("/")
+    transport = None
+    if args.inprocess:
+        pipeline = InProcessPipeline(storage_workers=args.storage_workers)
+        pipeline.start()
+        base_url, transport = BASE_URL, pipeline.transport
+
+    results = {}
+    async with httpx.AsyncClient(timeout=30, transport=transport) as client:
+        window_start = datetime.now(timezone.utc) - timedelta(seconds=1)
+        before = await stored_events(client, base_url)
+
+        results["receiver"] = await bench_receiver(base_url, args, transport)
+        results["ingest_lag"] = await bench_ingest_lag(
+            client, base_url, before + results["receiver"]["accepted"], args.drain_timeout
+        )
+        results["storage_query"] = await bench_storage_query(client, base_url, window_start, args.query_repeat)
+        if args.consistency_repeat:
+            results["consistency"] = await bench_consistency(client, base_url, args.consistency_repeat)
+
+    return {
+        "benchmark": "pipeline",
+        "started_at": window_start.isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "target": "inprocess" if args.inprocess else base_url,
+        "config": {
+            "events": args.events,
+            "rate": args.rate,
+            "devices": args.devices,
+            "alert_ratio": args.alert_ratio,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the tracker pipeline end to end")
+    parser.add_argument("--base-url", default="http://localhost", help="nginx in front of the services")
+    parser.add_argument("--inprocess", action="store_true", help="run the services in this process instead")
+    parser.add_argument("--storage-workers", type=int, default=1, help="storage consumer threads with --inprocess")
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=0, help="events per second, 0 for unthrottled")
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--alert-ratio", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--admission-token", default=os.environ.get("ADMISSION_BYPASS_TOKEN"),
+        help="ADMISSION_BYPASS_TOKEN of the receiver, skips its rate limits"
+    )
+    parser.add_argument("--drain-timeout", type=float, default=120, help="seconds to wait for storage")
+    parser.add_argument("--query-repeat", type=int, default=20)
+    parser.add_argument("--consistency-repeat", type=int, default=3, help="0 to skip")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,37 +2,59 @@ import connexion
 import os
 import yaml
 import json
-import logging.config
+import logging
 from datetime import datetime, timezone
 import asyncio
 import httpx
 from starlette.middleware.cors import CORSMiddleware
 from connexion.middleware import MiddlewarePosition
 
+from shared.cache import cache_from_config, file_version
+from shared.digest import differing
+from shared.health import Health
+from shared.log import configure_logging
+from shared.metrics import MetricsMiddleware, gauge, histogram, metrics_response
+from shared.profile import profiler_from_config
+from shared.serve import serve
+
 # Load app config
-with open("/app/config/app_conf.yml", "r") as f:
+with open(os.environ.get("APP_CONF_FILE", "/app/config/app_conf.yml"), "r") as f:
     app_config = yaml.safe_load(f.read())
 
 # Setup logging
-LOG_DIRECTORY = "/app/logs"
+LOG_DIRECTORY = os.environ.get("LOG_DIRECTORY", "/app/logs")
 if not os.path.exists(LOG_DIRECTORY):
     os.makedirs(LOG_DIRECTORY)
 
-with open('/config/log_conf.yml', 'r') as f:
-    log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+configure_logging(os.environ.get("LOG_CONF_FILE", '/config/log_conf.yml'))
 
 logger = logging.getLogger('consistencyLogger')
+# No connections to wait for, ready as soon as it serves requests
+health = Health(logger)
+# Sampling profiles and thread dumps on GET /debug/..., disabled without DEBUG_TOKEN
+profiler = profiler_from_config(app_config)
 
 CHECKS_FILE = app_config["datastore"]
 ANALYZER_URL = app_config["analyzer"]["url"]
 STORAGE_URL = app_config["storage"]["url"]
 PROCESSING_URL = app_config["processing"]["url"]
+# None sends requests over the network, the in-process benchmark routes them to the services' apps
+http_transport = None
 
 KAFKA_HOSTNAME = app_config["events"]["hostname"]
 KAFKA_PORT = app_config["events"]["port"]
 KAFKA_TOPIC = app_config["events"]["topic"]
 
+# Bucket widths compared in turn, each level only inside the buckets that differed at the one before
+DIGEST_LEVELS = app_config.get("digests", {}).get("levels", [86400, 3600])
+# Most buckets whose events are read in one check, the oldest ones first, the rest wait for the next check
+MAX_RANGES = app_config.get("digests", {}).get("max_ranges", 48)
+
+checks_cache = cache_from_config("checks", app_config)
+
+CHECK_LATENCY = histogram("consistency_check_duration_seconds", "Duration of one consistency check run")
+MISSING = gauge("consistency_missing_events", "Events missing after the last check", ("missing_from",))
+
 logger.info(f"Kafka config - Host: {KAFKA_HOSTNAME}, Port: {KAFKA_PORT}, Topic: {KAFKA_TOPIC}")
 
 # Load previous results
@@ -42,32 +64,17 @@ def load_results():
             return json.load(f)
     return {}
 
-# Save new check result
+# Save new check result, replaced at once so other workers never read it half written
 def save_results(data):
-    with open(CHECKS_FILE, 'w') as f:
+    temporary = f"{CHECKS_FILE}.{os.getpid()}.tmp"
+    with open(temporary, 'w') as f:
         json.dump(data, f, indent=2)
+    os.replace(temporary, CHECKS_FILE)
 
 # to create a key for an event based on trace_id
 def event_key(event):
     return str(event.get("trace_id"))
 
-# Fetch analyzer queue data
-async def fetch_all_analyzer_events(analyzer_url, event_type):
-    results = []
-    index = 0
-    while True:
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.get(f"{analyzer_url}/track/{event_type}?index={index}")
-                if response.status_code != 200:
-                    break
-                results.append(response.json())
-                index += 1
-            except Exception as e:
-                logger.error(f"Error fetching {event_type} from analyzer at index {index}: {str(e)}")
-                break
-    return results
-
 def clean_timestamp(ts):
     try:
         return datetime.fromisoformat(ts).astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
@@ -75,47 +82,69 @@ def clean_timestamp(ts):
         logger.error(f"Invalid timestamp format: {ts}. Resetting to default.")
         return "2000-01-01T00:00:00Z"
 
+async def fetch_json(client, url, params=None):
+    response = await client.get(url, params=params)
+    response.raise_for_status()
+    return response.json()
+
+def range_params(start_ms, end_ms):
+    return {key: value for key, value in (("start_ms", start_ms), ("end_ms", end_ms)) if value is not None}
+
+async def differing_buckets(client, bucket_seconds, start_ms, end_ms):
+    """ [start_ms, end_ms) of the buckets in the range whose digests differ between storage and the queue """
+    params = {"bucket_seconds": bucket_seconds, **range_params(start_ms, end_ms)}
+    db, queue = await asyncio.gather(
+        fetch_json(client, f"{STORAGE_URL}/digests", params),
+        fetch_json(client, f"{ANALYZER_URL}/digests", params),
+    )
+    return [(bucket_start, bucket_start + bucket_seconds * 1000) for bucket_start in differing(db, queue)]
+
+async def differing_ranges(client):
+    """ Drills down DIGEST_LEVELS, returns the finest buckets that still differ """
+    ranges = [(None, None)]
+    for bucket_seconds in DIGEST_LEVELS:
+        found = await asyncio.gather(*(
+            differing_buckets(client, bucket_seconds, start_ms, end_ms) for start_ms, end_ms in ranges
+        ))
+        ranges = [bucket for buckets in found for bucket in buckets]
+        if not ranges:
+            break
+    return ranges
+
+async def fetch_events(client, url, ranges):
+    """ All events of url/events in the ranges, by trace_id, in one request """
+    if not ranges:
+        return {}
+    params = [(key, value) for start_ms, end_ms in ranges for key, value in (("start_ms", start_ms), ("end_ms", end_ms))]
+    events = await fetch_json(client, f"{url}/events", params)
+    return {event_key(e): e for e in events["gps"] + events["alerts"]}
+
 # POST /update
-# to fetch events from storage and analyzer and comparing them
+# to compare storage and the analyzer's queue, only the events of buckets whose digests differ are fetched
 async def run_consistency_checks():
     logger.info("Running consistency check")
     start_time = datetime.now()
 
     try:
         now = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
-        default_start = "2000-01-01T00:00:00Z"
 
-        async with httpx.AsyncClient() as client:
-            analyzer_stats = (await client.get(f"{ANALYZER_URL}/stats")).json()
-            storage_stats = (await client.get(f"{STORAGE_URL}/stats")).json()
-            processing_stats = (await client.get(f"{PROCESSING_URL}/stats")).json()
-
-            gps_db_response = await client.get(f"{STORAGE_URL}/track/locations", params={
-                "start_timestamp": default_start, "end_timestamp": now
-            })
-            alerts_db_response = await client.get(f"{STORAGE_URL}/track/alerts", params={
-                "start_timestamp": default_start, "end_timestamp": now
-            })
-
-            gps_db = gps_db_response.json() if gps_db_response.status_code == 200 else []
-            alerts_db = alerts_db_response.json() if alerts_db_response.status_code == 200 else []
-
-        # Type safety
-        if not isinstance(gps_db, list):
-            logger.error("gps_db is not a list. Got: %s", type(gps_db))
-            gps_db = []
-        if not isinstance(alerts_db, list):
-            logger.error("alerts_db is not a list. Got: %s", type(alerts_db))
-            alerts_db = []
-
-        gps_queue = await fetch_all_analyzer_events(ANALYZER_URL, "locations")
-        alerts_queue = await fetch_all_analyzer_events(ANALYZER_URL, "alerts")
-
-        if not isinstance(gps_queue, list): gps_queue = []
-        if not isinstance(alerts_queue, list): alerts_queue = []
-
-        all_db = {event_key(e): e for e in gps_db + alerts_db}
-        all_queue = {event_key(e): e for e in gps_queue + alerts_queue}
+        async with httpx.AsyncClient(transport=http_transport) as client:
+            analyzer_stats, storage_stats, processing_stats = [
+                response.json() for response in await asyncio.gather(
+                    client.get(f"{ANALYZER_URL}/stats"),
+                    client.get(f"{STORAGE_URL}/stats"),
+                    client.get(f"{PROCESSING_URL}/stats"),
+                )
+            ]
+
+            ranges = await differing_ranges(client)
+            if len(ranges) > MAX_RANGES:
+                logger.warning(f"{len(ranges)} buckets differ, reading the events of the {MAX_RANGES} oldest")
+                ranges = ranges[:MAX_RANGES]
+            all_db, all_queue = await asyncio.gather(
+                fetch_events(client, STORAGE_URL, ranges),
+                fetch_events(client, ANALYZER_URL, ranges),
+            )
 
         not_in_db = [v for k, v in all_queue.items() if k not in all_db]
         not_in_queue = [v for k, v in all_db.items() if k not in all_queue]
@@ -127,12 +156,12 @@ async def run_consistency_checks():
             "processing_time_ms": processing_time,
             "counts": {
                 "db": {
-                    "gps": len(gps_db),
-                    "alerts": len(alerts_db)
+                    "gps": storage_stats.get("num_gps_events", 0),
+                    "alerts": storage_stats.get("num_alert_events", 0)
                 },
                 "queue": {
-                    "gps": len(gps_queue),
-                    "alerts": len(alerts_queue)
+                    "gps": analyzer_stats.get("num_gps_events", 0),
+                    "alerts": analyzer_stats.get("num_alert_events", 0)
                 },
                 "processing": {
                     "gps": processing_stats.get("num_gps_events", 0),
@@ -144,9 +173,12 @@ async def run_consistency_checks():
         }
 
         save_results(result)
+        CHECK_LATENCY.observe(processing_time / 1000)
+        MISSING.labels("db").set(len(not_in_db))
+        MISSING.labels("queue").set(len(not_in_queue))
 
         logger.info(
-            f"Consistency checks completed | processing_time_ms={processing_time} | missing_in_db = {len(not_in_db)} | missing_in_queue = {len(not_in_queue)}"
+            f"Consistency checks completed | processing_time_ms={processing_time} | differing_buckets = {len(ranges)} | missing_in_db = {len(not_in_db)} | missing_in_queue = {len(not_in_queue)}"
         )
 
         return {"processing_time_ms": processing_time}, 200
@@ -158,26 +190,54 @@ async def run_consistency_checks():
 # GET /checks
 async def get_checks():
     logger.info("Fetching consistency check results")
+    return checks_cache.respond("checks", file_version(CHECKS_FILE), read_checks)
 
+def read_checks():
     if not os.path.exists(CHECKS_FILE):
         return {"message": "No checks have been run yet"}, 404
 
     with open(CHECKS_FILE, 'r') as f:
         return json.load(f), 200
 
-app = connexion.FlaskApp(__name__, specification_dir=".")
-app.add_api("openapi.yml", base_path="/consistency_check", strict_validation=True, validate_responses=True)
-
-if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
-    app.add_middleware(
-        CORSMiddleware,
-        position=MiddlewarePosition.BEFORE_EXCEPTION,
-        allow_origins=["*"],
-        allow_credentials=True,
-        allow_methods=["*"],
-        allow_headers=["*"],
-    )
+# GET /debug/profile
+def get_profile(seconds=10, hz=100, thread=None):
+    return profiler.profile_response(seconds, hz, thread)
+
+# GET /debug/threads
+def get_threads():
+    return profiler.threads_response()
+
+# GET /metrics
+def get_metrics():
+    return metrics_response()
+
+# GET /health/live
+def get_liveness():
+    return health.liveness()
+
+# GET /health/ready
+def get_readiness():
+    return health.readiness()
+
+def create_app():
+    """ Builds the app """
+    app = connexion.FlaskApp(__name__, specification_dir=".", lifespan=health.lifespan)
+    app.add_api("openapi.yml", base_path="/consistency_check", strict_validation=True, validate_responses=True)
+    app.add_middleware(MetricsMiddleware, position=MiddlewarePosition.BEFORE_SECURITY)
+
+    if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
+        app.add_middleware(
+            CORSMiddleware,
+            position=MiddlewarePosition.BEFORE_EXCEPTION,
+            allow_origins=["*"],
+            allow_credentials=True,
+            allow_methods=["*"],
+            allow_headers=["*"],
+        )
+    return app
+
+app = create_app()
 
 if __name__ == "__main__":
     logger.info("Consistency Check Service started")
-    app.run(port=8120, host="0.0.0.0")
+    serve(app, 8120, app_config)
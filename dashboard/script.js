@@ -2,6 +2,7 @@
 
 const CLOUD_VM_DNS = "34.234.232.11" 
 const PROCESSING_STATS_API = `http://${CLOUD_VM_DNS}/processing/stats`
+const ANALYZER_FEED_API = `http://${CLOUD_VM_DNS}/analyzer/feed`
 const ANALYZER_API = {
     stats: `http://${CLOUD_VM_DNS}/analyzer/stats`,
     trackGPS: `http://${CLOUD_VM_DNS}/analyzer/track/locations`,
@@ -40,6 +41,27 @@ const updateCodeDiv = (result, elemId) => {
 
 const getLocaleDateStr = () => (new Date()).toLocaleString()
 
+const showProcessingStats = (result) => {
+    // Format processing stats for better display
+    let formattedStats = {
+        "Number of GPS Events Stored": result.num_gps_events || 0,
+        "Number of Alert Events Stored": result.num_alert_events || 0,
+        "Max Alerts Per Day": result.max_alerts_per_day || "N/A",
+        "Peak GPS Activity Day": result.peak_gps_activity_day || "N/A",
+        "Last Updated": result.last_updated ? new Date(result.last_updated).toLocaleString() : "N/A"
+    }
+    updateCodeDiv(formattedStats, "processing-stats")
+}
+
+const showAnalyzerStats = (result) => {
+    // Format analyzer stats for better display
+    let formattedStats = {
+        "GPS Events Count": result.num_gps_events || 0,
+        "Alert Events Count": result.num_alert_events || 0
+    }
+    updateCodeDiv(formattedStats, "analyzer-stats")
+}
+
 const getStats = () => {
     document.getElementById("last-updated-value").innerText = getLocaleDateStr()
     
@@ -48,29 +70,46 @@ const getStats = () => {
     // makeReq(ANALYZER_API_URL.snow, (result) => updateCodeDiv(result, "event-snow"))
     // makeReq(ANALYZER_API_URL.lift, (result) => updateCodeDiv(result, "event-lift"))
 
-    makeReq(PROCESSING_STATS_API, (result) => {
-        // Format processing stats for better display
-        let formattedStats = {
-            "Number of GPS Events Stored": result.num_gps_events || 0,
-            "Number of Alert Events Stored": result.num_alert_events || 0,
-            "Max Alerts Per Day": result.max_alerts_per_day || "N/A",
-            "Peak GPS Activity Day": result.peak_gps_activity_day || "N/A",
-            "Last Updated": result.last_updated ? new Date(result.last_updated).toLocaleString() : "N/A"
-        }
-        updateCodeDiv(formattedStats, "processing-stats")
-    })
+    makeReq(PROCESSING_STATS_API, showProcessingStats)
     
     // Fetch analyzer stats
     makeReq(ANALYZER_API.stats, (result) => {
-        // Format analyzer stats for better display
-        let formattedStats = {
-            "GPS Events Count": result.num_gps_events || 0,
-            "Alert Events Count": result.num_alert_events || 0
-        }
-        updateCodeDiv(formattedStats, "analyzer-stats")
+        analyzerStats = result
+        showAnalyzerStats(result)
     })
 }
 
+// Analyzer counts read once per connection, the feed sends what was added since
+let analyzerStats = null
+
+const applyUpdate = (update) => {
+    document.getElementById("last-updated-value").innerText = getLocaleDateStr()
+
+    if (analyzerStats) {
+        for (const [key, count] of Object.entries(update.stats_delta)) {
+            analyzerStats[key] = (analyzerStats[key] || 0) + count
+        }
+        showAnalyzerStats(analyzerStats)
+    }
+    if (update.processing_stats) showProcessingStats(update.processing_stats)
+    if (update.latest_gps) updateCodeDiv(update.latest_gps, "latest-gps")
+    if (update.latest_alert) updateCodeDiv(update.latest_alert, "latest-alert")
+}
+
+// Subscribes to the analyzer feed, polls every 4 seconds where EventSource is missing
+const subscribe = () => {
+    if (!window.EventSource) {
+        getStats()
+        setInterval(() => getStats(), 4000)
+        return
+    }
+    const source = new EventSource(ANALYZER_FEED_API)
+    // Also runs when the browser reconnects after an error
+    source.onopen = () => getStats()
+    source.addEventListener("update", (e) => applyUpdate(JSON.parse(e.data)))
+    source.onerror = () => updateErrorMessages("Live feed disconnected, reconnecting")
+}
+
 const fetchGpsEvent = () => {
     const index = document.getElementById("gps-index").value;
     fetch(`${ANALYZER_API.trackGPS}?index=${index}`)
@@ -193,8 +232,7 @@ const updateErrorMessages = (message) => {
 }
 
 const setup = () => {
-    getStats()
-    setInterval(() => getStats(), 4000) // Update every 4 seconds
+    subscribe()
 
     document.getElementById("fetch-gps-btn").addEventListener("click", fetchGpsEvent);
     document.getElementById("fetch-alert-btn").addEventListener("click", fetchAlertEvent);
@@ -1,38 +1,80 @@
 import connexion
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import os
 import json
+import time
 import yaml 
-import logging.config
-from apscheduler.schedulers.background import BackgroundScheduler
+import logging
+from threading import Thread
 
 import httpx
 import asyncio
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 
+from shared.ids import trace_id_ms
+from shared.cache import cache_from_config
+from shared.health import Health
+from shared.log import configure_logging
+from shared.metrics import MetricsMiddleware, counter, histogram, metrics_response
+from shared.profile import profiler_from_config
+from shared.serve import serve
+from shared.state import state_from_config
+from shared.tracing import tracer_from_config
+
 
 # Configurations
-with open("/app/config/app_conf.yml", "r") as f:
+with open(os.environ.get("APP_CONF_FILE", "/app/config/app_conf.yml"), "r") as f:
     app_config = yaml.safe_load(f.read())
 
 # Make sure the logs directory exists
-LOG_DIRECTORY = "/app/logs"
+LOG_DIRECTORY = os.environ.get("LOG_DIRECTORY", "/app/logs")
 if not os.path.exists(LOG_DIRECTORY):
     os.makedirs(LOG_DIRECTORY)
 
 # Logging file
-with open('/config/log_conf.yml', 'r') as f:
-    log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+configure_logging(os.environ.get("LOG_CONF_FILE", '/config/log_conf.yml'))
 
 logger = logging.getLogger('processingLogger')
+# No connections to wait for, ready as soon as it serves requests
+health = Health(logger)
+# Sampling profiles and thread dumps on GET /debug/..., disabled without DEBUG_TOKEN
+profiler = profiler_from_config(app_config)
 
 # URL from config
 GPS_URL = app_config["eventstores"]["track_locations"]["url"]
 ALERTS_URL = app_config["eventstores"]["track_alerts"]["url"]
+# None sends requests over the network, the in-process benchmark routes them to storage's app
+http_transport = None
+
+STATS_FILE = os.path.join(app_config["datastore"].get("directory", "/app/data"), app_config["datastore"]["filename"])
+
+INTERVAL_SECONDS = app_config["scheduler"]["interval"]
+# A run reads the time since the last one in windows, oldest first, and saves
+# its progress after each. Windows start at CHUNK_SECONDS and double while
+# they hold fewer than CHUNK_EVENTS / 2 events, up to MAX_CHUNK_SECONDS, so
+# quiet stretches (or the years before the first event) take a few requests.
+# A window with more than CHUNK_EVENTS events is read again in halves, down
+# to MIN_CHUNK_SECONDS, so a burst after a quiet stretch is not applied at once.
+CHUNK_SECONDS = app_config["scheduler"].get("chunk_seconds", 300)
+CHUNK_EVENTS = app_config["scheduler"].get("chunk_events", 5000)
+MAX_CHUNK_SECONDS = app_config["scheduler"].get("max_chunk_seconds", 604800)
+MIN_CHUNK_SECONDS = 1
+# The maxima compare whole days: per-day counts of the days whose events are
+# still arriving are kept in the stats file across windows and runs, for the
+# days this many days before the end of the last window and after
+DAILY_COUNTS_DAYS = app_config["scheduler"].get("daily_counts_days", 2)
 
-STATS_FILE = "/app/data/stats.json"
+RUN_LATENCY = histogram("processing_run_duration_seconds", "Duration of one populate_stats run")
+PROCESSED = counter("processing_events_total", "Events added to the statistics", ("type",))
+RUN_ERRORS = counter("processing_run_errors_total", "populate_stats runs that failed")
+CHUNKS = counter("processing_chunks_total", "Time windows read from storage and applied to the statistics")
+
+tracer = tracer_from_config(app_config)
+# The scheduler publishes the stats it writes, every worker answers /stats from there
+state = state_from_config(app_config, "/dev/shm/processing.state")
+# Dashboards poll /stats, the state only changes once per window of a scheduler run
+stats_cache = cache_from_config("stats", app_config)
 
 # Initialize default stats
 def initialize_stats():
@@ -61,112 +103,205 @@ def clean_timestamp(timestamp):
     except ValueError:
         logger.error(f"Invalid timestamp format: {timestamp}. Resetting to default.")
         return "2000-01-01T00:00:00Z"  
-    
-async def populate_stats():
+
+def write_stats(stats):
+    """ Replaces the stats file at once and publishes the stats to the workers """
+    temporary = f"{STATS_FILE}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(stats, f, indent=2)
+    os.replace(temporary, STATS_FILE)
+    state.publish(published(stats))
+
+def published(stats):
+    """ The stats without the per-day counts, the scheduler's own bookkeeping """
+    return {key: value for key, value in stats.items() if key != "daily_counts"}
+
+def utc_timestamp(moment):
+    return moment.isoformat().replace("+00:00", "Z")
+
+async def populate_stats(client):
+    with RUN_LATENCY.time():
+        await _populate_stats(client)
+
+async def _populate_stats(client):
     logger.info("Periodic processing has started")
-    logger.info("Periodic processing has started again.")
     try:
         stats = initialize_stats()
 
-        last_updated = clean_timestamp(stats["last_updated"])
-        current_time = datetime.now().astimezone().isoformat().replace("+00:00", "Z")
-        
-        # httpx
-        async with httpx.AsyncClient() as client:
-            gps_response = await client.get(
-                f"{GPS_URL}?start_timestamp={last_updated}&end_timestamp={current_time}"
-            )
-            alerts_response = await client.get(
-                f"{ALERTS_URL}?start_timestamp={last_updated}&end_timestamp={current_time}"
-            )
-        logger.debug(f"GPS API Response: {gps_response.status_code}, {gps_response.text}")
-        logger.debug(f"Alerts API Response: {alerts_response.status_code}, {alerts_response.text}")
-
-        # Check response codes
-        if gps_response.status_code != 200 or alerts_response.status_code != 200:
-            logger.error(
-                f"GPS status: {gps_response.status_code}, "
-                f"Alerts status: {alerts_response.status_code}"
-            )
-            return
-        
-        gps_events = gps_response.json()
-        alerts_events = alerts_response.json()
-        
-        logger.info(
-            f"Received events - GPS: {len(gps_events)}, Alerts: {len(alerts_events)}"
-        )
+        chunk_start = datetime.fromisoformat(clean_timestamp(stats["last_updated"]).replace("Z", "+00:00"))
+        end = datetime.now(timezone.utc)
+        window = timedelta(seconds=CHUNK_SECONDS)
+        max_window = timedelta(seconds=max(MAX_CHUNK_SECONDS, CHUNK_SECONDS))
+        min_window = timedelta(seconds=MIN_CHUNK_SECONDS)
 
-        # cumulative number for events
-        stats["num_gps_events"] += len(gps_events)
-        stats["num_alert_events"] += len(alerts_events)
-        
-        # Calculate max alerts
-        daily_alerts = {}
-        for event in alerts_events:
-            date = event["timestamp"].split("T")[0]
-            daily_alerts[date] = daily_alerts.get(date, 0) + 1
-
-        stats["max_alerts_per_day"] = max(daily_alerts.values(), default=stats["max_alerts_per_day"])
-    
-        # Calculate peak GPS
-        daily_gps = {}
-        for event in gps_events:
-            date = event["timestamp"].split("T")[0]
-            daily_gps[date] = daily_gps.get(date, 0) + 1
-
-        stats["peak_gps_activity_day"] = max(daily_gps.values(), default=stats["peak_gps_activity_day"])
-    
-        stats["last_updated"] = current_time
+        while chunk_start < end:
+            chunk_end = min(chunk_start + window, end)
+            events = await fetch_chunk(client, chunk_start, chunk_end)
+            if events is None:
+                return  # the next run starts again from the last saved window
+            count = len(events[0]) + len(events[1])
+            if count > CHUNK_EVENTS and chunk_end - chunk_start > min_window:
+                window = max((chunk_end - chunk_start) / 2, min_window)
+                continue  # read the first half again, nothing of this window is applied
+            apply_chunk(stats, *events, chunk_end)
+            chunk_start = chunk_end
+            if count < CHUNK_EVENTS // 2:
+                window = min(window * 2, max_window)
 
-        with open(STATS_FILE, "w") as f:
-            json.dump(stats, f, indent=2)
-        
-        logger.debug(f"Updated statistics: {stats}")
         logger.info("Periodic processing has ended")
 
     except Exception as e:
+        RUN_ERRORS.inc()
         logger.error(f"Error in populate_stats: {str(e)}")    
 
+async def fetch_chunk(client, chunk_start, chunk_end):
+    """ GPS and alert events of one window, None if storage failed """
+    params = {"start_timestamp": utc_timestamp(chunk_start), "end_timestamp": utc_timestamp(chunk_end)}
+    gps_response, alerts_response = await asyncio.gather(
+        client.get(GPS_URL, params=params),
+        client.get(ALERTS_URL, params=params),
+    )
+    logger.debug(f"GPS API Response: {gps_response.status_code}, {gps_response.text}")
+    logger.debug(f"Alerts API Response: {alerts_response.status_code}, {alerts_response.text}")
+
+    # Check response codes
+    if gps_response.status_code != 200 or alerts_response.status_code != 200:
+        logger.error(
+            f"GPS status: {gps_response.status_code}, "
+            f"Alerts status: {alerts_response.status_code}"
+        )
+        RUN_ERRORS.inc()
+        return None
+
+    gps_events = gps_response.json()
+    alerts_events = alerts_response.json()
+
+    logger.info(
+        f"Received events from {params['start_timestamp']} to {params['end_timestamp']} - "
+        f"GPS: {len(gps_events)}, Alerts: {len(alerts_events)}"
+    )
+    return gps_events, alerts_events
+
+def apply_chunk(stats, gps_events, alerts_events, chunk_end):
+    """ Adds the events of one window to stats and saves them """
+    PROCESSED.labels("TrackGPS").inc(len(gps_events))
+    PROCESSED.labels("TrackAlerts").inc(len(alerts_events))
+
+    # cumulative number for events
+    stats["num_gps_events"] += len(gps_events)
+    stats["num_alert_events"] += len(alerts_events)
+
+    # Calculate max alerts, over the running counts of each day
+    daily = stats.setdefault("daily_counts", {"gps": {}, "alerts": {}})
+    daily_alerts = daily["alerts"]
+    for event in alerts_events:
+        date = event["timestamp"].split("T")[0]
+        daily_alerts[date] = daily_alerts.get(date, 0) + 1
+
+    stats["max_alerts_per_day"] = max([stats["max_alerts_per_day"], *daily_alerts.values()])
+
+    # Calculate peak GPS
+    daily_gps = daily["gps"]
+    for event in gps_events:
+        date = event["timestamp"].split("T")[0]
+        daily_gps[date] = daily_gps.get(date, 0) + 1
+
+    stats["peak_gps_activity_day"] = max([stats["peak_gps_activity_day"], *daily_gps.values()])
+
+    # Days that ended long enough ago are already in the maxima
+    oldest_day = (chunk_end - timedelta(days=DAILY_COUNTS_DAYS)).date().isoformat()
+    for counts in daily.values():
+        for date in [date for date in counts if date < oldest_day]:
+            del counts[date]
+
+    # Checkpoint, a restart continues after this window
+    stats["last_updated"] = utc_timestamp(chunk_end)
+    write_stats(stats)
+    CHUNKS.inc()
+
+    # Receive time is encoded in the trace id, the stats are visible from now on
+    applied_ms = time.time_ns() // 1_000_000
+    for event in gps_events + alerts_events:
+        tracer.record(event["trace_id"], {"stats": (applied_ms - trace_id_ms(event["trace_id"])) / 1000})
+
+    logger.debug(f"Updated statistics: {stats}")
+
+async def run_scheduler():
+    """ Runs populate_stats every INTERVAL_SECONDS, one run at a time, on one client """
+    state.publish(published(initialize_stats()))
+    async with httpx.AsyncClient(transport=http_transport) as client:
+        while True:
+            started = time.monotonic()
+            await populate_stats(client)
+            # A run longer than the interval delays the next one instead of overlapping it
+            await asyncio.sleep(max(INTERVAL_SECONDS - (time.monotonic() - started), 0))
+
 async def get_stats():
 
     logger.info("Stats request received.")
+    return stats_cache.respond("stats", state.version(), read_stats)
 
-    if not os.path.exists(STATS_FILE):
-        logger.error("Statistics file does not exist.")
+def read_stats():
+    _, stats = state.read()
+    if stats is None:
+        logger.error("Statistics have not been published yet.")
         return {"message": "Statistics do not exist."}, 404
 
-    with open(STATS_FILE, "r") as f:
-        stats = json.load(f)
-
     logger.debug(f"Stats contents: {stats}")
     logger.info("Stats request completed.")
     return stats, 200
 
-# to setup a periodic call to the function
+# GET /traces/slow
+def get_slow_traces(limit=20):
+    return tracer.slow_traces(limit), 200
+
+# GET /debug/profile
+def get_profile(seconds=10, hz=100, thread=None):
+    return profiler.profile_response(seconds, hz, thread)
+
+# GET /debug/threads
+def get_threads():
+    return profiler.threads_response()
+
+# GET /metrics
+def get_metrics():
+    return metrics_response()
+
+# GET /health/live
+def get_liveness():
+    return health.liveness()
+
+# GET /health/ready
+def get_readiness():
+    return health.readiness()
+
+# to setup a periodic call to the function, on an event loop of its own
 def init_scheduler():
-    sched = BackgroundScheduler(daemon=True)
-    sched.add_job(lambda: asyncio.run(populate_stats()), "interval", seconds=app_config["scheduler"]["interval"])
-    # sched.add_job(populate_stats, 
-    #               "interval", 
-    #               seconds=app_config["scheduler"]["interval"])
-    sched.start()
+    thread = Thread(target=asyncio.run, args=(run_scheduler(),), name="stats-scheduler")
+    thread.daemon = True
+    thread.start()
     logger.info("Scheduler started")
 
-app = connexion.FlaskApp(__name__, specification_dir=".")
-app.add_api("openapi.yml", base_path="/processing", strict_validation=True, validate_responses=True)
-
-if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
-    app.add_middleware(
-        CORSMiddleware,
-        position=MiddlewarePosition.BEFORE_EXCEPTION,
-        allow_origins=["*"],
-        allow_credentials=True,
-        allow_methods=["*"],
-        allow_headers=["*"],
-    )
+def create_app():
+    """ Builds the app """
+    app = connexion.FlaskApp(__name__, specification_dir=".", lifespan=health.lifespan)
+    app.add_api("openapi.yml", base_path="/processing", strict_validation=True, validate_responses=True)
+    app.add_middleware(MetricsMiddleware, position=MiddlewarePosition.BEFORE_SECURITY)
+
+    if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
+        app.add_middleware(
+            CORSMiddleware,
+            position=MiddlewarePosition.BEFORE_EXCEPTION,
+            allow_origins=["*"],
+            allow_credentials=True,
+            allow_methods=["*"],
+            allow_headers=["*"],
+        )
+    return app
+
+app = create_app()
 
 if __name__ == "__main__":
     logger.info("Processing Service started")
     init_scheduler()
-    app.run(port=8100, host="0.0.0.0")
\ No newline at end of file
+    serve(app, 8100, app_config)
\ No newline at end of file
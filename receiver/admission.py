@@ -0,0 +1,126 @@
+"""
+Admission control for the event endpoints.
+
+    admission.check(device_id, depth)  None to accept, or (status, message, retry_after seconds)
+
+In order:
+
+  shed          503 with a probability that grows from 0 when the producer
+                holds shed_from of max_in_flight events to 1 when it is full,
+                so an overloaded receiver answers fast instead of queueing
+  device limit  429 once a device used its token bucket of device_burst
+                events, refilled at device_rate per second (0 for no limit)
+  global limit  429 once the replica used its bucket of global_burst events,
+                refilled at global_rate per second (0 for no limit)
+
+Buckets are kept for the max_devices most recently seen devices, a device
+that was forgotten comes back with a full bucket.
+
+Requests whose X-Admission-Bypass header matches the ADMISSION_BYPASS_TOKEN
+environment variable skip both limits, shedding still applies. The load
+generator and the pipeline benchmark send it with --admission-token, so a
+few simulated devices can send thousands of events to a running stack.
+"""
+import hmac
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+BYPASS_HEADER = "X-Admission-Bypass"
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self):
+        """ Seconds until one token is available, 0 if it is now """
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class Admission:
+    def __init__(self, device_rate, device_burst, global_rate=0, global_burst=1000,
+                 max_devices=100000, max_in_flight=10000, shed_from=0.5, bypass_token=None):
+        for name, rate, burst in (("device", device_rate, device_burst), ("global", global_rate, global_burst)):
+            if rate < 0:
+                raise ValueError(f"admission.{name}_rate must be 0 (no limit) or more, not {rate}")
+            if rate > 0 and burst < 1:
+                raise ValueError(f"admission.{name}_burst must be 1 or more, not {burst}")
+        self.device_rate = device_rate
+        self.device_burst = device_burst
+        self.max_devices = max_devices
+        self.max_in_flight = max_in_flight
+        self.shed_from = shed_from
+        self.bypass_token = bypass_token
+        self._devices = OrderedDict()
+        self._global = TokenBucket(global_rate, global_burst, time.monotonic()) if global_rate > 0 else None
+        self._lock = threading.Lock()
+
+    def shed_probability(self, depth):
+        load = depth / self.max_in_flight
+        if load <= self.shed_from:
+            return 0.0
+        return min(1.0, (load - self.shed_from) / (1 - self.shed_from))
+
+    def _device(self, device_id, now):
+        bucket = self._devices.get(device_id)
+        if bucket is None:
+            bucket = self._devices[device_id] = TokenBucket(self.device_rate, self.device_burst, now)
+            while len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+        else:
+            self._devices.move_to_end(device_id)
+            bucket.refill(now)
+        return bucket
+
+    def bypasses(self, token):
+        """ True if token is the configured bypass token """
+        if not self.bypass_token or not token:
+            return False
+        return hmac.compare_digest(token.encode("utf-8"), self.bypass_token.encode("utf-8"))
+
+    def check(self, device_id, depth=0, bypass=False):
+        if random.random() < self.shed_probability(depth):
+            return 503, "Receiver is overloaded", 1
+        if bypass:
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            device = self._device(device_id, now) if self.device_rate > 0 else None
+            if device is not None and device.tokens < 1:
+                return 429, f"Too many events from device {device_id}", math.ceil(device.wait())
+            if self._global is not None:
+                self._global.refill(now)
+                if self._global.tokens < 1:
+                    return 429, "Too many events", math.ceil(self._global.wait())
+                self._global.tokens -= 1
+            if device is not None:
+                device.tokens -= 1
+        return None
+
+
+def admission_from_config(app_config):
+    admission = app_config.get("admission") or {}
+    return Admission(
+        admission.get("device_rate", 5),
+        admission.get("device_burst", 20),
+        admission.get("global_rate", 0),
+        admission.get("global_burst", 1000),
+        admission.get("max_devices", 100000),
+        app_config["events"].get("max_in_flight", 10000),
+        admission.get("shed_from", 0.5),
+        os.environ.get("ADMISSION_BYPASS_TOKEN"),
+    )
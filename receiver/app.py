@@ -1,28 +1,37 @@
 import connexion
 from connexion import NoContent
+from connexion.middleware import MiddlewarePosition
 from datetime import datetime
 import yaml 
-import logging.config
-import time
-from pykafka import KafkaClient
-import json
+import logging
 import os
+import time
+
+from admission import BYPASS_HEADER, admission_from_config
+from shared.codec import EncodeError, get_codec
+from shared.health import Health
+from shared.ids import TraceIdGenerator
+from shared.log import configure_logging, get_event_logger
+from shared.metrics import MetricsMiddleware, counter, histogram, metrics_response
+from shared.profile import profiler_from_config
+from shared.tracing import stamp, tracer_from_config
+from shared.transport import AsyncProducer, get_transport
 
 # Configurations
-with open('/app/config/app_conf.yml', 'r') as f:
+with open(os.environ.get("APP_CONF_FILE", '/app/config/app_conf.yml'), 'r') as f:
     app_config = yaml.safe_load(f.read())
 
 # Make sure the logs directory exists
-log_directory = "/app/logs"
+log_directory = os.environ.get("LOG_DIRECTORY", "/app/logs")
 if not os.path.exists(log_directory):
     os.makedirs(log_directory)
 
 # Logging
-with open('/config/log_conf.yml', 'r') as f:
-    log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+configure_logging(os.environ.get("LOG_CONF_FILE", '/config/log_conf.yml'))
 
 logger = logging.getLogger('receiverLogger')
+# Per-event lines, sampled by the log config
+event_logger = get_event_logger('receiverLogger.events')
 
 # URL from config
 EVENT1_URL = app_config["eventstore1"]["url"]
@@ -31,24 +40,122 @@ EVENT2_URL = app_config["eventstore2"]["url"]
 KAFKA_HOSTNAME = app_config["events"]["hostname"] 
 KAFKA_PORT = app_config["events"]["port"] 
 KAFKA_TOPIC = app_config["events"]["topic"] 
+# Message encoding on the topic, consumers can decode every codec
+codec = get_codec(app_config["events"].get("codec", "json"))
+# Unique across replicas, the replica id defaults to the container address
+trace_ids = TraceIdGenerator((app_config.get("trace_ids") or {}).get("replica_id"))
+tracer = tracer_from_config(app_config)
+
+PRODUCED = counter("kafka_produced_messages_total", "Events produced to Kafka", ("type",))
+PRODUCE_ERRORS = counter("kafka_produce_errors_total", "Events that could not be produced")
+PRODUCE_LATENCY = histogram("kafka_produce_duration_seconds", "Time until the broker acknowledged an event")
+REJECTED = counter("receiver_rejected_events_total", "Events turned away before they were produced", ("status",))
+
+# async: coroutine handlers on connexion's AsyncApp, a produce waits on the
+# event loop instead of holding a worker thread. sync: Flask handlers.
+ASYNC_MODE = (app_config.get("server") or {}).get("mode", "sync") == "async"
+
+health = Health(logger)
+# Sampling profiles and thread dumps on GET /debug/..., disabled without DEBUG_TOKEN
+profiler = profiler_from_config(app_config)
+
+# Kafka Connection (Persistent), made in the background once the server runs
+def connect_kafka():
+    # Keyed by device_id below, every event of a device lands on the same partition
+    topic = get_transport(app_config["events"]).topic()
+    if ASYNC_MODE:
+        # One thread produces for every request, in batches
+        return AsyncProducer(
+            topic.producer(batched=True),
+            app_config["events"].get("max_in_flight", 10000),
+            app_config["events"].get("batch_size", 500),
+        )
+    return topic.producer()
+
+kafka = health.dependency("kafka", connect_kafka)
+
+# Rate limits per device and replica, load shedding on the producer depth
+admission = admission_from_config(app_config)
+
+def admit(body):
+    """ None when the event may go on, otherwise the 429/503 response """
+    # Only the async producer queues, the sync mode is bounded by its threads
+    depth = getattr(kafka.value, "in_flight", 0)
+    bypass = admission.bypasses(connexion.request.headers.get(BYPASS_HEADER))
+    rejected = admission.check(body["device_id"], depth, bypass)
+    if rejected is None:
+        return None
+    status, message, retry_after = rejected
+    REJECTED.labels(str(status)).inc()
+    event_logger.info("Rejected event of device %s with %d: %s", body["device_id"], status, message)
+    return {"message": message}, status, {"Retry-After": str(retry_after)}
+
+def encode_event(msg):
+    """ Stamps and encodes one event, returns the message bytes and partition key """
+    stamp(msg, produced=time.time_ns())
+    return codec.encode(msg), msg["payload"]["device_id"].encode("utf-8")
+
+def event_sent(msg):
+    trace_id = msg["payload"]["trace_id"]
+    acked = time.time_ns()
+    tracer.record(trace_id, {
+        "receive": (msg["trace"]["produced"] - msg["trace"]["received"]) / 1e9,
+        "produce": (acked - msg["trace"]["produced"]) / 1e9,
+    })
+    PRODUCED.labels(msg["type"]).inc()
+    event_logger.info("[Trace ID: %d] Successfully sent to Kafka topic '%s'.", trace_id, KAFKA_TOPIC)
+    return NoContent, 201
+
+def event_failed(msg, error):
+    PRODUCE_ERRORS.inc()
+    if error is None:
+        logger.error("[Trace ID: %d] Kafka producer is not available.", msg["payload"]["trace_id"])
+        return {"error": "Kafka is down"}, 500
+    logger.error("[Trace ID: %d] Kafka error: %s", msg["payload"]["trace_id"], error)
+    return {"error": "Kafka failure"}, 500
+
+def event_rejected(msg, error):
+    logger.error("[Trace ID: %d] Event cannot be encoded: %s", msg["payload"]["trace_id"], error)
+    return {"message": str(error)}, 400
 
-# Kafka Connection (Persistent)
-try:
-    client = KafkaClient(hosts=f"{KAFKA_HOSTNAME}:{KAFKA_PORT}")
-    topic = client.topics[KAFKA_TOPIC.encode("utf-8")]
-    producer = topic.get_sync_producer()
-    logger.info(f"Connected to Kafka at {KAFKA_HOSTNAME}:{KAFKA_PORT}")
-except Exception as e:
-    logger.error(f"Failed to connect to Kafka: {str(e)}")
-    producer = None
+# Encode and produce one event, shared by both event types
+def send_event(msg):
+    producer = kafka.value
+    if not producer:
+        return event_failed(msg, None)
+    try:
+        msg_bytes, partition_key = encode_event(msg)
+    except EncodeError as e:
+        return event_rejected(msg, e)
+    try:
+        with PRODUCE_LATENCY.time():
+            producer.produce(msg_bytes, partition_key=partition_key)
+    except Exception as e:
+        return event_failed(msg, e)
+    return event_sent(msg)
 
-# Event 1
-def trackGPS(body):
+# send_event for the async mode, the request waits for the producer thread
+async def send_event_async(msg):
+    producer = kafka.value
+    if not producer:
+        return event_failed(msg, None)
+    try:
+        msg_bytes, partition_key = encode_event(msg)
+    except EncodeError as e:
+        return event_rejected(msg, e)
+    try:
+        with PRODUCE_LATENCY.time():
+            await producer.produce(msg_bytes, partition_key=partition_key)
+    except Exception as e:
+        return event_failed(msg, e)
+    return event_sent(msg)
 
-    trace_id = time.time_ns()
+def gps_message(body):
+    received = time.time_ns()
+    trace_id = trace_ids.next_id()
 
     # Logging when an event is received
-    logger.info(f"Received event trackGPS of [Trace ID: {trace_id}].")
+    event_logger.info("Received event trackGPS of [Trace ID: %d].", trace_id)
 
     # 2025-02-11T15:30:00Z >>> 2025-02-11 15:30:00+00:00
     received_timestamp = datetime.fromisoformat(body.get("timestamp", "").replace("Z", "+00:00"))
@@ -62,35 +169,19 @@ def trackGPS(body):
             "trace_id" : trace_id,
     }
 
-    msg = { 
+    return { 
         "type": "TrackGPS",
         "datetime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-        "payload": data
+        "payload": data,
+        "trace": {"received": received},
     }
 
-    msg_str = json.dumps(msg)
-
-    # Send data to kafka
-    if producer:
-        try:
-            producer.produce(msg_str.encode('utf-8'))
-            logger.info(f"[Trace ID: {trace_id}] Successfully sent to Kafka topic '{KAFKA_TOPIC}'.")
-        except Exception as e:
-            logger.error(f"[Trace ID: {trace_id}] Kafka error: {str(e)}")
-            return {"error": "Kafka failure"}, 500
-    else:
-        logger.error(f"[Trace ID: {trace_id}] Kafka producer is not available.")
-        return {"error": "Kafka is down"}, 500
-
-    return NoContent, 201
-
-
-# Event 2
-def trackAlerts(body):
-    trace_id = time.time_ns()
+def alert_message(body):
+    received = time.time_ns()
+    trace_id = trace_ids.next_id()
 
     # Logging when an event is received
-    logger.info(f"Received event trackAlerts with a trace id of [Trace ID: {trace_id}].")
+    event_logger.info("Received event trackAlerts with a trace id of [Trace ID: %d].", trace_id)
 
     received_timestamp = datetime.fromisoformat(body.get("timestamp", "").replace("Z", "+00:00"))
 
@@ -104,29 +195,63 @@ def trackAlerts(body):
             "trace_id" : trace_id,
     }
 
-    msg = { 
+    return { 
         "type": "TrackAlerts",
         "datetime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-        "payload": data
+        "payload": data,
+        "trace": {"received": received},
     }
-    msg_str = json.dumps(msg)
-
-    # Send to Kafka
-    if producer:
-        try:
-            producer.produce(msg_str.encode('utf-8'))
-            logger.info(f"[Trace ID: {trace_id}] Successfully sent to Kafka topic '{KAFKA_TOPIC}'.")
-        except Exception as e:
-            logger.error(f"[Trace ID: {trace_id}] Kafka error: {str(e)}")
-            return {"error": "Kafka failure"}, 500
-    else:
-        logger.error(f"[Trace ID: {trace_id}] Kafka producer is not available.")
-        return {"error": "Kafka is down"}, 500
 
-    return NoContent, 201
+if ASYNC_MODE:
+    # Event 1
+    async def trackGPS(body):
+        return admit(body) or await send_event_async(gps_message(body))
+
+    # Event 2
+    async def trackAlerts(body):
+        return admit(body) or await send_event_async(alert_message(body))
+else:
+    # Event 1
+    def trackGPS(body):
+        return admit(body) or send_event(gps_message(body))
+
+    # Event 2
+    def trackAlerts(body):
+        return admit(body) or send_event(alert_message(body))
+
+# GET /traces/slow
+def get_slow_traces(limit=20):
+    return tracer.slow_traces(limit), 200
+
+# GET /debug/profile
+def get_profile(seconds=10, hz=100, thread=None):
+    return profiler.profile_response(seconds, hz, thread)
+
+# GET /debug/threads
+def get_threads():
+    return profiler.threads_response()
+
+# GET /metrics
+def get_metrics():
+    return metrics_response()
+
+# GET /health/live
+def get_liveness():
+    return health.liveness()
+
+# GET /health/ready
+def get_readiness():
+    return health.readiness()
+
+def create_app():
+    """ Builds the app, dependencies connect when the server starts it """
+    app_class = connexion.AsyncApp if ASYNC_MODE else connexion.FlaskApp
+    app = app_class(__name__, specification_dir='.', lifespan=health.lifespan)
+    app.add_api("openapi.yml", base_path="/receiver", strict_validation=True, validate_responses=True)
+    app.add_middleware(MetricsMiddleware, position=MiddlewarePosition.BEFORE_SECURITY)
+    return app
 
-app = connexion.FlaskApp(__name__, specification_dir='.')
-app.add_api("openapi.yml", base_path="/receiver", strict_validation=True, validate_responses=True)
+app = create_app()
 
 if __name__ == "__main__":
     logger.info("Receiver Service started")
@@ -0,0 +1,134 @@
+"""
+Cached GET responses with ETags.
+
+Read endpoints the dashboard polls wrap their handler body in
+cache.respond(key, version, compute). `version` is a cheap value that changes
+when the data behind the response changes, e.g. file_version(path) of the
+stats file. An entry is served until its version changes or it is older
+than ttl_seconds, whichever comes first; at most max_entries are kept, the
+least recently used go first.
+
+Every response carries an ETag derived from its body and Cache-Control:
+no-cache, so browsers revalidate with If-None-Match and get a 304 without a
+body while nothing changed. Concurrent misses on one key compute it once.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from connexion import NoContent, request
+
+from shared.metrics import counter
+
+CACHE_REQUESTS = counter("http_cache_requests_total", "Cached GET requests by outcome", ("cache", "result"))
+
+
+def file_version(path):
+    """ Version of a file for cache keys, None while it does not exist """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class _Entry:
+    __slots__ = ("version", "expires_at", "body", "status", "etag")
+
+    def __init__(self, version, expires_at, body, status, etag):
+        self.version = version
+        self.expires_at = expires_at
+        self.body = body
+        self.status = status
+        self.etag = etag
+
+
+class ResponseCache:
+    def __init__(self, name, ttl_seconds=5, max_entries=256):
+        self.name = name
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._results = {result: CACHE_REQUESTS.labels(name, result) for result in ("hit", "miss", "not_modified")}
+
+    def _get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.version != version or entry.expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def _put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _key_lock(self, key):
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                if len(self._key_locks) > self.max_entries * 2:
+                    self._key_locks.clear()  # old locks still held keep working, new callers get new ones
+                lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def lookup(self, key, version, compute):
+        """ Cached (body, status, etag) for key, compute() returns (body, status) on a miss """
+        entry = self._get(key, version)
+        if entry is not None:
+            self._results["hit"].inc()
+            return entry
+        with self._key_lock(key):
+            entry = self._get(key, version)  # computed while we waited
+            if entry is not None:
+                self._results["hit"].inc()
+                return entry
+            self._results["miss"].inc()
+            body, status = compute()
+            if status != 200:
+                return _Entry(version, 0, body, status, None)  # errors are not cached
+            entry = _Entry(version, time.monotonic() + self.ttl, body, status, etag(body))
+            self._put(key, entry)
+            return entry
+
+    def respond(self, key, version, compute):
+        """ Connexion response for a GET handler, 304 when If-None-Match has the current ETag """
+        entry = self.lookup(key, version, compute)
+        if entry.status != 200:
+            return entry.body, entry.status
+        headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+        if entry.etag in if_none_match():
+            self._results["not_modified"].inc()
+            return NoContent, 304, headers
+        return entry.body, 200, headers
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def etag(body):
+    data = json.dumps(body, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")
+    return '"' + hashlib.blake2b(data, digest_size=12).hexdigest() + '"'
+
+
+def if_none_match():
+    header = request.headers.get("If-None-Match", "")
+    # W/ prefixes come back from proxies that compress the response
+    return {tag.strip().removeprefix("W/") for tag in header.split(",") if tag.strip()}
+
+
+def cache_from_config(name, app_config):
+    cache = app_config.get("cache") or {}
+    return ResponseCache(name, cache.get("ttl_seconds", 5), cache.get("max_entries", 256))
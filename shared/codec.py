@@ -0,0 +1,171 @@
+"""
+Message codecs for the events topic.
+
+Producers pick one codec by name ("json", "orjson" or "binary"). Consumers
+call decode() which works out the format from the first byte, so services
+can read a topic that holds a mix of both while producers are switched over.
+
+Binary layout (schema encoding, no field names on the wire):
+
+    byte 0      version (BINARY_VERSION)
+    byte 1      event type code (see EVENT_TYPES)
+    trace       received and produced stamps (int64 unix ns, 0 when
+                missing), version 2 and later
+    fixed part  latitude, longitude (float64), trace_id (int64) and one
+                uint16 length per string field (0xFFFF marks a null value,
+                so strings take at most MAX_STRING_BYTES), little-endian
+    strings     utf-8 bytes of the envelope datetime then the payload
+                string fields, in schema order
+"""
+import json
+import struct
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the stdlib
+    orjson = None
+
+BINARY_VERSION = 2
+NULL_LENGTH = 0xFFFF
+MAX_STRING_BYTES = NULL_LENGTH - 1
+
+# type code -> (event type, payload string fields in wire order)
+EVENT_TYPES = {
+    1: ("TrackGPS", ("device_id", "location_name", "timestamp")),
+    2: ("TrackAlerts", ("device_id", "location_name", "alert_desc", "timestamp")),
+}
+TYPE_CODES = {name: code for code, (name, _) in EVENT_TYPES.items()}
+
+
+class DecodeError(ValueError):
+    """ Raised when a message cannot be decoded by any codec """
+
+
+class EncodeError(ValueError):
+    """ Raised when a message does not fit the codec's format """
+
+
+_HEADER = struct.Struct("<BB")
+_TRACE = struct.Struct("<qq")
+# per type: latitude, longitude, trace_id and one length per string field
+_BODIES = {
+    code: struct.Struct("<ddq" + "H" * (len(fields) + 1))
+    for code, (_, fields) in EVENT_TYPES.items()
+}
+
+
+class JsonCodec:
+    """ Stdlib json, the format every service used before codecs existed """
+    name = "json"
+
+    def encode(self, msg):
+        return json.dumps(msg).encode("utf-8")
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    """ Same JSON on the wire, encoded and parsed by orjson """
+    name = "orjson"
+
+    def encode(self, msg):
+        return orjson.dumps(msg)
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class BinaryCodec:
+    """ Compact schema encoding for TrackGPS and TrackAlerts messages """
+    name = "binary"
+
+    def encode(self, msg):
+        code = TYPE_CODES[msg["type"]]
+        payload = msg["payload"]
+        strings = [_encode_string(msg["datetime"])]
+        strings.extend(_encode_string(payload.get(field)) for field in EVENT_TYPES[code][1])
+
+        head = _BODIES[code].pack(
+            payload["latitude"], payload["longitude"], payload["trace_id"],
+            *[NULL_LENGTH if raw is None else len(raw) for raw in strings]
+        )
+        trace = msg.get("trace") or {}
+        return b"".join([
+            _HEADER.pack(BINARY_VERSION, code),
+            _TRACE.pack(trace.get("received", 0), trace.get("produced", 0)),
+            head, *filter(None, strings)
+        ])
+
+    def decode(self, data):
+        version, code = _HEADER.unpack_from(data, 0)
+        if version not in (1, 2):
+            raise ValueError(f"Unsupported binary message version {version}")
+        event_type, fields = EVENT_TYPES[code]
+        body = _BODIES[code]
+
+        pos = _HEADER.size
+        trace = None
+        if version >= 2:
+            received, produced = _TRACE.unpack_from(data, pos)
+            pos += _TRACE.size
+            if received or produced:
+                trace = {"received": received, "produced": produced}
+
+        latitude, longitude, trace_id, *lengths = body.unpack_from(data, pos)
+        pos += body.size
+        values = []
+        for length in lengths:
+            if length == NULL_LENGTH:
+                values.append(None)
+                continue
+            end = pos + length
+            values.append(str(data[pos:end], "utf-8"))
+            pos = end
+
+        payload = dict(zip(fields, values[1:]))
+        payload["latitude"] = latitude
+        payload["longitude"] = longitude
+        payload["trace_id"] = trace_id
+        msg = {"type": event_type, "datetime": values[0], "payload": payload}
+        if trace is not None:
+            msg["trace"] = trace
+        return msg
+
+
+def _encode_string(value):
+    if value is None:
+        return None
+    raw = value.encode("utf-8")
+    if len(raw) > MAX_STRING_BYTES:
+        raise EncodeError(f"String of {len(raw)} bytes, the binary codec takes at most {MAX_STRING_BYTES}")
+    return raw
+
+
+_json_codec = OrjsonCodec() if orjson is not None else JsonCodec()
+_binary_codec = BinaryCodec()
+
+CODECS = {
+    "json": JsonCodec,
+    "orjson": OrjsonCodec,
+    "binary": BinaryCodec,
+}
+
+
+def get_codec(name):
+    """ Returns the codec registered under name, orjson falls back to json if missing """
+    if name not in CODECS:
+        raise ValueError(f"Unknown message codec '{name}'")
+    if name == "orjson" and orjson is None:
+        return JsonCodec()
+    return CODECS[name]()
+
+
+def decode(data):
+    """ Decodes a message produced by any codec """
+    try:
+        if data[:1] == b"{":
+            return _json_codec.decode(data)
+        return _binary_codec.decode(data)
+    except (ValueError, KeyError, struct.error) as e:
+        raise DecodeError(str(e)) from e
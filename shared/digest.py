@@ -0,0 +1,135 @@
+"""
+Digests of trace ids per time bucket, to find the events two tiers disagree on
+without sending every event across.
+
+A bucket covers bucket_seconds of receive time, read from the trace ids, so
+storage and the queue put an event in the same bucket. Its digest is the
+number of ids and the XOR of their hashes: the same ids give the same digest,
+a missing, extra or swapped id changes it. Ids are hashed first because they
+are nearly sequential, the plain XOR of a run of them is often 0.
+
+    GET /<service>/digests?bucket_seconds=86400[&start_ms=..&end_ms=..]
+        [{"start_ms": bucket start, "count": n, "xor": x}, ...]
+    GET /<service>/events?start_ms=..&end_ms=..[&start_ms=..&end_ms=..]
+        {"gps": [...], "alerts": [...]} received in any of the [start_ms, end_ms)
+
+Storage and the analyzer keep a BucketDigests of digests.bucket_seconds
+buckets, updated as they store or consume events, and answer /digests by
+merging them: XOR and counts of wider buckets are those of the buckets they
+hold. bucket_seconds, start_ms and end_ms have to fall on bucket bounds.
+
+The consistency check compares day buckets, then the hours of the days that
+differ, and reads the events of the hours that still differ in one request
+per side.
+"""
+from bisect import bisect_right
+
+from shared.ids import trace_id_ms, trace_id_range
+
+
+MASK = (1 << 63) - 1
+
+
+def id_hash(trace_id):
+    """ splitmix64 finalizer of trace_id, kept to 63 bits to fit a signed int64 """
+    x = (trace_id + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return (x ^ (x >> 31)) & MASK
+
+
+def digests(trace_ids, bucket_seconds):
+    """ Digest list of trace_ids, sorted by bucket """
+    bucket_ms = bucket_seconds * 1000
+    buckets = {}
+    for trace_id in trace_ids:
+        start_ms = trace_id_ms(trace_id) // bucket_ms * bucket_ms
+        count, xor = buckets.get(start_ms, (0, 0))
+        buckets[start_ms] = (count + 1, xor ^ id_hash(trace_id))
+    return [
+        {"start_ms": start_ms, "count": count, "xor": xor}
+        for start_ms, (count, xor) in sorted(buckets.items())
+    ]
+
+
+class BucketDigests:
+    """ count and XOR of id hashes per bucket_seconds bucket, kept up to date one id at a time """
+
+    def __init__(self, bucket_seconds=3600, buckets=None):
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets if buckets is not None else {}  # start_ms -> [count, xor]
+
+    def bucket(self, trace_id):
+        bucket_ms = self.bucket_seconds * 1000
+        return trace_id_ms(trace_id) // bucket_ms * bucket_ms
+
+    def add(self, trace_id):
+        start_ms = self.bucket(trace_id)
+        digest = self.buckets.setdefault(start_ms, [0, 0])
+        digest[0] += 1
+        digest[1] ^= id_hash(trace_id)
+
+    def aligned(self, bucket_seconds, start_ms=None, end_ms=None):
+        """ Whether digests of bucket_seconds in the range can be merged from these buckets """
+        bucket_ms = self.bucket_seconds * 1000
+        return bucket_seconds > 0 and bucket_seconds % self.bucket_seconds == 0 and all(
+            bound is None or bound % bucket_ms == 0 for bound in (start_ms, end_ms)
+        )
+
+    def rollup(self, bucket_seconds, start_ms=None, end_ms=None):
+        """ Digest list of bucket_seconds buckets in [start_ms, end_ms), sorted by bucket """
+        bucket_ms = bucket_seconds * 1000
+        merged = {}
+        for start, (count, digest) in self.buckets.items():
+            if (start_ms is not None and start < start_ms) or (end_ms is not None and start >= end_ms):
+                continue
+            wide = start // bucket_ms * bucket_ms
+            total, wide_digest = merged.get(wide, (0, 0))
+            merged[wide] = (total + count, wide_digest ^ digest)
+        return [
+            {"start_ms": start, "count": count, "xor": digest}
+            for start, (count, digest) in sorted(merged.items()) if count
+        ]
+
+    def to_json(self):
+        return {"bucket_seconds": self.bucket_seconds, "buckets": [[start, *digest] for start, digest in self.buckets.items()]}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["bucket_seconds"], {start: [count, digest] for start, count, digest in data["buckets"]})
+
+
+def digests_from_config(app_config):
+    return BucketDigests((app_config.get("digests") or {}).get("bucket_seconds", 3600))
+
+
+def differing(ours, theirs):
+    """ Start of every bucket whose digest is not the same in both lists """
+    ours = {bucket["start_ms"]: (bucket["count"], bucket["xor"]) for bucket in ours}
+    theirs = {bucket["start_ms"]: (bucket["count"], bucket["xor"]) for bucket in theirs}
+    return sorted(start_ms for start_ms in ours.keys() | theirs.keys() if ours.get(start_ms) != theirs.get(start_ms))
+
+
+def in_range(trace_id, start_ms=None, end_ms=None):
+    """ Whether trace_id was received in [start_ms, end_ms), open ends when None """
+    ms = trace_id_ms(trace_id)
+    return (start_ms is None or ms >= start_ms) and (end_ms is None or ms < end_ms)
+
+
+class Ranges:
+    """ Sorted, non overlapping [start_ms, end_ms) ranges, to test many ids against """
+
+    def __init__(self, ranges):
+        self.ranges = sorted(ranges)
+        self.starts = [start_ms for start_ms, _ in self.ranges]
+
+    def __contains__(self, trace_id):
+        ms = trace_id_ms(trace_id)
+        i = bisect_right(self.starts, ms) - 1
+        return i >= 0 and ms < self.ranges[i][1]
+
+
+def id_bounds(start_ms=None, end_ms=None):
+    """ (lowest, first excluded) trace id of the range, None for an open end """
+    low, high = trace_id_range(start_ms or 0, end_ms or 0)
+    return (low if start_ms is not None else None), (high if end_ms is not None else None)
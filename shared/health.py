@@ -0,0 +1,105 @@
+"""
+Liveness, readiness and background connection of a service's dependencies.
+
+A service registers what it needs before it can serve traffic, e.g. the
+Kafka producer or the database engine, with a connect function:
+
+    health = Health(logger)
+    kafka = health.dependency("kafka", connect_producer)
+
+health.start() connects every dependency on its own thread, retrying until
+it succeeds, so the process accepts requests right after it starts. Until
+then kafka.value is None and the handlers answer with an error. A connect
+function raises DependencyFailed when retrying cannot help, e.g. a database
+that needs a migration: the dependency stops retrying and readiness reports
+the error.
+
+    GET /<service>/health/live   200 while the process serves requests
+    GET /<service>/health/ready  200 once every dependency is connected, 503 before
+"""
+import contextlib
+import threading
+import time
+
+
+class DependencyFailed(Exception):
+    """ Raised by a connect function for errors retrying will not fix """
+
+
+class Dependency:
+    def __init__(self, name, connect, retry_seconds, logger):
+        self.name = name
+        self.connect = connect
+        self.retry_seconds = retry_seconds
+        self.logger = logger
+        self.value = None
+        self.error = None
+        self.ready = threading.Event()
+
+    def run(self):
+        attempts = 0
+        while not self.ready.is_set():
+            attempts += 1
+            try:
+                self.value = self.connect()
+                self.error = None
+                self.ready.set()
+                self.logger.info("%s connected after %d attempt(s)", self.name, attempts)
+            except DependencyFailed as e:
+                self.error = str(e)
+                self.logger.critical("%s failed, not retrying: %s", self.name, e)
+                return
+            except Exception as e:
+                self.error = str(e)
+                self.logger.error("%s not ready (attempt %d): %s", self.name, attempts, e)
+                time.sleep(self.retry_seconds)
+
+    def wait(self, timeout=None):
+        """ Value once connected, None if timeout passed first """
+        self.ready.wait(timeout)
+        return self.value
+
+
+class Health:
+    def __init__(self, logger):
+        self.logger = logger
+        self.dependencies = {}
+        self.started_at = time.monotonic()
+        self._started = False
+        self._lock = threading.Lock()
+
+    def dependency(self, name, connect, retry_seconds=5):
+        dependency = Dependency(name, connect, retry_seconds, self.logger)
+        self.dependencies[name] = dependency
+        return dependency
+
+    def start(self):
+        """ Connects the dependencies in the background, only the first call does anything """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for dependency in self.dependencies.values():
+            thread = threading.Thread(target=dependency.run, name=f"connect-{dependency.name}", daemon=True)
+            thread.start()
+
+    @contextlib.asynccontextmanager
+    async def lifespan(self, app):
+        """ connexion lifespan handler, connects once the server started """
+        self.start()
+        yield
+
+    def is_ready(self):
+        return all(dependency.ready.is_set() for dependency in self.dependencies.values())
+
+    def liveness(self):
+        return {"status": "alive", "uptime_seconds": round(time.monotonic() - self.started_at, 3)}, 200
+
+    def readiness(self):
+        dependencies = {
+            name: {"ready": dependency.ready.is_set(), "error": dependency.error}
+            for name, dependency in self.dependencies.items()
+        }
+        if self.is_ready():
+            return {"status": "ready", "dependencies": dependencies}, 200
+        return {"status": "starting", "dependencies": dependencies}, 503
@@ -0,0 +1,89 @@
+"""
+Snowflake style 64-bit trace ids.
+
+    bit 63      always 0, ids fit a signed BIGINT
+    bits 22-62  milliseconds since EPOCH_MS (about 69 years)
+    bits 12-21  replica id (0-1023)
+    bits 0-11   sequence within the millisecond (0-4095)
+
+Ids from one replica are unique and increasing. The hot path is a single
+next() on an itertools.count, which is atomic under the GIL, so no lock is
+taken per id. The counter holds (milliseconds << 12 | sequence): under load
+it simply runs ahead of the clock, and when traffic is idle it is moved
+forward to the current time so the timestamp bits stay meaningful.
+"""
+import itertools
+import os
+import socket
+import threading
+import time
+import zlib
+
+# 2025-01-01T00:00:00Z
+EPOCH_MS = 1735689600000
+
+SEQUENCE_BITS = 12
+REPLICA_BITS = 10
+TIMESTAMP_SHIFT = SEQUENCE_BITS + REPLICA_BITS
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+MAX_REPLICA_ID = (1 << REPLICA_BITS) - 1
+
+
+def _now_ms():
+    return time.time_ns() // 1_000_000 - EPOCH_MS
+
+
+def default_replica_id():
+    """
+    Replica id from REPLICA_ID, otherwise the low bits of the container's IPv4
+    address, which are distinct for containers on the same network
+    """
+    if "REPLICA_ID" in os.environ:
+        return int(os.environ["REPLICA_ID"]) & MAX_REPLICA_ID
+    hostname = socket.gethostname()
+    try:
+        address = socket.inet_aton(socket.gethostbyname(hostname))
+        return int.from_bytes(address, "big") & MAX_REPLICA_ID
+    except OSError:
+        return zlib.crc32(hostname.encode("utf-8")) & MAX_REPLICA_ID
+
+
+class TraceIdGenerator:
+    """ Generates unique trace ids for one replica """
+
+    def __init__(self, replica_id=None, max_lag_ms=1000):
+        if replica_id is None:
+            replica_id = default_replica_id()
+        if not 0 <= replica_id <= MAX_REPLICA_ID:
+            raise ValueError(f"replica_id must be between 0 and {MAX_REPLICA_ID}")
+        self.replica_id = replica_id
+        self.max_lag_ms = max_lag_ms
+        self._replica_bits = replica_id << SEQUENCE_BITS
+        self._counter = itertools.count(_now_ms() << SEQUENCE_BITS)
+        self._resync_lock = threading.Lock()
+
+    def next_id(self):
+        counter = self._counter
+        value = next(counter)
+        ms = value >> SEQUENCE_BITS
+
+        if _now_ms() - ms > self.max_lag_ms:
+            # Clock moved well past the counter while idle: restart the counter
+            # at the current time. Ids already taken from the old counter are
+            # all below the new start, so nothing repeats.
+            with self._resync_lock:
+                if self._counter is counter:
+                    self._counter = itertools.count(_now_ms() << SEQUENCE_BITS)
+            return self.next_id()
+
+        return (ms << TIMESTAMP_SHIFT) | self._replica_bits | (value & SEQUENCE_MASK)
+
+
+def trace_id_ms(trace_id):
+    """ Unix time in milliseconds encoded in a trace id """
+    return (trace_id >> TIMESTAMP_SHIFT) + EPOCH_MS
+
+
+def trace_id_range(start_ms, end_ms):
+    """ Smallest and first-excluded trace id for unix milliseconds [start_ms, end_ms) """
+    return (start_ms - EPOCH_MS) << TIMESTAMP_SHIFT, (end_ms - EPOCH_MS) << TIMESTAMP_SHIFT
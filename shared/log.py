@@ -0,0 +1,160 @@
+"""
+Logging setup shared by the services.
+
+configure_logging() applies config/shared/log_conf.yml. With `queue.enabled`
+set, the handlers configured for each logger are moved behind a
+QueueHandler: the request or consumer thread only enqueues the record and a
+QueueListener thread formats it and writes the console and log file.
+
+Per-event lines go through get_event_logger(), sampled at the rate given
+for that logger name in the `sampling` section.
+
+With several worker processes (shared/serve.py) only the supervising
+process writes the console and the log file, so a rotation never races
+another process. The workers replace their handlers with one SocketHandler
+to a unix socket in the directory shared/peers.py creates, and
+serve_worker_logs() hands what arrives there to the supervisor's handlers.
+"""
+import atexit
+import itertools
+import logging
+import logging.config
+import logging.handlers
+import os
+import pickle
+import queue
+import socketserver
+import struct
+import threading
+
+import yaml
+
+from shared import peers
+
+WORKER_LOG_SOCKET = "log.sock"
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread. The stock
+    prepare() formats the message on the calling thread, which is the cost
+    we want off the hot path. Log arguments must not be mutated after the
+    call, which holds for the ids, counts and decoded messages we log.
+    """
+
+    dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        # When the listener falls behind, drop records instead of blocking the caller
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SampledLogger:
+    """
+    Logger for per-event lines that keeps one call in `rate`. The check runs
+    before a LogRecord is built, so dropped lines cost almost nothing.
+    Warnings and errors are never sampled away.
+    """
+
+    def __init__(self, logger, rate=1):
+        self.logger = logger
+        self.rate = max(int(rate), 1)
+        self._counter = itertools.count()
+
+    def _sampled(self, level, msg, args, kwargs):
+        if next(self._counter) % self.rate == 0 and self.logger.isEnabledFor(level):
+            self.logger._log(level, msg, args, **kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        self._sampled(logging.DEBUG, msg, args, kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self._sampled(logging.INFO, msg, args, kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.logger.warning(msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self.logger.error(msg, *args, **kwargs)
+
+
+_sample_rates = {}
+
+
+def get_event_logger(name):
+    """ SampledLogger for name, with the rate from the `sampling` section of the log config """
+    return SampledLogger(logging.getLogger(name), _sample_rates.get(name, 1))
+
+
+def configure_logging(path):
+    with open(path, "r", encoding="utf-8") as f:
+        log_config = yaml.safe_load(f.read())
+
+    queue_config = log_config.pop("queue", None) or {}
+    _sample_rates.update(log_config.pop("sampling", None) or {})
+    logging.config.dictConfig(log_config)
+
+    if peers.is_worker():
+        _send_to_supervisor(log_config)
+
+    if queue_config.get("enabled"):
+        _use_queue_handlers(log_config, queue_config.get("maxsize", 10000))
+
+
+def _configured_loggers(log_config):
+    loggers = [logging.getLogger(name) for name in log_config.get("loggers", {})]
+    loggers.append(logging.getLogger())
+    return loggers
+
+
+def _send_to_supervisor(log_config):
+    """ Sends the records of a worker process to the supervising one, which writes them """
+    handler = logging.handlers.SocketHandler(os.path.join(peers.directory(), WORKER_LOG_SOCKET), None)
+    for logger in _configured_loggers(log_config):
+        if logger.handlers:
+            logger.handlers = [handler]
+
+
+class _WorkerRecords(socketserver.StreamRequestHandler):
+    """ Length-prefixed pickled records, as a SocketHandler sends them """
+
+    def handle(self):
+        while True:
+            header = self.rfile.read(4)
+            if len(header) < 4:
+                return
+            data = self.rfile.read(struct.unpack(">L", header)[0])
+            record = logging.makeLogRecord(pickle.loads(data))
+            logging.getLogger(None if record.name == "root" else record.name).handle(record)
+
+
+def serve_worker_logs():
+    """ Writes the records of the worker processes with this process' handlers, before they start """
+    # mkdtemp makes the directory private to the service's user, only its processes can send records
+    server = socketserver.ThreadingUnixStreamServer(
+        os.path.join(peers.directory(), WORKER_LOG_SOCKET), _WorkerRecords
+    )
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="worker-logs", daemon=True).start()
+
+
+def _use_queue_handlers(log_config, maxsize):
+    """ Gives every distinct set of handlers its own queue and listener thread """
+    queue_handlers = {}
+    for logger in _configured_loggers(log_config):
+        if not logger.handlers:
+            continue
+        handlers = tuple(logger.handlers)
+        if handlers not in queue_handlers:
+            log_queue = queue.Queue(maxsize)
+            listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+            queue_handlers[handlers] = DeferredQueueHandler(log_queue)
+        logger.handlers = [queue_handlers[handlers]]
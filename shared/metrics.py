@@ -0,0 +1,294 @@
+"""
+In-process metrics in the Prometheus text format.
+
+Services create their metrics at import time and expose them with
+render() on GET /<service>/metrics. Recording a value takes one lock and a
+couple of list updates, a few hundred nanoseconds per call.
+
+With several worker processes (shared/serve.py) each one shares a snapshot
+of its values through shared/peers.py, and render() adds those of the
+other processes to its own: counters and histograms count the events of
+every process, gauges are summed. The supervising process shares its own,
+so the metrics of the background work it runs show up on every worker.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from shared import peers
+
+CONTENT_TYPE = "text/plain"
+
+# seconds, 0.5 ms to 10 s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def labels(self, *values):
+        """ Child metric for one set of label values, cache it in hot paths """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def snapshot(self):
+        """ [label values, value] of every child, as JSON """
+        return [[[str(v) for v in values], self._value(child)] for values, child in list(self._children.items())]
+
+    def render(self, collected=()):
+        """ Text lines of the own values plus the snapshot() lists of other processes """
+        merged = {}
+        for values, value in self.snapshot():
+            merged[tuple(values)] = value
+        for snapshot in collected:
+            for values, value in snapshot:
+                key = tuple(values)
+                merged[key] = self._merge(merged[key], value) if key in merged else value
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, value in merged.items():
+            lines.extend(self._render_value(values, value))
+        return lines
+
+    def _merge(self, value, other):
+        return value + other
+
+    # Unlabelled metrics forward to their only child
+    def __getattr__(self, attr):
+        if attr.startswith("_") or self.labelnames:
+            raise AttributeError(attr)
+        return getattr(self._children[()], attr)
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _value(self, child):
+        return child.value
+
+    def _render_value(self, values, value):
+        return [f"{self.name}{self._label_text(values)} {value}"]
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """ Reads the value from function at scrape time, e.g. a queue size """
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def _value(self, child):
+        return child.get()
+
+    def _render_value(self, values, value):
+        return [f"{self.name}{self._label_text(values)} {value}"]
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """ Context manager observing the elapsed seconds """
+        return _Timer(self)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _value(self, child):
+        """ Bucket counts followed by the sum """
+        with child._lock:
+            return [*child.counts, child.sum]
+
+    def _merge(self, value, other):
+        return [a + b for a, b in zip(value, other)]
+
+    def _render_value(self, values, value):
+        counts, total = value[:-1], value[-1]
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            labels = self._label_text(values, [("le", bound)])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(values)} {total}")
+        lines.append(f"{self.name}_count{self._label_text(values)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in list(self._metrics.items())}
+
+    def render(self, collected=()):
+        lines = []
+        for name, metric in list(self._metrics.items()):
+            lines.extend(metric.render([snapshot[name] for snapshot in collected if name in snapshot]))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+peers.share("metrics", REGISTRY.snapshot)
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def render():
+    """ All registered metrics in the Prometheus text format, of every worker process """
+    return REGISTRY.render(peers.collected("metrics"))
+
+
+def metrics_response():
+    """ Connexion response for a GET /metrics operation """
+    return render(), 200, {"Content-Type": CONTENT_TYPE}
+
+
+REQUEST_LATENCY = histogram(
+    "http_request_duration_seconds",
+    "Request latency per OpenAPI operation",
+    ("operation_id", "method", "status"),
+)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording REQUEST_LATENCY. Add it with
+    MiddlewarePosition.BEFORE_SECURITY so connexion routing already filled in
+    the operation id.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        routing = scope.get("extensions", {}).get("connexion_routing", {})
+        operation_id = routing.get("operation_id") or "unmatched"
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_LATENCY.labels(operation_id, scope["method"], str(status[0])).observe(
+                time.perf_counter() - start
+            )
@@ -0,0 +1,124 @@
+"""
+Snapshots every process of a service publishes for the others while it
+serves with several workers (see shared/serve.py), so an answer from any
+worker can cover all of them.
+
+    share(name, snapshot)   snapshot() of this process is written every PUBLISH_SECONDS
+    collected(name)         snapshots the other live processes wrote under name
+    directory()             where they are written, None while the service runs in one process
+    is_worker()             True in a worker process started by serve()
+
+serve() creates the directory in the supervising process and hands it and
+its own pid to the workers it starts through the environment. A process
+writes its snapshots as JSON files named <name>.<pid>, replaced at once,
+from a daemon thread that starts with the first share() once there is a
+directory. Answers built from them are up to PUBLISH_SECONDS old for the
+other processes. Files of processes that exited are removed when they are
+collected: the counters of a worker that was restarted start again from 0,
+as they would for a restarted service.
+"""
+import atexit
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+DIRECTORY_ENV = "SERVE_SHARED_DIRECTORY"
+SUPERVISOR_ENV = "SERVE_SUPERVISOR_PID"
+PUBLISH_SECONDS = 1.0
+
+logger = logging.getLogger(__name__)
+
+_snapshots = {}
+_lock = threading.Lock()
+_publisher = None
+
+
+def directory():
+    return os.environ.get(DIRECTORY_ENV) or None
+
+
+def is_worker():
+    supervisor = os.environ.get(SUPERVISOR_ENV)
+    return supervisor is not None and int(supervisor) != os.getpid()
+
+
+def create():
+    """ Directory of a new set of workers, called by serve() before it starts them """
+    parent = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    path = tempfile.mkdtemp(prefix="serve-", dir=parent)
+    atexit.register(shutil.rmtree, path, ignore_errors=True)
+    os.environ[DIRECTORY_ENV] = path
+    os.environ[SUPERVISOR_ENV] = str(os.getpid())
+    _start_publisher()
+    return path
+
+
+def share(name, snapshot):
+    _snapshots[name] = snapshot
+    _start_publisher()
+
+
+def collected(name):
+    path = directory()
+    if path is None:
+        return []
+    snapshots = []
+    prefix = f"{name}."
+    for filename in os.listdir(path):
+        pid = filename[len(prefix):]
+        if not filename.startswith(prefix) or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        if not _alive(int(pid)):
+            _remove(os.path.join(path, filename))
+            continue
+        try:
+            with open(os.path.join(path, filename), "r", encoding="utf-8") as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # the process exited since the listing
+    return snapshots
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _start_publisher():
+    global _publisher
+    with _lock:
+        if _publisher is None and _snapshots and directory() is not None:
+            _publisher = threading.Thread(target=_publish_forever, name="peer-snapshots", daemon=True)
+            _publisher.start()
+
+
+def _publish_forever():
+    path = directory()
+    pid = os.getpid()
+    while True:
+        for name, snapshot in list(_snapshots.items()):
+            # Hidden temporary names are never collected
+            temporary = os.path.join(path, f".{name}.{pid}.tmp")
+            try:
+                with open(temporary, "w", encoding="utf-8") as f:
+                    json.dump(snapshot(), f)
+                os.replace(temporary, os.path.join(path, f"{name}.{pid}"))
+            except Exception as err:
+                logger.error("Could not publish the %s snapshot: %s", name, err)
+        time.sleep(PUBLISH_SECONDS)
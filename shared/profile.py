@@ -0,0 +1,124 @@
+"""
+On-demand sampling profiles and thread dumps of a running service.
+
+    GET /<service>/debug/profile?seconds=10&hz=100[&thread=kafka-worker]
+        Samples the stack of every thread of the process (the Kafka
+        consumers, schedulers and request threads alike) for `seconds`
+        and answers in the collapsed format of flamegraph.pl and
+        speedscope, one line per distinct stack:
+
+            kafka-worker-0;process_messages (storage/app.py);store_batch (storage/app.py) 412
+
+    GET /<service>/debug/threads
+        Name, state and current stack of every thread.
+
+Both need the X-Debug-Token header to match the DEBUG_TOKEN environment
+variable, and answer 404 when it is not set. Nothing runs between
+profiles: the request's own thread reads sys._current_frames() hz times
+a second while the profile lasts, and one profile runs at a time per
+process, so a profile covers the process that answered. With
+server.workers above 1 the scheduler or updater of a service runs in the
+supervising process, which serves the app on server.owner_port (see
+shared/serve.py): profile it there, e.g. analyzer:8111/analyzer/debug/profile.
+"""
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from connexion import request
+
+TOKEN_HEADER = "X-Debug-Token"
+
+
+def _frame_name(code):
+    directory, filename = os.path.split(code.co_filename)
+    return f"{code.co_name} ({os.path.basename(directory)}/{filename})"
+
+
+def _stack(frame):
+    """ Frame names from the outermost call to frame """
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+class Profiler:
+    def __init__(self, token=None, max_seconds=60, max_hz=1000):
+        self.token = token
+        self.max_seconds = max_seconds
+        self.max_hz = max_hz
+        self._running = threading.Lock()
+
+    def refused(self):
+        """ Error response unless the request carries the debug token, None if it does """
+        if not self.token:
+            return {"message": "Debug endpoints are disabled"}, 404
+        given = request.headers.get(TOKEN_HEADER, "")
+        if not hmac.compare_digest(given.encode("utf-8"), self.token.encode("utf-8")):
+            return {"message": f"Missing or wrong {TOKEN_HEADER} header"}, 403
+        return None
+
+    def profile(self, seconds=10, hz=100, thread=None):
+        """ Collapsed stacks of `seconds` of samples, None if a profile is already running """
+        seconds = min(seconds, self.max_seconds)
+        interval = 1 / min(hz, self.max_hz)
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            stacks = Counter()
+            own = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    name = names.get(ident, str(ident))
+                    if ident == own or (thread and thread not in name):
+                        continue
+                    stacks[";".join([name] + _stack(frame))] += 1
+                time.sleep(interval)
+        finally:
+            self._running.release()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def profile_response(self, seconds=10, hz=100, thread=None):
+        """ Connexion response for a GET /debug/profile operation """
+        refused = self.refused()
+        if refused:
+            return refused
+        collapsed = self.profile(seconds, hz, thread)
+        if collapsed is None:
+            return {"message": "A profile is already running"}, 409
+        return collapsed, 200, {"Content-Type": "text/plain"}
+
+    def threads_response(self):
+        """ Connexion response for a GET /debug/threads operation """
+        refused = self.refused()
+        if refused:
+            return refused
+        frames = sys._current_frames()
+        threads = [
+            {
+                "name": t.name,
+                "ident": t.ident,
+                "daemon": t.daemon,
+                "alive": t.is_alive(),
+                "stack": _stack(frames[t.ident]) if t.ident in frames else [],
+            }
+            for t in threading.enumerate()
+        ]
+        return threads, 200
+
+
+def profiler_from_config(app_config):
+    debug = app_config.get("debug") or {}
+    return Profiler(
+        os.environ.get("DEBUG_TOKEN"),
+        debug.get("max_seconds", 60),
+        debug.get("max_hz", 1000),
+    )
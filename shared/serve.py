@@ -0,0 +1,39 @@
+"""
+Serving a service's app in one process or several.
+
+    serve(app, port, app_config)   server.workers from the config, 1 by default
+
+With one worker the app runs in this process, as app.run() does. With more,
+uvicorn starts that many processes which each import app:app and share the
+port, and this process only supervises them. Whatever the service started
+before calling serve() keeps running here, once, whatever the number of
+workers: that is where a service runs the updater of its SharedState.
+
+So that the background work stays observable, the supervising process
+- shares its metrics and slow traces with the workers (shared/peers.py),
+  which add them to their own on /metrics and /traces/slow,
+- is the only process writing the log file, the workers send it their
+  records (shared/log.py),
+- serves the app itself on server.owner_port when it is set, which is
+  where /debug/profile and /debug/threads sample the background work.
+"""
+import threading
+
+import uvicorn
+
+from shared import peers
+from shared.log import serve_worker_logs
+
+
+def serve(app, port, app_config):
+    server = app_config.get("server") or {}
+    workers = server.get("workers", 1)
+    if workers > 1:
+        peers.create()
+        serve_worker_logs()
+        if server.get("owner_port"):
+            owner = uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=server["owner_port"]))
+            threading.Thread(target=owner.run, name="owner-server", daemon=True).start()
+        uvicorn.run("app:app", host="0.0.0.0", port=port, workers=workers)
+    else:
+        app.run(port=port, host="0.0.0.0")
@@ -0,0 +1,93 @@
+"""
+State one process of a service publishes for all of its workers to read,
+through an mmap'd file (under /dev/shm in the containers, so it stays in
+memory).
+
+    state = SharedState(path)
+    state.publish(value)   the updater, any JSON value
+    state.version()        grows with every publish, 0 before the first one
+    state.read()           (version, value), value is None before the first publish
+
+The file holds a sequence number, the body length and the JSON body.
+publish() is a seqlock write: the sequence turns odd, the length and body
+are written, the sequence turns even again. A reader copies the body and
+tries again if the sequence was odd or moved during the copy, so readers
+never block the updater and never see half a body. Each process decodes
+a body once per version.
+
+Only one process may publish to a file.
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+SEQUENCE = struct.Struct("<Q")
+LENGTH = struct.Struct("<Q")
+BODY_OFFSET = SEQUENCE.size + LENGTH.size
+READ_ATTEMPTS = 1000
+
+
+class SharedState:
+    def __init__(self, path, size=1 << 20):
+        self.path = path
+        self.size = size
+        self._map = None
+        self._lock = threading.Lock()
+        self._decoded = (0, None)  # sequence, value
+
+    def _mapped(self):
+        if self._map is None:
+            with self._lock:
+                if self._map is None:
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                    try:
+                        if os.fstat(fd).st_size < self.size:
+                            os.ftruncate(fd, self.size)
+                        self._map = mmap.mmap(fd, self.size)
+                    finally:
+                        os.close(fd)
+        return self._map
+
+    def publish(self, value):
+        body = json.dumps(value).encode("utf-8")
+        if BODY_OFFSET + len(body) > self.size:
+            raise ValueError(f"State of {len(body)} bytes does not fit in {self.path}")
+        state = self._mapped()
+        with self._lock:
+            sequence = SEQUENCE.unpack_from(state, 0)[0]
+            # Odd if a publisher died halfway, that write is never completed
+            writing = sequence + 1 if sequence % 2 == 0 else sequence
+            SEQUENCE.pack_into(state, 0, writing)
+            LENGTH.pack_into(state, SEQUENCE.size, len(body))
+            state[BODY_OFFSET:BODY_OFFSET + len(body)] = body
+            SEQUENCE.pack_into(state, 0, writing + 1)
+
+    def version(self):
+        return SEQUENCE.unpack_from(self._mapped(), 0)[0] // 2
+
+    def read(self):
+        state = self._mapped()
+        for _ in range(READ_ATTEMPTS):
+            sequence = SEQUENCE.unpack_from(state, 0)[0]
+            if sequence % 2:
+                time.sleep(0)  # being written
+                continue
+            decoded = self._decoded
+            if sequence == decoded[0]:
+                return sequence // 2, decoded[1]
+            length = LENGTH.unpack_from(state, SEQUENCE.size)[0]
+            body = state[BODY_OFFSET:BODY_OFFSET + length]
+            if SEQUENCE.unpack_from(state, 0)[0] == sequence:
+                self._decoded = (sequence, json.loads(body) if length else None)
+                return sequence // 2, self._decoded[1]
+        # The publisher stopped in the middle of a write, keep the last value
+        decoded = self._decoded
+        return decoded[0] // 2, decoded[1]
+
+
+def state_from_config(app_config, default_path):
+    server = app_config.get("server") or {}
+    return SharedState(server.get("state_file", default_path), server.get("state_size", 1 << 20))
@@ -0,0 +1,83 @@
+"""
+Per-stage latency of events, keyed by trace_id.
+
+The receiver stamps `received` and `produced` (unix ns) into the message
+envelope under "trace". Each service that handles the event turns the
+stamps it can see into stage durations and hands them to its Tracer:
+
+    receive   receiver: request received -> handed to the producer
+    produce   receiver: handed to the producer -> broker acknowledged
+    queue     storage: handed to the producer -> consumed
+    commit    storage: consumed -> database commit
+    stats     processing: received (from the trace id) -> statistics updated
+
+Durations go into one histogram per stage. Events whose stages add up to more
+than the slow threshold are kept in a small per-process sample, served on
+GET /<service>/traces/slow together with the samples the other worker
+processes share (shared/peers.py).
+"""
+import threading
+import time
+from collections import deque
+
+from shared import peers
+from shared.metrics import histogram
+
+STAGE_LATENCY = histogram(
+    "trace_stage_duration_seconds",
+    "Event latency per pipeline stage",
+    ("stage",),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+
+def stamp(msg, **stamps):
+    """ Adds unix ns stamps to the message envelope """
+    msg.setdefault("trace", {}).update(stamps)
+
+
+class Tracer:
+    def __init__(self, slow_threshold_ms=500, slow_samples=100):
+        self.slow_threshold = slow_threshold_ms / 1000
+        self._slow = deque(maxlen=slow_samples)
+        self._lock = threading.Lock()
+        self._stages = {}
+        peers.share("slow_traces", self.sampled)
+
+    def sampled(self):
+        with self._lock:
+            return list(self._slow)
+
+    def record(self, trace_id, stages):
+        """ Records stage durations in seconds for one event """
+        total = 0.0
+        for stage, seconds in stages.items():
+            if seconds < 0:
+                continue  # clocks or stamps we cannot trust
+            child = self._stages.get(stage)
+            if child is None:
+                child = self._stages.setdefault(stage, STAGE_LATENCY.labels(stage))
+            child.observe(seconds)
+            total += seconds
+
+        if total >= self.slow_threshold:
+            with self._lock:
+                self._slow.append({
+                    "trace_id": trace_id,
+                    "total_ms": round(total * 1000, 3),
+                    "stages_ms": {stage: round(seconds * 1000, 3) for stage, seconds in stages.items()},
+                    "recorded_at": time.time(),
+                })
+
+    def slow_traces(self, limit=20):
+        """ Slowest of the recently sampled slow traces, of every worker process """
+        traces = self.sampled()
+        for sampled in peers.collected("slow_traces"):
+            traces.extend(sampled)
+        traces.sort(key=lambda trace: trace["total_ms"], reverse=True)
+        return traces[:limit]
+
+
+def tracer_from_config(app_config):
+    tracing = app_config.get("tracing") or {}
+    return Tracer(tracing.get("slow_threshold_ms", 500), tracing.get("slow_samples", 100))
@@ -0,0 +1,397 @@
+"""
+Access to the events topic, on Kafka or in memory.
+
+get_transport(app_config["events"]) picks the backend from `events.backend`:
+
+    kafka   (default) pykafka against events.hostname:events.port
+    memory  a topic held in this process, shared by every service loaded in it
+
+Both hand out the same few objects the services need:
+
+    transport.topic().producer(batched)          produce(value, partition_key), produce_batch(messages)
+    transport.topic().group_consumer(group, ms)  consume(), commit_offsets(), held_offsets, stop()
+    transport.topic().follow_consumer(ms, held)  consume() from the start of the topic, or after the
+                                                 held_offsets of an earlier consumer, on
+    transport.topic().scan_consumer(ms)          iterate the topic from the start
+    transport.topic().latest_offsets()           {partition id: next offset}
+
+Messages have .value, .partition_id and .offset. The memory backend keeps
+offsets and committed group offsets per partition like Kafka does, so the
+services run unchanged on it for benchmarks and profiling.
+
+AsyncProducer(producer) lets coroutines produce through a producer running
+on its own thread, `await async_producer.produce(value, partition_key)`.
+"""
+import asyncio
+import itertools
+import queue
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+Message = namedtuple("Message", ("value", "partition_id", "offset"))
+
+
+def get_transport(events_config):
+    backend = events_config.get("backend", "kafka")
+    if backend == "kafka":
+        return KafkaTransport(f"{events_config['hostname']}:{events_config['port']}", events_config["topic"])
+    if backend == "memory":
+        return MemoryTransport(events_config["topic"], events_config.get("partitions", 6))
+    raise ValueError(f"Unknown events backend '{backend}'")
+
+
+class KafkaTransport:
+    def __init__(self, hosts, topic_name):
+        self.hosts = hosts
+        self.topic_name = topic_name.encode("utf-8")
+
+    def _client(self):
+        from pykafka import KafkaClient
+        return KafkaClient(hosts=self.hosts)
+
+    def has_topic(self):
+        return self.topic_name in self._client().topics
+
+    def topic(self):
+        """ Topic handle on a new client connection """
+        return KafkaTopic(self._client().topics[self.topic_name])
+
+
+class KafkaTopic:
+    def __init__(self, topic):
+        self.topic = topic
+
+    def producer(self, batched=False):
+        """
+        Producer that returns once the broker acknowledged. A batched one
+        sends everything given to produce_batch together and then waits for
+        the delivery reports, instead of one round trip per message.
+        """
+        from pykafka.partitioners import hashing_partitioner
+        # Hash on the key so every event of a device lands on the same partition
+        if batched:
+            producer = self.topic.get_producer(
+                partitioner=hashing_partitioner, delivery_reports=True, linger_ms=5
+            )
+            return KafkaProducer(producer, delivery_reports=True)
+        return KafkaProducer(self.topic.get_sync_producer(partitioner=hashing_partitioner))
+
+    def group_consumer(self, group, timeout_ms):
+        from pykafka.common import OffsetType
+        return self.topic.get_balanced_consumer(
+            consumer_group=group,
+            managed=True,
+            auto_commit_enable=False,
+            reset_offset_on_start=False,
+            auto_offset_reset=OffsetType.LATEST,
+            consumer_timeout_ms=timeout_ms,
+        )
+
+    def follow_consumer(self, timeout_ms, held_offsets=None):
+        from pykafka.common import OffsetType
+        consumer = self.topic.get_simple_consumer(
+            reset_offset_on_start=True,
+            auto_offset_reset=OffsetType.EARLIEST,
+            consumer_timeout_ms=timeout_ms,
+        )
+        if held_offsets:
+            # pykafka resets to the last consumed offset, as held_offsets reports it.
+            # -1 (nothing consumed yet) would read as OffsetType.LATEST, skipping the partition
+            partitions = consumer.partitions
+            consumer.reset_offsets([
+                (partitions[partition_id], offset if offset >= 0 else OffsetType.EARLIEST)
+                for partition_id, offset in held_offsets.items() if partition_id in partitions
+            ])
+        return consumer
+
+    def scan_consumer(self, timeout_ms):
+        return self.topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=timeout_ms)
+
+    def latest_offsets(self):
+        return {
+            partition_id: offsets.offset[0]
+            for partition_id, offsets in self.topic.latest_available_offsets().items()
+        }
+
+
+class KafkaProducer:
+    def __init__(self, producer, delivery_reports=False):
+        self.producer = producer
+        self.delivery_reports = delivery_reports
+
+    def produce(self, value, partition_key=None):
+        if self.delivery_reports:
+            self.produce_batch(((value, partition_key),))
+        else:
+            self.producer.produce(value, partition_key=partition_key)
+
+    def produce_batch(self, messages):
+        """ Produces (value, partition_key) pairs, returns when all were acknowledged """
+        for value, partition_key in messages:
+            self.producer.produce(value, partition_key=partition_key)
+        if not self.delivery_reports:
+            return
+        # Reports are queued per producing thread, all of these are ours
+        error = None
+        for _ in messages:
+            _, exc = self.producer.get_delivery_report(block=True)
+            if exc is not None and error is None:
+                error = exc
+        if error is not None:
+            raise error
+
+
+_memory_topics = {}
+_memory_topics_lock = threading.Lock()
+
+
+class MemoryTransport:
+    def __init__(self, topic_name, partitions=6):
+        with _memory_topics_lock:
+            if topic_name not in _memory_topics:
+                _memory_topics[topic_name] = MemoryTopic(partitions)
+            self._topic = _memory_topics[topic_name]
+
+    def has_topic(self):
+        return True
+
+    def topic(self):
+        return self._topic
+
+
+class MemoryTopic:
+    """ Partitioned append-only log with committed offsets per consumer group """
+
+    def __init__(self, partitions=6):
+        self.partitions = [[] for _ in range(partitions)]
+        self.committed = {}  # group -> {partition id: next offset}
+        self.members = {}  # group -> [consumer]
+        self.generations = {}  # group -> bumped on every join and leave
+        self.changed = threading.Condition()
+        self._round_robin = itertools.count()
+
+    def _partition_for(self, partition_key):
+        if partition_key is None:
+            return next(self._round_robin) % len(self.partitions)
+        return zlib.crc32(partition_key) % len(self.partitions)
+
+    def append(self, messages):
+        with self.changed:
+            for value, partition_key in messages:
+                self.partitions[self._partition_for(partition_key)].append(value)
+            self.changed.notify_all()
+
+    def producer(self, batched=False):
+        return MemoryProducer(self)
+
+    def group_consumer(self, group, timeout_ms):
+        return MemoryGroupConsumer(self, group, timeout_ms)
+
+    def follow_consumer(self, timeout_ms, held_offsets=None):
+        consumer = MemoryConsumer(self, None, start=0, timeout_ms=timeout_ms)
+        for partition_id, offset in (held_offsets or {}).items():
+            if partition_id in consumer.positions:
+                consumer.positions[partition_id] = offset + 1
+        return consumer
+
+    def scan_consumer(self, timeout_ms):
+        # Nothing is in flight in memory, the scan ends at the offsets seen now
+        # instead of waiting timeout_ms for more
+        return MemoryConsumer(self, None, start=0, timeout_ms=timeout_ms, stop_at=self.latest_offsets())
+
+    def latest_offsets(self):
+        with self.changed:
+            return {partition_id: len(messages) for partition_id, messages in enumerate(self.partitions)}
+
+    def join(self, group, consumer):
+        with self.changed:
+            # A new group starts at the latest offsets as of now, members that
+            # take over a partition before the first commit resume from there
+            if group not in self.committed:
+                self.committed[group] = {p: len(messages) for p, messages in enumerate(self.partitions)}
+            self.members.setdefault(group, []).append(consumer)
+            self.generations[group] = self.generations.get(group, 0) + 1
+
+    def leave(self, group, consumer):
+        with self.changed:
+            if consumer in self.members.get(group, []):
+                self.members[group].remove(consumer)
+                self.generations[group] += 1
+
+    def commit(self, group, positions):
+        with self.changed:
+            self.committed.setdefault(group, {}).update(positions)
+
+
+class MemoryProducer:
+    def __init__(self, topic):
+        self.topic = topic
+
+    def produce(self, value, partition_key=None):
+        self.topic.append(((value, partition_key),))
+
+    def produce_batch(self, messages):
+        """ Produces (value, partition_key) pairs under one lock """
+        self.topic.append(messages)
+
+
+class AsyncProducer:
+    """
+    Hands messages from the event loop to `producer` running on one thread,
+    so a request awaits its acknowledgement without holding a thread. The
+    thread produces everything queued since its last call as one batch. At
+    most max_in_flight messages are queued or being produced, produce()
+    waits for room beyond that.
+    """
+
+    def __init__(self, producer, max_in_flight=10000, batch_size=500):
+        self.producer = producer
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        self.in_flight = 0
+        self._queue = queue.SimpleQueue()
+        self._slots = None
+        self._thread = threading.Thread(target=self._run, name="async-producer", daemon=True)
+        self._thread.start()
+
+    async def produce(self, value, partition_key=None):
+        """ Returns once acknowledged, raises what the producer raised """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+        self.in_flight += 1
+        try:
+            async with self._slots:
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                self._queue.put((value, partition_key, loop, future))
+                await future
+        finally:
+            self.in_flight -= 1
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            error = None
+            try:
+                self.producer.produce_batch([(value, partition_key) for value, partition_key, _, _ in batch])
+            except Exception as e:
+                error = e
+            for _, _, loop, future in batch:
+                loop.call_soon_threadsafe(_resolve, future, error)
+
+
+def _resolve(future, error):
+    if future.done():  # the request was cancelled, the message went out anyway
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+
+class MemoryConsumer:
+    """
+    Reads the partitions it is assigned, round robin. Without a group the
+    consumer reads every partition, a group without committed offsets starts
+    at the latest ones.
+    """
+
+    def __init__(self, topic, group, start=None, timeout_ms=None, stop_at=None):
+        self.topic = topic
+        self.group = group
+        self.timeout = timeout_ms / 1000 if timeout_ms is not None and timeout_ms >= 0 else None
+        self.stop_at = stop_at
+        self._start = start
+        self._cursor = 0
+        self.positions = {}
+        self._assign(range(len(topic.partitions)))
+
+    def _assign(self, partition_ids):
+        with self.topic.changed:
+            committed = self.topic.committed.get(self.group, {})
+            self.positions = {
+                partition_id: (
+                    self._start if self._start is not None
+                    else committed.get(partition_id, len(self.topic.partitions[partition_id]))
+                )
+                for partition_id in partition_ids
+            }
+
+    @property
+    def held_offsets(self):
+        """ Last consumed offset per partition, -1 if none """
+        return {partition_id: position - 1 for partition_id, position in self.positions.items()}
+
+    def _before_consume(self):
+        pass
+
+    def _next(self):
+        partition_ids = list(self.positions)
+        for i in range(len(partition_ids)):
+            partition_id = partition_ids[(self._cursor + i) % len(partition_ids)]
+            position = self.positions[partition_id]
+            messages = self.topic.partitions[partition_id]
+            end = len(messages) if self.stop_at is None else self.stop_at[partition_id]
+            if position < end:
+                self.positions[partition_id] = position + 1
+                self._cursor += i + 1
+                return Message(messages[position], partition_id, position)
+        return None
+
+    def consume(self):
+        """ Next message, None once the timeout passed without one """
+        self._before_consume()
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self.topic.changed:
+            while True:
+                msg = self._next()
+                if msg is not None or self.stop_at is not None:
+                    return msg
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.topic.changed.wait(remaining)
+
+    def __iter__(self):
+        while True:
+            msg = self.consume()
+            if msg is None:
+                return
+            yield msg
+
+    def commit_offsets(self):
+        if self.group is not None:
+            self.topic.commit(self.group, dict(self.positions))
+
+    def stop(self):
+        pass
+
+
+class MemoryGroupConsumer(MemoryConsumer):
+    """ Splits the partitions with the other members of its group, like a balanced consumer """
+
+    def __init__(self, topic, group, timeout_ms):
+        self.generation = None
+        super().__init__(topic, group, start=None, timeout_ms=timeout_ms)
+        self._assign(())
+        topic.join(group, self)
+
+    def _before_consume(self):
+        generation = self.topic.generations.get(self.group)
+        if generation != self.generation:
+            with self.topic.changed:
+                self.generation = self.topic.generations.get(self.group)
+                members = self.topic.members.get(self.group, [])
+                index = members.index(self) if self in members else 0
+                count = max(len(members), 1)
+            self._assign(p for p in range(len(self.topic.partitions)) if p % count == index)
+
+    def stop(self):
+        self.topic.leave(self.group, self)
@@ -1,69 +1,147 @@
 import os
-import json
 import time
-import logging.config
+import logging
+from collections import OrderedDict
 from datetime import datetime
 from threading import Thread
 
 import connexion
-from sqlalchemy import create_engine, select
+from connexion.middleware import MiddlewarePosition
+from sqlalchemy import and_, create_engine, insert, or_, select
 from sqlalchemy.orm import sessionmaker
-from pykafka import KafkaClient
-from pykafka.common import OffsetType
+from sqlalchemy.pool import StaticPool
 import yaml
 
-from models import Base, TrackAlerts, TrackLocations
+import bucket_digests
+from dimensions import Dimension, string_columns
+from latest import LatestPositions, model_position, upsert_statement, utc
+from models import AlertDescription, Base, Device, DeviceLatest, LocationName, TrackAlerts, TrackLocations
+from trajectory import bucket, encode_polyline, simplify
+from shared.codec import DecodeError, decode
+from shared.digest import digests_from_config, id_bounds
+from shared.health import DependencyFailed, Health
+from shared.log import configure_logging, get_event_logger
+from shared.metrics import MetricsMiddleware, counter, gauge, histogram, metrics_response, SIZE_BUCKETS
+from shared.profile import profiler_from_config
+from shared.tracing import tracer_from_config
+from shared.transport import get_transport
 
 # Configurations
-with open('/app/config/app_conf.yml', 'r', encoding='utf-8') as f:
+with open(os.environ.get("APP_CONF_FILE", '/app/config/app_conf.yml'), 'r', encoding='utf-8') as f:
     app_config = yaml.safe_load(f.read())
 
 # Make sure the logs directory exists
-log_directory = "/app/logs"
+log_directory = os.environ.get("LOG_DIRECTORY", "/app/logs")
 if not os.path.exists(log_directory):
     os.makedirs(log_directory)
 
 # Logging
-with open('/config/log_conf.yml', 'r', encoding='utf-8') as f:
-    log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+configure_logging(os.environ.get("LOG_CONF_FILE", '/config/log_conf.yml'))
 
 logger = logging.getLogger('storageLogger')
+# Per-event lines, sampled by the log config
+event_logger = get_event_logger('storageLogger.events')
 
-# mysql
-# Load database config
-db_user = app_config["datastore"]["user"]
-db_password = app_config["datastore"]["password"]
-db_hostname = app_config["datastore"]["hostname"]
-db_port = app_config["datastore"]["port"]
-db_name = app_config["datastore"]["db"]
 # Load Kafka config
 KAFKA_HOSTNAME = app_config["events"]["hostname"] 
 KAFKA_PORT = app_config["events"]["port"] 
 KAFKA_TOPIC = app_config["events"]["topic"] 
+transport = get_transport(app_config["events"])
+# Consumer threads per replica, each one owns a share of the topic partitions
+KAFKA_WORKERS = app_config["events"].get("workers", 1)
+# Rows are written and offsets committed once per batch
+BATCH_SIZE = app_config["events"].get("batch_size", 500)
+BATCH_WAIT_MS = app_config["events"].get("batch_wait_ms", 200)
+DEDUP_CACHE_SIZE = app_config["events"].get("dedup_cache_size", 100000)
+# Keys of device ids, location names and alert descriptions kept per dimension
+INTERN_CACHE_SIZE = app_config["events"].get("intern_cache_size", 100000)
+LAG_INTERVAL_SECONDS = 10
+# Digests of the stored events per bucket, /digests merges them into wider buckets
+DIGEST_BUCKET_SECONDS = digests_from_config(app_config).bucket_seconds
+
+tracer = tracer_from_config(app_config)
+
+CONSUMED = counter("kafka_consumed_messages_total", "Messages read from the events topic")
+DUPLICATES = counter("storage_duplicate_events_total", "Events skipped or ignored as already stored")
+BATCH_SIZES = histogram("storage_batch_size", "Messages per stored batch", buckets=SIZE_BUCKETS)
+PENDING = gauge("storage_pending_messages", "Consumed messages waiting for the next batch commit", ("worker",))
+COMMIT_LATENCY = histogram("db_commit_duration_seconds", "Time to insert and commit one batch")
+CONSUMER_LAG = gauge("kafka_consumer_lag", "Messages behind the latest offset per partition", ("partition",))
+
+def database_url(datastore):
+    """ datastore.url (e.g. sqlite:///storage.db for local runs) or the MySQL settings """
+    if datastore.get("url"):
+        return datastore["url"]
+    return (
+        f"mysql+mysqldb://{datastore['user']}:{datastore['password']}"
+        f"@{datastore['hostname']}:{datastore['port']}/{datastore['db']}"
+    )
+
+def engine_options(url):
+    if not url.startswith("sqlite"):
+        return {}
+    # Consumer threads and requests share the engine
+    options = {"connect_args": {"check_same_thread": False}}
+    if url in ("sqlite://", "sqlite:///:memory:"):
+        options["poolclass"] = StaticPool  # one connection, or every thread gets its own empty database
+    return options
 
 # Initialize the engine
-db_url = f"mysql+mysqldb://{db_user}:{db_password}@{db_hostname}:{db_port}/{db_name}"
-
-# MySQL connection
-MAX_RETRIES = 5
-for i in range(MAX_RETRIES):
+db_url = database_url(app_config["datastore"])
+
+health = Health(logger)
+# Sampling profiles and thread dumps on GET /debug/..., disabled without DEBUG_TOKEN
+profiler = profiler_from_config(app_config)
+
+# Newest position per device this replica stored, older rows are not upserted
+positions = LatestPositions()
+
+# Keys of the strings event rows refer to
+devices = Dimension(Device, INTERN_CACHE_SIZE)
+location_names = Dimension(LocationName, INTERN_CACHE_SIZE)
+alert_descriptions = Dimension(AlertDescription, INTERN_CACHE_SIZE)
+
+# MySQL connection, retried in the background until the database is up
+def connect_database():
+    engine = create_engine(db_url, **engine_options(db_url))
+    outdated = string_columns(engine)
+    if outdated:
+        raise DependencyFailed(
+            f"The event tables hold strings from before the dimension tables ({outdated}), "
+            "run migrate_dimensions.py on the database first"
+        )
+    # Create missing tables
+    Base.metadata.create_all(engine)
+    # create_all skips tables that exist, so indexes added since are created here
+    for index in TrackLocations.__table__.indexes:
+        index.create(engine, checkfirst=True)
+    session = sessionmaker(bind=engine)()
     try:
-        engine = create_engine(db_url)
-        # Create missing tables
-        Base.metadata.create_all(engine)
-        logger.info("Connected to MySQL")
-        break
-    except Exception as e:
-        logger.error("MySQL not ready.")
-        time.sleep(5)
-else:
-    logger.error("MySQL connection failed after retries.")
-    import sys
-    sys.exit(1)
+        logger.info("Loaded the latest position of %d devices", positions.load(session))
+    finally:
+        session.close()
+    digested = bucket_digests.digest_existing(
+        engine, DIGEST_BUCKET_SECONDS, lambda connection: stored_trace_ids(connection, None, None)
+    )
+    if digested:
+        logger.info("Digested the %d events stored before event_digests existed", digested)
+    return engine
+
+database = health.dependency("database", connect_database)
+
+class DatabaseNotReady(RuntimeError):
+    """ Raised by make_session() until the database is connected """
+
 
 def make_session():
-    return sessionmaker(bind=engine)()
+    if database.value is None:
+        raise DatabaseNotReady("Database is not connected yet")
+    return sessionmaker(bind=database.value)()
+
+
+def database_not_ready():
+    """ Answer of the handlers while the database is not connected, as /health/ready's 503 """
+    return {"message": "Database is not connected yet"}, 503
 
 def parse_timestamp(timestamp):
     try:
@@ -74,8 +152,9 @@ def parse_timestamp(timestamp):
 
 # Get Location events
 def get_trackGPS(start_timestamp, end_timestamp):
-    session = make_session()
+    session = None
     try:
+        session = make_session()
         start = parse_timestamp(start_timestamp)
         end = parse_timestamp(end_timestamp)
 
@@ -92,19 +171,22 @@ def get_trackGPS(start_timestamp, end_timestamp):
         logger.info(f"Found {len(results)} trackGPS events (start: {start}, end: {end})")
         return results
 
+    except DatabaseNotReady:
+        return database_not_ready()
     except Exception as e:
         logger.error(f"Error retrieving GPS data: {e}")
         return {"error": "Database error"}, 500
     
     finally:
-        session.close()
+        if session is not None:
+            session.close()
 
 
 # Get Alert events
 def get_trackAlerts(start_timestamp, end_timestamp):
-    session = make_session()
-
+    session = None
     try:
+        session = make_session()
         start = parse_timestamp(start_timestamp)
         end = parse_timestamp(end_timestamp)
         
@@ -121,130 +203,454 @@ def get_trackAlerts(start_timestamp, end_timestamp):
         logger.info(f"Found {len(results)} trackAlerts events (start: {start}, end: {end})")
         return results
 
+    except DatabaseNotReady:
+        return database_not_ready()
     except Exception as e:
         logger.error(f"Error retrieving alerts data: {e}")
         return {"error": "Database error"}, 500
     
     finally:
-        session.close()
+        if session is not None:
+            session.close()
 
 def get_event_stats():
-    session = make_session()
+    session = None
     try:
+        session = make_session()
         gps_count = session.query(TrackLocations).count()
         alert_count = session.query(TrackAlerts).count()
         return {
             "num_gps_events": gps_count,
             "num_alert_events": alert_count
         }, 200
+    except DatabaseNotReady:
+        return database_not_ready()
     except Exception as e:
         logger.error(f"Error counting events: {e}")
         return {"message": "Internal error"}, 500
     finally:
-        session.close()
+        if session is not None:
+            session.close()
 
 def get_event_ids():
-    session = make_session()
+    session = None
     try:
-        gps = session.query(TrackLocations.device_id, TrackLocations.trace_id).all()
-        alerts = session.query(TrackAlerts.device_id, TrackAlerts.trace_id).all()
+        session = make_session()
+        gps = session.query(Device.name, TrackLocations.trace_id).join(TrackLocations.device).all()
+        alerts = session.query(Device.name, TrackAlerts.trace_id).join(TrackAlerts.device).all()
         combined = [{"event_id": e[0], "trace_id": e[1]} for e in gps + alerts]
         return combined, 200
+    except DatabaseNotReady:
+        return database_not_ready()
     except Exception as e:
         logger.error(f"Error fetching event IDs: {e}")
         return {"message": "Internal error"}, 500
     finally:
-        session.close()
+        if session is not None:
+            session.close()
+
+# GET /devices/latest
+def get_latest_positions():
+    session = None
+    try:
+        session = make_session()
+        return [model_position(row) for row in session.execute(select(DeviceLatest)).scalars()], 200
+    except DatabaseNotReady:
+        return database_not_ready()
+    except Exception as e:
+        logger.error(f"Error reading the latest positions: {e}")
+        return {"message": "Internal error"}, 500
+    finally:
+        if session is not None:
+            session.close()
+
+# GET /devices/{device_id}/latest
+def get_latest_position(device_id):
+    # device_latest rather than this replica's map, other replicas store the devices it does not hold
+    session = None
+    try:
+        session = make_session()
+        row = session.get(DeviceLatest, device_id)
+        if row is None:
+            return {"message": f"No position for device {device_id}"}, 404
+        return model_position(row), 200
+    except DatabaseNotReady:
+        return database_not_ready()
+    except Exception as e:
+        logger.error(f"Error reading the latest position of {device_id}: {e}")
+        return {"message": "Internal error"}, 500
+    finally:
+        if session is not None:
+            session.close()
+
+# GET /devices/{device_id}/trajectory
+def get_trajectory(device_id, start_timestamp, end_timestamp, bucket_seconds=0, tolerance_m=0, output="json"):
+    session = None
+    try:
+        session = make_session()
+        start = parse_timestamp(start_timestamp)
+        end = parse_timestamp(end_timestamp)
+
+        device_key = devices.find(database.value, device_id)
+        statement = select(
+            TrackLocations.latitude, TrackLocations.longitude, TrackLocations.timestamp
+        ).where(
+            TrackLocations.device_key == device_key,
+            TrackLocations.timestamp >= start,
+            TrackLocations.timestamp < end
+        ).order_by(TrackLocations.timestamp)
+        # A device that never sent an event has no key and no points
+        points = [tuple(row) for row in session.execute(statement)] if device_key is not None else []
+    except DatabaseNotReady:
+        return database_not_ready()
+    except Exception as e:
+        logger.error(f"Error retrieving the trajectory of {device_id}: {e}")
+        return {"message": "Database error"}, 500
+    finally:
+        if session is not None:
+            session.close()
+
+    route = simplify(bucket(points, bucket_seconds), tolerance_m)
+    logger.info(f"Trajectory of {device_id}: {len(route)} of {len(points)} points (start: {start}, end: {end})")
+
+    result = {"device_id": device_id, "points_in_window": len(points), "points_returned": len(route)}
+    if output == "polyline":
+        result["polyline"] = encode_polyline(route)
+        # Milliseconds since the first point, in the order of the polyline
+        first = route[0][2] if route else None
+        result["start"] = utc(first).isoformat() + "Z" if first else None
+        result["offsets_ms"] = [round((point[2] - first).total_seconds() * 1000) for point in route]
+    else:
+        result["points"] = [
+            {"latitude": lat, "longitude": lon, "timestamp": utc(timestamp).isoformat() + "Z"}
+            for lat, lon, timestamp in route
+        ]
+    return result, 200
+
+def trace_id_filters(column, start_ms, end_ms):
+    """ Conditions on a trace_id column for events received in [start_ms, end_ms) """
+    low, high = id_bounds(start_ms, end_ms)
+    filters = []
+    if low is not None:
+        filters.append(column >= low)
+    if high is not None:
+        filters.append(column < high)
+    return filters
+
+def stored_trace_ids(connection, start_ms, end_ms):
+    for model in (TrackLocations, TrackAlerts):
+        statement = select(model.trace_id).where(*trace_id_filters(model.trace_id, start_ms, end_ms))
+        yield from connection.execute(statement, execution_options={"yield_per": 10000}).scalars()
+
+# GET /digests
+def get_digests(bucket_seconds=86400, start_ms=None, end_ms=None):
+    session = None
+    try:
+        session = make_session()
+        digests = bucket_digests.stored_digests(session, DIGEST_BUCKET_SECONDS)
+        if not digests.aligned(bucket_seconds, start_ms, end_ms):
+            return {"message": f"bucket_seconds, start_ms and end_ms must be multiples of {DIGEST_BUCKET_SECONDS} seconds"}, 400
+        return digests.rollup(bucket_seconds, start_ms, end_ms), 200
+    except DatabaseNotReady:
+        return database_not_ready()
+    except Exception as e:
+        logger.error(f"Error computing digests: {e}")
+        return {"message": "Internal error"}, 500
+    finally:
+        if session is not None:
+            session.close()
+
+# GET /events
+def get_events(start_ms, end_ms):
+    if len(start_ms) != len(end_ms):
+        return {"message": "start_ms and end_ms must be given in pairs"}, 400
+    session = None
+    try:
+        session = make_session()
+        events = {}
+        for key, model in (("gps", TrackLocations), ("alerts", TrackAlerts)):
+            ranges = [and_(*trace_id_filters(model.trace_id, start, end)) for start, end in zip(start_ms, end_ms)]
+            statement = select(model).where(or_(*ranges)).order_by(model.trace_id)
+            events[key] = [result.to_dict() for result in session.execute(statement).scalars()]
+        return events, 200
+    except DatabaseNotReady:
+        return database_not_ready()
+    except Exception as e:
+        logger.error(f"Error fetching events received in {list(zip(start_ms, end_ms))}: {e}")
+        return {"message": "Internal error"}, 500
+    finally:
+        if session is not None:
+            session.close()
+
+class RecentTraceIds:
+    """ Bounded LRU of trace ids this worker already committed """
+
+    def __init__(self, size):
+        self.size = size
+        self.ids = OrderedDict()
+
+    def __contains__(self, trace_id):
+        if trace_id in self.ids:
+            self.ids.move_to_end(trace_id)
+            return True
+        return False
+
+    def add_all(self, trace_ids):
+        for trace_id in trace_ids:
+            self.ids[trace_id] = None
+            self.ids.move_to_end(trace_id)
+        while len(self.ids) > self.size:
+            self.ids.popitem(last=False)
+
+
+def to_row(msg):
+    """ Maps a decoded message to its table and insert values """
+    payload = msg["payload"]
+    row = {
+        "device_id": payload["device_id"],
+        "latitude": payload["latitude"],
+        "longitude": payload["longitude"],
+        "location_name": payload["location_name"],
+        "timestamp": datetime.fromisoformat(payload["timestamp"].replace("Z", "+00:00")),
+        "trace_id": payload["trace_id"],
+    }
+    if msg["type"] == "TrackGPS":
+        return TrackLocations, row
+    if msg["type"] == "TrackAlerts":
+        row["alert_desc"] = payload["alert_desc"]
+        return TrackAlerts, row
+    return None, None
+
+
+def dimension_key(keys, name, dimension, row):
+    """ Key of name, None (logged) if the database matched it to a name spelled otherwise """
+    key = keys.get(name)
+    if key is None and name is not None:
+        logger.error("No %s key for %r, event with trace id %d", dimension, name, row["trace_id"])
+    return key
+
+
+def intern(batch):
+    """ The batch as stored, the strings of each row replaced by their dimension keys """
+    engine = database.value
+    rows = [row for model_rows in batch.values() for row in model_rows]
+    device_keys = devices.keys(engine, (row["device_id"] for row in rows))
+    location_keys = location_names.keys(engine, (row["location_name"] for row in rows))
+    alert_keys = alert_descriptions.keys(engine, (row.get("alert_desc") for row in rows))
+
+    stored = {}
+    for model, model_rows in batch.items():
+        stored[model] = []
+        for row in model_rows:
+            device_key = dimension_key(device_keys, row["device_id"], "device", row)
+            if device_key is None:
+                continue  # rows need a device, skipping it beats replaying the batch forever
+            stored_row = {
+                "device_key": device_key,
+                "latitude": row["latitude"],
+                "longitude": row["longitude"],
+                "location_key": dimension_key(location_keys, row["location_name"], "location", row),
+                "timestamp": row["timestamp"],
+                "trace_id": row["trace_id"],
+            }
+            if model is TrackAlerts:
+                stored_row["alert_key"] = dimension_key(alert_keys, row["alert_desc"], "alert", row)
+            stored[model].append(stored_row)
+    return stored
+
+
+def store_batch(batch):
+    """ Inserts a batch of rows per table, rows whose trace_id is already stored are ignored """
+    latest = positions.newest(batch.get(TrackLocations, ()))
+    stored = intern(batch)
+    session = make_session()
+    try:
+        connection = session.connection()
+        inserted = []
+        for model, rows in stored.items():
+            if not rows:
+                continue
+            # Locked on MySQL, so the ids are digested once even if another replica stores them too
+            existing = set(connection.execute(
+                select(model.trace_id).where(model.trace_id.in_([row["trace_id"] for row in rows])).with_for_update()
+            ).scalars())
+            if existing:
+                DUPLICATES.inc(len(existing))
+                logger.info(f"Ignored {len(existing)} duplicate {model.__tablename__} rows")
+                rows = [row for row in rows if row["trace_id"] not in existing]
+                if not rows:
+                    continue
+            statement = (
+                insert(model)
+                .prefix_with("IGNORE", dialect="mysql")
+                .prefix_with("OR IGNORE", dialect="sqlite")
+            )
+            connection.execute(statement, rows)
+            inserted.extend(row["trace_id"] for row in rows)
+        if inserted:
+            digests = bucket_digests.deltas(DIGEST_BUCKET_SECONDS, inserted)
+            connection.execute(bucket_digests.upsert_statement(connection.dialect.name), digests)
+        if latest:
+            connection.execute(upsert_statement(connection.dialect.name), latest)
+        session.commit()
+        positions.put(latest)
+    finally:
+        session.close()  # Ensure session closes every time
+
 
-def process_messages():
+def update_lag(topic, consumer):
+    """ Sets CONSUMER_LAG for the partitions this consumer holds """
+    latest = topic.latest_offsets()
+    for partition_id, offset in consumer.held_offsets.items():
+        if partition_id in latest:
+            # held offsets are the last consumed message, latest is the next one to be written
+            CONSUMER_LAG.labels(str(partition_id)).set(max(latest[partition_id] - offset - 1, 0))
+
+
+def process_messages(worker_id):
     """ Process event messages """
+    database.wait()  # Nothing to store into before that
+    # Per worker: a replayed trace id comes back on the same partition
+    recent_ids = RecentTraceIds(DEDUP_CACHE_SIZE)
+    pending_gauge = PENDING.labels(str(worker_id))
+
     while True:  # Keep the consumer running even if it crashes
+        consumer = None
         try:
-            hostname = f"{KAFKA_HOSTNAME}:{KAFKA_PORT}"
-            client = KafkaClient(hosts=hostname)
-
-            if KAFKA_TOPIC.encode("utf-8") not in client.topics:
+            if not transport.has_topic():
                 logger.error(f"Kafka topic '{KAFKA_TOPIC}' does not exist. Retrying in 10s...")
                 time.sleep(10)
                 continue  # Skip iteration if topic does not exist
 
-            topic = client.topics[KAFKA_TOPIC.encode("utf-8")]
+            topic = transport.topic()
 
-            consumer = topic.get_simple_consumer(
-                consumer_group=b"event_group",
-                reset_offset_on_start=False,
-                auto_offset_reset=OffsetType.LATEST
-            )
+            # Members of event_group (across threads and replicas) split the
+            # partitions between them. The receiver keys by device_id, so one
+            # worker sees all events of a device, in order.
+            consumer = topic.group_consumer(b"event_group", BATCH_WAIT_MS)
 
-            logger.info("Kafka Consumer started, waiting for messages")
-            
-            # Stay in the loop, waiting for new messages
-            for msg in consumer:
-                if msg is None:
-                    continue  # No new messages, keep waiting
+            logger.info(f"Kafka Consumer worker {worker_id} started, waiting for messages")
 
-                try:
-                    msg_str = msg.value.decode("utf-8")
-                    msg = json.loads(msg_str)
-
-                    logger.info("Message: %s" % msg)
-
-                    payload = msg["payload"]
-
-                    session = make_session()
-                    timestamp = datetime.fromisoformat(payload["timestamp"].replace("Z", "+00:00"))
-                    trace_id = payload["trace_id"]        
-
-                    if msg["type"] == "TrackGPS":
-                        event = TrackLocations(
-                            device_id=payload["device_id"],
-                            latitude=payload["latitude"],
-                            longitude=payload["longitude"],
-                            location_name=payload["location_name"],
-                            timestamp=timestamp,
-                            trace_id=trace_id
-                        )
-                        session.add(event)
-                        session.commit()
-
-                        # Logging when event is successfully stored
-                        logger.debug(f"Stored trackGPS event with trace id {trace_id}")
-
-                    elif msg["type"] == "TrackAlerts":
-                        # Store the event2 to the DB 
-                        event = TrackAlerts(
-                            device_id=payload["device_id"],
-                            latitude=payload["latitude"],
-                            longitude=payload["longitude"],
-                            location_name=payload["location_name"],
-                            alert_desc=payload["alert_desc"],
-                            timestamp=timestamp,
-                            trace_id=trace_id 
-                        )
-                        session.add(event)
-                        session.commit()
-                        
-                        # Use DEBUG level for stored events as specified
-                        logger.debug(f"Stored event trackAlerts with a trace id of {trace_id}")
-                    
-                finally:
-                    session.close()  # Ensure session closes every time
-                
-                consumer.commit_offsets()
+            batch = {TrackLocations: [], TrackAlerts: []}
+            batch_ids = set()
+            # (trace_id, produced ns, consumed ns) of the batched events
+            batch_traces = []
+            pending = 0
+            deadline = None
+            next_lag_update = 0
+
+            # Stay in the loop, waiting for new messages
+            while True:
+                msg = consumer.consume()
+
+                if msg is not None:
+                    CONSUMED.inc()
+                    pending += 1
+                    pending_gauge.set(pending)
+                    if deadline is None:
+                        deadline = time.monotonic() + BATCH_WAIT_MS / 1000
+                    try:
+                        msg = decode(msg.value)
+                        event_logger.info("Message: %s", msg)
+                        model, row = to_row(msg)
+                    except (DecodeError, KeyError, ValueError) as e:
+                        # Skip messages that cannot be stored instead of crashing the consumer
+                        logger.error("Skipping invalid message: %s", e)
+                        model = None
+
+                    if model is not None:
+                        trace_id = row["trace_id"]
+                        if trace_id in batch_ids or trace_id in recent_ids:
+                            DUPLICATES.inc()
+                            event_logger.debug("Skipping duplicate event with trace id %d", trace_id)
+                        else:
+                            batch[model].append(row)
+                            batch_ids.add(trace_id)
+                            # Binary messages without stamps decode with 0, skip those too
+                            produced = (msg.get("trace") or {}).get("produced")
+                            if produced:
+                                batch_traces.append((trace_id, produced, time.time_ns()))
+
+                # Flush when the batch is full, its wait time is over or the topic is idle
+                if pending and (pending >= BATCH_SIZE or msg is None or time.monotonic() >= deadline):
+                    with COMMIT_LATENCY.time():
+                        store_batch(batch)
+                    BATCH_SIZES.observe(pending)
+                    committed = time.time_ns()
+                    for trace_id, produced, consumed in batch_traces:
+                        tracer.record(trace_id, {
+                            "queue": (consumed - produced) / 1e9,
+                            "commit": (committed - consumed) / 1e9,
+                        })
+                    # Offsets only move after the rows are committed, a crash in
+                    # between replays the batch and the duplicates are ignored
+                    consumer.commit_offsets()
+                    recent_ids.add_all(batch_ids)
+
+                    logger.debug(
+                        "Stored %d trackGPS and %d trackAlerts events",
+                        len(batch[TrackLocations]), len(batch[TrackAlerts])
+                    )
+                    batch = {TrackLocations: [], TrackAlerts: []}
+                    batch_ids = set()
+                    batch_traces = []
+                    pending = 0
+                    pending_gauge.set(0)
+                    deadline = None
+
+                if time.monotonic() >= next_lag_update:
+                    update_lag(topic, consumer)
+                    next_lag_update = time.monotonic() + LAG_INTERVAL_SECONDS
         
         except Exception as e:
-            logger.error(f"Kafka Consumer crashed: {e}")
+            logger.error(f"Kafka Consumer worker {worker_id} crashed: {e}")
+            if consumer is not None:
+                try:
+                    consumer.stop()  # Leave the group so partitions get reassigned
+                except Exception:
+                    pass
             time.sleep(5) # Wait before restarting
         
 
-# thread to consume messages
+# threads to consume messages
 def setup_kafka_thread():
-    t1 = Thread(target=process_messages)
-    t1.setDaemon(True)
-    t1.start()
-
-app = connexion.FlaskApp(__name__, specification_dir='.')
-app.add_api("openapi.yml", base_path="/storage", strict_validation=True, validate_responses=True)
+    for worker_id in range(KAFKA_WORKERS):
+        t1 = Thread(target=process_messages, args=(worker_id,), name=f"kafka-worker-{worker_id}")
+        t1.daemon = True
+        t1.start()
+
+# GET /traces/slow
+def get_slow_traces(limit=20):
+    return tracer.slow_traces(limit), 200
+
+# GET /debug/profile
+def get_profile(seconds=10, hz=100, thread=None):
+    return profiler.profile_response(seconds, hz, thread)
+
+# GET /debug/threads
+def get_threads():
+    return profiler.threads_response()
+
+# GET /metrics
+def get_metrics():
+    return metrics_response()
+
+# GET /health/live
+def get_liveness():
+    return health.liveness()
+
+# GET /health/ready
+def get_readiness():
+    return health.readiness()
+
+def create_app():
+    """ Builds the app, the database connects when the server starts it """
+    app = connexion.FlaskApp(__name__, specification_dir='.', lifespan=health.lifespan)
+    app.add_api("openapi.yml", base_path="/storage", strict_validation=True, validate_responses=True)
+    app.add_middleware(MetricsMiddleware, position=MiddlewarePosition.BEFORE_SECURITY)
+    return app
+
+app = create_app()
 
 if __name__ == "__main__":
     logger.info("Storage Service received")
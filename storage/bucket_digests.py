@@ -0,0 +1,88 @@
+"""
+Digests of the stored events per digests.bucket_seconds bucket, for
+GET /digests without reading the event tables.
+
+store_batch adds the trace ids it inserts with upsert_statement, in the
+same transaction as the rows, and the digests of any bucket width are
+merged from event_digests when asked:
+
+    stored_digests(session, bucket_seconds)   BucketDigests of event_digests
+
+Only ids that were not stored yet are added: store_batch reads which ids of
+a batch are already there, locking them on MySQL so a replica storing the
+same ids waits for this batch. A database that has events but no digests,
+stored before event_digests existed, is digested once when storage connects.
+"""
+from sqlalchemy import func, select
+from sqlalchemy.dialects import mysql, sqlite
+
+from models import EventDigest
+from shared.digest import BucketDigests
+
+
+def deltas(bucket_seconds, trace_ids):
+    """ event_digests rows to add for trace_ids, one per bucket """
+    added = BucketDigests(bucket_seconds)
+    for trace_id in trace_ids:
+        added.add(trace_id)
+    return [
+        {"start_ms": start_ms, "events": count, "id_xor": digest}
+        for start_ms, (count, digest) in added.buckets.items()
+    ]
+
+
+def _xor(column, value):
+    # a ^ b of 63 bit values, SQLite has no XOR operator
+    return column.op("|")(value) - column.op("&")(value)
+
+
+def upsert_statement(dialect_name):
+    """ Insert into event_digests that adds to the bucket already there """
+    if dialect_name == "mysql":
+        statement = mysql.insert(EventDigest)
+        return statement.on_duplicate_key_update(
+            events=EventDigest.events + statement.inserted.events,
+            id_xor=_xor(EventDigest.id_xor, statement.inserted.id_xor),
+        )
+    if dialect_name == "sqlite":
+        statement = sqlite.insert(EventDigest)
+        return statement.on_conflict_do_update(
+            index_elements=["start_ms"],
+            set_={
+                "events": EventDigest.events + statement.excluded.events,
+                "id_xor": _xor(EventDigest.id_xor, statement.excluded.id_xor),
+            },
+        )
+    raise ValueError(f"No event_digests upsert for the {dialect_name} dialect")
+
+
+def stored_digests(session, bucket_seconds):
+    digests = BucketDigests(bucket_seconds)
+    for row in session.execute(select(EventDigest)).scalars():
+        digests.buckets[row.start_ms] = [row.events, row.id_xor]
+    return digests
+
+
+def digest_existing(engine, bucket_seconds, trace_ids):
+    """ Fills an empty event_digests from trace_ids, returns how many ids were digested """
+    with engine.begin() as connection:
+        if connection.execute(select(func.count()).select_from(EventDigest)).scalar():
+            return 0
+        digests = BucketDigests(bucket_seconds)
+        count = 0
+        for trace_id in trace_ids(connection):
+            digests.add(trace_id)
+            count += 1
+        rows = [
+            {"start_ms": start_ms, "events": events, "id_xor": digest}
+            for start_ms, (events, digest) in digests.buckets.items()
+        ]
+        if rows:
+            # Another replica filling the table at the same time writes the same rows
+            statement = (
+                EventDigest.__table__.insert()
+                .prefix_with("IGNORE", dialect="mysql")
+                .prefix_with("OR IGNORE", dialect="sqlite")
+            )
+            connection.execute(statement, rows)
+    return count
@@ -0,0 +1,105 @@
+"""
+Dimension tables for the strings the event tables repeat on every row:
+device ids, location names and alert descriptions. Event rows hold the
+integer key of their strings, the models join them back for the JSON API.
+
+    devices.keys(engine, names)  {name: key}, inserting the names not stored yet
+    devices.find(engine, name)   key of a stored name, None if there is none
+
+Keys are cached in process, so a batch of events only reads the database for
+names this replica has not seen. New names are inserted and read back in
+transactions of their own, committed before the batch that references them:
+a name another worker or replica inserts at the same time is ignored as a
+duplicate and its key read once that insert is visible.
+
+Names are compared byte for byte (utf8mb4_bin on MySQL, models.name_type).
+If the database still matches a name to one spelled otherwise, keys() has
+no key for it and storage logs the event instead of failing the batch.
+
+Databases created before the dimension tables still hold the strings in the
+event tables, create_all does not change existing tables. string_columns()
+finds them, storage refuses to start on them and migrate_dimensions.py
+moves them to the dimension tables in place.
+"""
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import insert, inspect, select
+
+# Columns of the event tables before the dimension tables, per table
+STRING_COLUMNS = {
+    "track_locations": ("device_id", "location_name"),
+    "track_alerts": ("device_id", "location_name", "alert_desc"),
+}
+
+
+class Dimension:
+    """ Bounded LRU of name -> key over one dimension table """
+
+    def __init__(self, model, size=100000):
+        self.model = model
+        self.size = size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(self, names):
+        found = {}
+        with self._lock:
+            for name in names:
+                key = self._keys.get(name)
+                if key is not None:
+                    self._keys.move_to_end(name)
+                    found[name] = key
+        return found
+
+    def _remember(self, found):
+        with self._lock:
+            self._keys.update(found)
+            for name in found:
+                self._keys.move_to_end(name)
+            while len(self._keys) > self.size:
+                self._keys.popitem(last=False)
+
+    def _read(self, engine, names):
+        with engine.connect() as connection:
+            statement = select(self.model.name, self.model.id).where(self.model.name.in_(names))
+            return dict(connection.execute(statement).all())
+
+    def keys(self, engine, names):
+        names = {name for name in names if name is not None}
+        found = self._cached(names)
+        missing = names - found.keys()
+        if missing:
+            stored = self._read(engine, missing)
+            new = missing - stored.keys()
+            if new:
+                statement = (
+                    insert(self.model)
+                    .prefix_with("IGNORE", dialect="mysql")
+                    .prefix_with("OR IGNORE", dialect="sqlite")
+                )
+                with engine.begin() as connection:
+                    connection.execute(statement, [{"name": name} for name in new])
+                stored.update(self._read(engine, new))
+            self._remember(stored)
+            found.update(stored)
+        return found
+
+    def find(self, engine, name):
+        found = self._cached((name,)) or self._read(engine, (name,))
+        if found:
+            self._remember(found)
+        return found.get(name)
+
+
+def string_columns(engine):
+    """ {table: [string columns]} of the event tables that still hold strings instead of keys """
+    tables = inspect(engine)
+    found = {}
+    for table, columns in STRING_COLUMNS.items():
+        if tables.has_table(table):
+            existing = {column["name"] for column in tables.get_columns(table)}
+            old = [column for column in columns if column in existing]
+            if old:
+                found[table] = old
+    return found
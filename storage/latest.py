@@ -0,0 +1,105 @@
+"""
+Last known position of every device, for GET /devices/latest and
+GET /devices/{device_id}/latest.
+
+store_batch passes the TrackGPS rows it inserts to positions.newest(rows),
+the newest row per device that is newer than the position this replica
+knows. Those are upserted into device_latest in the same transaction as the
+events and put into the map once committed, so the map only saves upserts
+of rows that are already older. After a restart the map is reloaded from
+device_latest, one row per device.
+
+The lookups read device_latest, one row per device, never the event
+history. Its rows are what every replica stored: after a rebalance another
+replica stores the devices of the partitions this one gave up. The upsert
+only replaces a row with a position at least as new, so a late or replayed
+event never moves a device back.
+"""
+import threading
+from datetime import timezone
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects import mysql, sqlite
+
+from models import DeviceLatest
+
+COLUMNS = ("latitude", "longitude", "location_name", "timestamp", "trace_id")
+
+
+def utc(timestamp):
+    """ Naive UTC, the databases return DateTime columns without a timezone """
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def to_position(row):
+    return {
+        "device_id": row["device_id"],
+        "latitude": row["latitude"],
+        "longitude": row["longitude"],
+        "location_name": row["location_name"],
+        "timestamp": utc(row["timestamp"]).isoformat() + "Z",
+        "trace_id": row["trace_id"],
+    }
+
+
+def model_position(row):
+    """ Position of a DeviceLatest row """
+    return to_position({"device_id": row.device_id, **{column: getattr(row, column) for column in COLUMNS}})
+
+
+class LatestPositions:
+    def __init__(self):
+        self._positions = {}  # device_id -> (naive UTC timestamp, position)
+        self._lock = threading.Lock()
+
+    def load(self, session):
+        """ Reads every device from device_latest """
+        positions = {}
+        for row in session.execute(select(DeviceLatest)).scalars():
+            positions[row.device_id] = (utc(row.timestamp), model_position(row))
+        with self._lock:
+            self._positions = positions
+        return len(positions)
+
+    def newest(self, rows):
+        """ Newest row per device among rows, only where it is newer than the known position """
+        newest = {}
+        with self._lock:
+            for row in rows:
+                device_id = row["device_id"]
+                timestamp = utc(row["timestamp"])
+                known = newest.get(device_id) or self._positions.get(device_id)
+                if known is None or timestamp > known[0]:
+                    newest[device_id] = (timestamp, row)
+        return [row for _, row in newest.values()]
+
+    def put(self, rows):
+        with self._lock:
+            for row in rows:
+                timestamp = utc(row["timestamp"])
+                known = self._positions.get(row["device_id"])
+                if known is None or timestamp > known[0]:
+                    self._positions[row["device_id"]] = (timestamp, to_position(row))
+
+
+def upsert_statement(dialect_name):
+    """ Insert into device_latest that replaces the row of a device already there with a newer one """
+    if dialect_name == "mysql":
+        statement = mysql.insert(DeviceLatest)
+        newer = statement.inserted.timestamp >= DeviceLatest.timestamp
+        # MySQL assigns in order and later conditions see the new values, timestamp goes last
+        columns = ["date_updated"] + [column for column in COLUMNS if column != "timestamp"] + ["timestamp"]
+        values = {"date_updated": func.now(), **{column: statement.inserted[column] for column in COLUMNS}}
+        return statement.on_duplicate_key_update([
+            (column, func.if_(newer, values[column], DeviceLatest.__table__.c[column])) for column in columns
+        ])
+    if dialect_name == "sqlite":
+        statement = sqlite.insert(DeviceLatest)
+        return statement.on_conflict_do_update(
+            index_elements=["device_id"],
+            set_={"date_updated": func.now(), **{column: statement.excluded[column] for column in COLUMNS}},
+            where=statement.excluded.timestamp >= DeviceLatest.timestamp,
+        )
+    raise ValueError(f"No device_latest upsert for the {dialect_name} dialect")
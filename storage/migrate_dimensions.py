@@ -0,0 +1,118 @@
+"""
+Moves the device ids, location names and alert descriptions of a database
+created before the dimension tables into them, in place:
+
+    APP_CONF_FILE=/app/config/app_conf.yml python migrate_dimensions.py
+
+Stop the storage replicas first. For each event table still holding strings
+the script fills the dimension tables with its distinct strings, adds the key
+columns and sets them, then drops the string columns and their index.
+Storage creates the new (device_key, timestamp) index when it connects.
+Running it again after it stopped halfway picks up where it stopped, once a
+table is migrated it is left alone.
+
+On MySQL it also gives the names of dimension tables created before they
+were compared byte for byte the utf8mb4_bin collation (see models.name_type),
+so names differing only in case or accents get keys of their own.
+"""
+import os
+
+import yaml
+from sqlalchemy import create_engine, inspect, text
+
+from dimensions import string_columns
+from models import Base
+
+# string column -> (key column, dimension table)
+KEYS = {
+    "device_id": ("device_key", "devices"),
+    "location_name": ("location_key", "location_names"),
+    "alert_desc": ("alert_key", "alert_descriptions"),
+}
+OLD_INDEXES = {"track_locations": "ix_track_locations_device_timestamp"}
+# table -> (name column, length), compared byte for byte on MySQL
+NAME_COLUMNS = {
+    "devices": ("name", 50),
+    "location_names": ("name", 100),
+    "alert_descriptions": ("name", 100),
+    "device_latest": ("device_id", 50),
+}
+
+with open(os.environ.get("APP_CONF_FILE", "app_conf.yml"), "r", encoding="utf-8") as f:
+    app_config = yaml.safe_load(f.read())
+
+datastore = app_config["datastore"]
+db_url = datastore.get("url") or (
+    f"mysql+mysqldb://{datastore['user']}:{datastore['password']}"
+    f"@{datastore['hostname']}:{datastore['port']}/{datastore['db']}"
+)
+
+
+def binary_names(engine):
+    """ Gives the name columns the utf8mb4_bin collation where they still have another one """
+    tables = inspect(engine)
+    with engine.begin() as connection:
+        for table, (column, length) in NAME_COLUMNS.items():
+            if not tables.has_table(table):
+                continue
+            found = next(c for c in tables.get_columns(table) if c["name"] == column)
+            if getattr(found["type"], "collation", None) != "utf8mb4_bin":
+                connection.execute(text(
+                    f"ALTER TABLE {table} MODIFY {column} VARCHAR({length}) "
+                    "CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL"
+                ))
+                print(f"Compared {table}.{column} byte for byte.")
+
+
+def migrate(engine, table, columns):
+    mysql = engine.dialect.name == "mysql"
+    ignore = "INSERT IGNORE" if mysql else "INSERT OR IGNORE"
+    # MySQL commits each ALTER TABLE on its own, every step checks what a failed run already did
+    existing = {column["name"] for column in inspect(engine).get_columns(table)}
+    with engine.begin() as connection:
+        for column in columns:
+            key, dimension = KEYS[column]
+            # The old columns compare without case or accents on MySQL, the names must not
+            value = f"CONVERT({table}.{column} USING utf8mb4) COLLATE utf8mb4_bin" if mysql else f"{table}.{column}"
+            connection.execute(text(
+                f"{ignore} INTO {dimension} (name) SELECT DISTINCT {value} FROM {table} WHERE {column} IS NOT NULL"
+            ))
+            if key not in existing:
+                connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {key} INTEGER NULL"))
+            connection.execute(text(
+                f"UPDATE {table} SET {key} = (SELECT id FROM {dimension} WHERE name = {value})"
+            ))
+
+    indexes = {index["name"] for index in inspect(engine).get_indexes(table)}
+    with engine.begin() as connection:
+        if OLD_INDEXES.get(table) in indexes:
+            connection.execute(text(f"DROP INDEX {OLD_INDEXES[table]}" + (f" ON {table}" if mysql else "")))
+        for column in columns:
+            connection.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+        if mysql:
+            # SQLite cannot add constraints to a table, its keys stay nullable
+            connection.execute(text(f"ALTER TABLE {table} MODIFY device_key INTEGER NOT NULL"))
+            for column in columns:
+                key, dimension = KEYS[column]
+                connection.execute(text(
+                    f"ALTER TABLE {table} ADD CONSTRAINT fk_{table}_{key} FOREIGN KEY ({key}) REFERENCES {dimension} (id)"
+                ))
+
+
+def main():
+    engine = create_engine(db_url)
+    if engine.dialect.name == "mysql":
+        binary_names(engine)
+    outdated = string_columns(engine)
+    if not outdated:
+        print("The event tables already hold keys, nothing to migrate.")
+        return
+    # The dimension tables, existing tables are left as they are
+    Base.metadata.create_all(engine)
+    for table, columns in outdated.items():
+        migrate(engine, table, columns)
+        print(f"Migrated {', '.join(columns)} of {table}.")
+
+
+if __name__ == "__main__":
+    main()
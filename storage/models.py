@@ -1,27 +1,64 @@
-from sqlalchemy.orm import DeclarativeBase, mapped_column
-from sqlalchemy import Integer, String, DateTime, func, Float, BigInteger
+from sqlalchemy.orm import DeclarativeBase, mapped_column, relationship
+from sqlalchemy import Integer, String, DateTime, func, Float, BigInteger, ForeignKey, Index
+from sqlalchemy.dialects import mysql
 
 class Base(DeclarativeBase):
     pass
 
+
+def name_type(length):
+    """ Compared byte for byte: MySQL's default collation takes "Dev1" and "dev1" for one name """
+    return String(length).with_variant(
+        mysql.VARCHAR(length, charset="utf8mb4", collation="utf8mb4_bin"), "mysql", "mariadb"
+    )
+
+
+# Strings repeated on every event row are stored once, rows hold their key
+
+class Device(Base):
+    __tablename__ = "devices"
+
+    id = mapped_column(Integer, primary_key=True, autoincrement=True)
+    name = mapped_column(name_type(50), nullable=False, unique=True)
+
+
+class LocationName(Base):
+    __tablename__ = "location_names"
+
+    id = mapped_column(Integer, primary_key=True, autoincrement=True)
+    name = mapped_column(name_type(100), nullable=False, unique=True)
+
+
+class AlertDescription(Base):
+    __tablename__ = "alert_descriptions"
+
+    id = mapped_column(Integer, primary_key=True, autoincrement=True)
+    name = mapped_column(name_type(100), nullable=False, unique=True)
+
+
 class TrackLocations(Base):
     __tablename__ = "track_locations"
+    # Trajectory queries read one device over a time range
+    __table_args__ = (Index("ix_track_locations_device_timestamp", "device_key", "timestamp"),)
 
     id = mapped_column(Integer, primary_key=True, autoincrement=True)
-    device_id = mapped_column(String(50), nullable=False)
+    device_key = mapped_column(Integer, ForeignKey("devices.id"), nullable=False)
     latitude = mapped_column(Float, nullable=False)
     longitude = mapped_column(Float, nullable=False)
-    location_name = mapped_column(String(100), nullable=True)
+    location_key = mapped_column(Integer, ForeignKey("location_names.id"), nullable=True)
     timestamp = mapped_column(DateTime(timezone=True), nullable=False)
-    trace_id = mapped_column(BigInteger, nullable=False)  
+    trace_id = mapped_column(BigInteger, nullable=False, unique=True)  
     date_created = mapped_column(DateTime, nullable=False, default=func.now())
 
+    device = relationship(Device, lazy="joined", innerjoin=True)
+    location = relationship(LocationName, lazy="joined")
+
     def to_dict(self):
         return {
-            "device_id": self.device_id,
+            "device_id": self.device.name,
             "latitude": self.latitude,
             "longitude": self.longitude,
-            "location_name": self.location_name,
+            "location_name": self.location.name if self.location else None,
             "timestamp": self.timestamp.isoformat().replace("+00:00", "Z"),
             "trace_id": self.trace_id
         }
@@ -31,22 +68,46 @@ class TrackAlerts(Base):
     __tablename__ = "track_alerts"
 
     id = mapped_column(Integer, primary_key=True, autoincrement=True)
-    device_id = mapped_column(String(50), nullable=False)
+    device_key = mapped_column(Integer, ForeignKey("devices.id"), nullable=False)
     latitude = mapped_column(Float, nullable=False)
     longitude = mapped_column(Float, nullable=False)
-    location_name = mapped_column(String(100), nullable=True)
-    alert_desc = mapped_column(String(100), nullable=True)
+    location_key = mapped_column(Integer, ForeignKey("location_names.id"), nullable=True)
+    alert_key = mapped_column(Integer, ForeignKey("alert_descriptions.id"), nullable=True)
     timestamp = mapped_column(DateTime(timezone=True), nullable=False)
-    trace_id = mapped_column(BigInteger, nullable=False) 
+    trace_id = mapped_column(BigInteger, nullable=False, unique=True) 
     date_created = mapped_column(DateTime, nullable=False, default=func.now())
 
+    device = relationship(Device, lazy="joined", innerjoin=True)
+    location = relationship(LocationName, lazy="joined")
+    alert = relationship(AlertDescription, lazy="joined")
+
     def to_dict(self):
         return {
-            "device_id": self.device_id,
+            "device_id": self.device.name,
             "latitude": self.latitude,
             "longitude": self.longitude,
-            "location_name": self.location_name,
-            "alert_desc": self.alert_desc,
+            "location_name": self.location.name if self.location else None,
+            "alert_desc": self.alert.name if self.alert else None,
             "timestamp": self.timestamp.isoformat().replace("+00:00", "Z"),
             "trace_id": self.trace_id
-        }
\ No newline at end of file
+        }
+
+class DeviceLatest(Base):
+    """ Newest TrackGPS row per device, kept up to date by the consumer """
+    __tablename__ = "device_latest"
+
+    device_id = mapped_column(name_type(50), primary_key=True)
+    latitude = mapped_column(Float, nullable=False)
+    longitude = mapped_column(Float, nullable=False)
+    location_name = mapped_column(String(100), nullable=True)
+    timestamp = mapped_column(DateTime(timezone=True), nullable=False)
+    trace_id = mapped_column(BigInteger, nullable=False)
+    date_updated = mapped_column(DateTime, nullable=False, default=func.now(), onupdate=func.now())
+
+class EventDigest(Base):
+    """ Count and XOR of the id hashes of the stored events per bucket, see shared/digest.py """
+    __tablename__ = "event_digests"
+
+    start_ms = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    events = mapped_column(Integer, nullable=False)
+    id_xor = mapped_column(BigInteger, nullable=False)
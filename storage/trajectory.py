@@ -0,0 +1,92 @@
+"""
+Downsampling and encoding of a device's route for GET /devices/{device_id}/trajectory.
+
+Points are (latitude, longitude, timestamp) tuples in time order.
+
+    bucket(points, seconds)          first point of every `seconds` wide time bucket
+    simplify(points, tolerance_m)    Douglas-Peucker, drops points closer than
+                                     tolerance_m to the line their neighbours draw
+    encode_polyline(points)          Google encoded polyline of the coordinates
+
+The first and last point of the window are always kept.
+"""
+import math
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def bucket(points, seconds):
+    if seconds <= 0 or len(points) < 3:
+        return list(points)
+    kept = []
+    current = None
+    for point in points[:-1]:
+        key = int(point[2].timestamp() // seconds)
+        if key != current:
+            kept.append(point)
+            current = key
+    kept.append(points[-1])
+    return kept
+
+
+def _project(points):
+    """ Metres on a plane tangent at the first point, close enough over a city """
+    latitude0 = math.radians(points[0][0])
+    scale = math.cos(latitude0)
+    return [
+        (math.radians(lon) * scale * EARTH_RADIUS_M, math.radians(lat) * EARTH_RADIUS_M)
+        for lat, lon, _ in points
+    ]
+
+
+def _distance_to_segment(p, a, b):
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    length2 = dx * dx + dy * dy
+    if length2 == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    t = max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / length2))
+    return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+def simplify(points, tolerance_m):
+    if tolerance_m <= 0 or len(points) < 3:
+        return list(points)
+    xy = _project(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    # Iterative, a day of fixes would go past the recursion limit
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, distance = None, tolerance_m
+        for i in range(first + 1, last):
+            d = _distance_to_segment(xy[i], xy[first], xy[last])
+            if d > distance:
+                farthest, distance = i, d
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def _encode_value(value):
+    value = ~(value << 1) if value < 0 else value << 1
+    chunks = []
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+    return "".join(chunks)
+
+
+def encode_polyline(points, precision=5):
+    factor = 10 ** precision
+    encoded = []
+    previous_lat = previous_lon = 0
+    for lat, lon, _ in points:
+        lat, lon = round(lat * factor), round(lon * factor)
+        encoded.append(_encode_value(lat - previous_lat))
+        encoded.append(_encode_value(lon - previous_lon))
+        previous_lat, previous_lon = lat, lon
+    return "".join(encoded)